@@ -1,18 +1,32 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import Pool
 from sale import SalesReport, SalesReportWizardStart, SalesReportWizard
+from summary import SaleSummary, Sale, SaleLine
+from job import SalesReportJob, SalesReportJobStatus, SalesReportJobOutput
+from definition import SalesReportDefinition
+from template import warm_templates
 
 
 def register():
     Pool.register(
         SalesReportWizardStart,
+        SaleSummary,
+        Sale,
+        SaleLine,
+        SalesReportJob,
+        SalesReportJobStatus,
+        SalesReportDefinition,
         module='sales_reports', type_='model'
     )
     Pool.register(
         SalesReport,
+        SalesReportJobOutput,
         module='sales_reports', type_='report'
     )
     Pool.register(
         SalesReportWizard,
         module='sales_reports', type_='wizard'
     )
+    warm_templates([
+        'sales_reports/reports/sales_report.html',
+    ])
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .sale import SalesReportOptions
+
+__all__ = ['SalesReportDefinition']
+
+logger = logging.getLogger(__name__)
+
+# Hour of the day from which the reports of the previous period are queued
+# by the scheduler, preferably off-peak
+RENDER_DUE_HOUR = config.getint(
+    'sales_reports', 'render_due_hour', default=2
+)
+
+PERIODS = [
+    ('day', 'Previous Day'),
+    ('week', 'Previous Week'),
+    ('month', 'Previous Month'),
+]
+
+
+class SalesReportDefinition(SalesReportOptions, ModelSQL, ModelView):
+    "Sales Report Definition"
+    __name__ = 'report.sales.definition'
+
+    name = fields.Char('Name', required=True)
+    active = fields.Boolean('Active', select=True)
+    period = fields.Selection(PERIODS, 'Period', required=True)
+    company = fields.Many2One('company.company', 'Company', required=True)
+    user = fields.Many2One(
+        'res.user', 'User', required=True,
+        help="The user for whom the report is rendered"
+    )
+    jobs = fields.One2Many(
+        'report.sales.job', 'definition', 'Jobs', readonly=True
+    )
+
+    @staticmethod
+    def default_active():
+        return True
+
+    @staticmethod
+    def default_period():
+        return 'day'
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_user():
+        return Transaction().user
+
+    def get_period(self, date):
+        """
+        Return the start and end dates of the previous period of the
+        definition at date
+        """
+        if self.period == 'week':
+            end_date = date - datetime.timedelta(days=date.weekday() + 1)
+            return end_date - datetime.timedelta(days=6), end_date
+        elif self.period == 'month':
+            end_date = date.replace(day=1) - datetime.timedelta(days=1)
+            return end_date.replace(day=1), end_date
+        day = date - datetime.timedelta(days=1)
+        return day, day
+
+    def get_due_data(self, date):
+        """
+        Return the report data of the previous period at date if it has
+        not been rendered yet, otherwise None
+        """
+        Job = Pool().get('report.sales.job')
+
+        data = self.get_report_data(*self.get_period(date))
+        if Job.search([
+                    ('definition', '=', self.id),
+                    ('data_key', '=', Job.get_data_key(data)),
+                    ('state', '!=', 'failed'),
+                ], limit=1):
+            return None
+        return data
+
+    @classmethod
+    def run_due(cls):
+        """
+        Queue the reports which are due from render_due_hour, called every
+        hour by the scheduler. The reports missed while the server was
+        stopped are queued at the next call.
+        """
+        if datetime.datetime.now().hour >= RENDER_DUE_HOUR:
+            cls.render_due()
+
+    @classmethod
+    def render_due(cls):
+        """
+        Queue the rendering of the reports of the previous period of the
+        active definitions which are not rendered yet. The reports are
+        rendered by the worker pool, so that only job_workers reports are
+        rendered at once.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Job = pool.get('report.sales.job')
+
+        # The definitions and jobs of every user are scheduled
+        with Transaction().set_user(0):
+            definitions = cls.search([])
+            today = Date.today()
+            for definition in definitions:
+                data = definition.get_due_data(today)
+                if data is None:
+                    continue
+                logger.info(
+                    'Queue sales report %s from %s to %s', definition.name,
+                    data['start_date'], data['end_date']
+                )
+                # The jobs are rendered as the users of the definitions
+                with Transaction().set_user(definition.user.id), \
+                        Transaction().set_context(
+                            company=definition.company.id):
+                    Job.enqueue(data, definition)
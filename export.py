@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import os
+import csv
+import datetime
+import tempfile
+from collections import namedtuple
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+__all__ = ['EXPORT_FORMATS', 'Sheet', 'can_export', 'export_sheets']
+
+# Formats in which the report data can be exported without rendering
+EXPORT_FORMATS = ['csv', 'xlsx']
+
+
+class Sheet(namedtuple('Sheet', ['title', 'header', 'rows'])):
+    """
+    A table of the exported data: the title, the column names and an
+    iterable of the rows, which is consumed once
+    """
+    __slots__ = ()
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def write_csv(output, sheets):
+    """
+    Write the sheets one after another to the output file, each preceded
+    by its title and column names and separated by an empty line
+    """
+    writer = csv.writer(output)
+    for index, sheet in enumerate(sheets):
+        if index:
+            writer.writerow([])
+        writer.writerow([_csv_value(sheet.title)])
+        writer.writerow([_csv_value(name) for name in sheet.header])
+        for row in sheet.rows:
+            writer.writerow([_csv_value(value) for value in row])
+
+
+def write_xlsx(file_name, sheets):
+    """
+    Write each sheet to a worksheet of the workbook file_name. The rows
+    are flushed as they are written to keep the memory constant.
+    """
+    workbook = xlsxwriter.Workbook(file_name, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd',
+    })
+    try:
+        bold = workbook.add_format({'bold': True})
+        for sheet in sheets:
+            worksheet = workbook.add_worksheet(sheet.title)
+            worksheet.write_row(0, 0, sheet.header, bold)
+            for number, row in enumerate(sheet.rows, 1):
+                worksheet.write_row(number, 0, row)
+    finally:
+        workbook.close()
+
+
+def can_export(output_format):
+    """
+    Return True if the data can be exported in the output format
+    """
+    if output_format == 'xlsx':
+        return xlsxwriter is not None
+    return output_format in EXPORT_FORMATS
+
+
+def export_sheets(output_format, sheets):
+    """
+    Write the sheets to a temporary file in the output format and return
+    its content
+    """
+    if not can_export(output_format):
+        raise ValueError('Unable to export in %s' % output_format)
+
+    output = tempfile.NamedTemporaryFile(
+        suffix='.' + output_format, prefix='trytond_', delete=False
+    )
+    try:
+        with output:
+            if output_format == 'csv':
+                write_csv(output, sheets)
+        if output_format == 'xlsx':
+            write_xlsx(output.name, sheets)
+        with open(output.name, 'rb') as output_file:
+            return output_file.read()
+    finally:
+        os.remove(output.name)
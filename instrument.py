@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['subscribe', 'unsubscribe', 'profile', 'phase', 'current_profile']
+
+logger = logging.getLogger(__name__)
+
+# Record the duration, queries, rows and memory of each phase of the reports
+INSTRUMENT = config.getboolean('sales_reports', 'instrument', default=False)
+
+_hooks = []
+_local = threading.local()
+
+
+def subscribe(callback):
+    """
+    Call callback with the ReportProfile of each instrumented report once
+    it is rendered. Subscribing instruments every report.
+    """
+    if callback not in _hooks:
+        _hooks.append(callback)
+
+
+def unsubscribe(callback):
+    """
+    Stop calling callback for the instrumented reports
+    """
+    if callback in _hooks:
+        _hooks.remove(callback)
+
+
+def current_profile():
+    """
+    Return the ReportProfile of the report being rendered by the thread or
+    None if it is not instrumented
+    """
+    return getattr(_local, 'profile', None)
+
+
+class CountingCursor(object):
+    """
+    Cursor counting the queries executed and the rows fetched
+    """
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.queries += 1
+        result = self._cursor.execute(*args, **kwargs)
+        return self if result is self._cursor else result
+
+    def executemany(self, *args, **kwargs):
+        self._counter.queries += 1
+        result = self._cursor.executemany(*args, **kwargs)
+        return self if result is self._cursor else result
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._counter.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._counter.rows += len(rows)
+        return rows
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._counter.rows += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection(object):
+    """
+    Connection whose cursors count the queries executed and the rows
+    fetched
+    """
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def _max_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class ReportProfile(object):
+    """
+    The phases of the rendering of a report. Each phase is a dictionary
+    with:
+
+        * name: the name of the phase
+        * duration: the wall time in seconds
+        * queries: the number of SQL queries executed
+        * rows: the number of rows fetched
+        * max_rss: the peak resident memory of the process in kilobytes at
+          the end of the phase
+        * max_rss_growth: the growth of the peak resident memory during the
+          phase in kilobytes
+    """
+
+    def __init__(self, report_name, data=None):
+        self.report_name = report_name
+        self.data = data
+        self.phases = []
+        self.queries = 0
+        self.rows = 0
+        self.start = time.time()
+        self.duration = None
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Record the phase for the duration of the block
+        """
+        start, queries, rows = time.time(), self.queries, self.rows
+        max_rss = _max_rss()
+        try:
+            yield
+        finally:
+            end_max_rss = _max_rss()
+            self.phases.append({
+                'name': name,
+                'duration': time.time() - start,
+                'queries': self.queries - queries,
+                'rows': self.rows - rows,
+                'max_rss': end_max_rss,
+                'max_rss_growth': end_max_rss - max_rss,
+            })
+
+    def format(self):
+        """
+        Return the profile as a single line
+        """
+        return '%s %.3fs %s queries %s rows: %s' % (
+            self.report_name, self.duration or 0, self.queries, self.rows,
+            ', '.join(
+                '%s %.3fs/%sq/%sr/%skB' % (
+                    p['name'], p['duration'], p['queries'], p['rows'],
+                    p['max_rss_growth'])
+                for p in self.phases
+            )
+        )
+
+
+@contextmanager
+def profile(report_name, data=None):
+    """
+    Instrument the rendering of the report for the duration of the block.
+
+    The queries of the transaction are counted, and once the block is left
+    the profile is logged and passed to the subscribed hooks. Nothing is
+    recorded unless the instrument option of the sales_reports
+    configuration section is set, a hook is subscribed or the data has
+    debug set.
+    """
+    if (current_profile() is not None
+            or not (INSTRUMENT or _hooks or (data or {}).get('debug'))):
+        yield current_profile()
+        return
+
+    transaction = Transaction()
+    report_profile = ReportProfile(report_name, data)
+    connection = transaction.connection
+    transaction.connection = CountingConnection(connection, report_profile)
+    _local.profile = report_profile
+    try:
+        yield report_profile
+    finally:
+        _local.profile = None
+        transaction.connection = connection
+        report_profile.duration = time.time() - report_profile.start
+
+        logger.info('%s', report_profile.format())
+        for callback in list(_hooks):
+            try:
+                callback(report_profile)
+            except Exception:
+                logger.error(
+                    'Unable to call report profile hook %s', callback,
+                    exc_info=True
+                )
+
+
+@contextmanager
+def phase(name):
+    """
+    Record the block as a phase of the report being instrumented, if any
+    """
+    report_profile = current_profile()
+    if report_profile is None:
+        yield
+        return
+    with report_profile.phase(name):
+        yield
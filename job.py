@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+import json
+import hashlib
+import logging
+import datetime
+import threading
+import traceback
+
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
+from trytond.report import Report
+from trytond.transaction import Transaction
+
+from .replica import replica_connection
+
+__all__ = ['SalesReportJob', 'SalesReportJobStatus', 'SalesReportJobOutput']
+
+logger = logging.getLogger(__name__)
+
+# Number of threads rendering the queued reports in each server process.
+# With 0, the queued reports are only rendered by the scheduler.
+JOB_WORKERS = config.getint('sales_reports', 'job_workers', default=2)
+# Number of seconds after which a running job is considered left by a
+# stopped server and is queued again
+JOB_TIMEOUT = config.getint('sales_reports', 'job_timeout', default=3600)
+
+STATES = [
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+]
+
+
+def run_queued_jobs(database_name):
+    """
+    Render the queued reports of the database one by one, each in its own
+    transaction, until none is left
+    """
+    while True:
+        with Transaction(new=True).start(database_name, 0):
+            Job = Pool().get('report.sales.job')
+            job_id = Job.pop()
+        if job_id is None:
+            return
+        try:
+            with Transaction(new=True).start(database_name, 0):
+                Job = Pool().get('report.sales.job')
+                Job.process([Job(job_id)])
+        except Exception:
+            logger.error(
+                'Unable to render sales report job %s', job_id, exc_info=True
+            )
+            with Transaction(new=True).start(database_name, 0):
+                Job = Pool().get('report.sales.job')
+                Job.write([Job(job_id)], {
+                    'state': 'failed',
+                    'message': traceback.format_exc(),
+                })
+
+
+class JobWorkerPool(object):
+    """
+    A bounded pool of threads rendering the queued reports of the
+    databases they are notified of
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._condition = threading.Condition()
+        self._pending = set()
+        self._threads = []
+
+    def notify(self, database_name):
+        """
+        Wake up a worker to render the queued reports of the database
+        """
+        with self._condition:
+            self._pending.add(database_name)
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._condition.notify()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                database_name = self._pending.pop()
+            try:
+                run_queued_jobs(database_name)
+            except Exception:
+                logger.error(
+                    'Unable to run sales report jobs on %s', database_name,
+                    exc_info=True
+                )
+
+
+WORKER_POOL = JobWorkerPool(JOB_WORKERS)
+
+
+class JobNotifier(object):
+    """
+    Data manager notifying the worker pool once the transaction which
+    queued a report is committed
+    """
+
+    def __init__(self, database_name):
+        self.database_name = database_name
+
+    def __eq__(self, other):
+        return isinstance(other, JobNotifier) \
+            and other.database_name == self.database_name
+
+    def __ne__(self, other):
+        return not self == other
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        WORKER_POOL.notify(self.database_name)
+
+    def tpc_abort(self, trans):
+        pass
+
+
+class SalesReportJob(ModelSQL, ModelView):
+    "Sales Report Job"
+    __name__ = 'report.sales.job'
+
+    name = fields.Char('Name', readonly=True)
+    state = fields.Selection(
+        STATES, 'State', required=True, readonly=True, select=True
+    )
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    data = fields.Text('Data', readonly=True)
+    started = fields.DateTime('Started', readonly=True)
+    finished = fields.DateTime('Finished', readonly=True)
+    message = fields.Text('Message', readonly=True)
+    output_name = fields.Char('Output Name', readonly=True)
+    output_format = fields.Char('Output Format', readonly=True)
+    output = fields.Binary('Output', filename='output_name', readonly=True)
+    definition = fields.Many2One(
+        'report.sales.definition', 'Definition', readonly=True,
+        ondelete='SET NULL', select=True
+    )
+    data_key = fields.Char('Data Key', readonly=True, select=True)
+    data_version = fields.Text('Data Version', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(SalesReportJob, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def enqueue(cls, data, definition=None):
+        """
+        Queue the rendering of the sales report for the data. The report is
+        rendered by the worker pool once the transaction is committed.
+
+        The jobs are only created by this method, as their output is served
+        to the other users of the company.
+        """
+        values = {
+            'name': 'Sales Report',
+            'data': json.dumps(data, cls=JSONEncoder),
+            'data_key': cls.get_data_key(data),
+        }
+        if definition is not None:
+            values.update({
+                'name': definition.name,
+                'definition': definition.id,
+                'company': definition.company.id,
+            })
+        with Transaction().set_context(_check_access=False):
+            job, = cls.create([values])
+        if JOB_WORKERS:
+            transaction = Transaction()
+            transaction.join(JobNotifier(transaction.database.name))
+        return job
+
+    def get_data(self):
+        """
+        Return the report data of the job
+        """
+        return json.loads(self.data, object_hook=JSONDecoder())
+
+    @staticmethod
+    def get_data_key(data):
+        """
+        Return the key identifying the report data
+        """
+        return hashlib.sha1(
+            json.dumps(data, cls=JSONEncoder, sort_keys=True)
+        ).hexdigest()
+
+    @staticmethod
+    def dump_data_version(version):
+        """
+        Return the data version of the sales report as text
+        """
+        return json.dumps(list(version), cls=JSONEncoder)
+
+    @classmethod
+    def find_rendered(cls, data):
+        """
+        Return the last job of a report definition of the company rendered
+        for the data, or None if there is none or if the sales changed since
+        """
+        return cls.get_shared([
+            ('data_key', '=', cls.get_data_key(data)),
+        ])
+
+    @classmethod
+    def get_shared(cls, domain):
+        """
+        Return the last job of a report definition of the company rendered
+        and matching domain, or None if there is none or if the sales
+        changed since.
+
+        The jobs of the definitions are shared by the users of the company
+        whatever the user who created them. They are returned only if the
+        sales matching their data for the user have the same version as
+        when they were rendered.
+        """
+        SalesReport = Pool().get('report.sales', type='report')
+
+        with Transaction().set_user(0):
+            jobs = cls.search(domain + [
+                ('definition', '!=', None),
+                ('company', '=', Transaction().context.get('company')),
+                ('state', '=', 'done'),
+            ], order=[('finished', 'DESC')], limit=1)
+            if not jobs:
+                return None
+            job, = jobs
+            data, data_version = job.get_data(), job.data_version
+        version = cls.dump_data_version(SalesReport.get_data_version(data))
+        if data_version != version:
+            return None
+        return job
+
+    @classmethod
+    def pop(cls):
+        """
+        Mark the oldest queued job as running and return its id, or None if
+        no job is queued. The jobs running for more than job_timeout seconds
+        are queued again first.
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        cursor.execute(*table.update(
+            [table.state], ['queued'],
+            where=(table.state == 'running')
+            & (table.started < datetime.datetime.now()
+                - datetime.timedelta(seconds=JOB_TIMEOUT))
+        ))
+        while True:
+            cursor.execute(*table.select(
+                table.id, where=table.state == 'queued',
+                order_by=table.id.asc, limit=1
+            ))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            job_id, = row
+            cursor.execute(*table.update(
+                [table.state, table.started],
+                ['running', datetime.datetime.now()],
+                where=(table.id == job_id) & (table.state == 'queued')
+            ))
+            # Otherwise another worker took the job in the meantime
+            if cursor.rowcount:
+                return job_id
+
+    @classmethod
+    def process(cls, jobs):
+        """
+        Render the reports of the jobs as the users who queued them
+        """
+        pool = Pool()
+        User = pool.get('res.user')
+        SalesReport = pool.get('report.sales', type='report')
+
+        for job in jobs:
+            with Transaction().set_user(job.create_uid.id):
+                context = User.get_preferences(context_only=True)
+            if job.company:
+                context['company'] = job.company.id
+            data = job.get_data()
+            with Transaction().set_user(job.create_uid.id), \
+                    Transaction().set_context(context):
+                # Read before rendering so that later changes are detected,
+                # from the same database as the report
+                with replica_connection(SalesReport.use_replica(data)):
+                    version = SalesReport.get_data_version(data)
+                    oext, content, _, name = SalesReport.execute([], data)
+            cls.write([job], {
+                'state': 'done',
+                'finished': datetime.datetime.now(),
+                'output': bytearray(content),
+                'output_format': oext,
+                'output_name': '%s.%s' % (name, oext),
+                'data_version': cls.dump_data_version(version),
+                'message': None,
+            })
+
+    @classmethod
+    def run_queued(cls):
+        """
+        Render the queued reports, used by the scheduler when the worker
+        pool is disabled or to pick up the jobs left running by a stopped
+        server once they are older than job_timeout seconds
+        """
+        run_queued_jobs(Transaction().database.name)
+
+
+class SalesReportJobStatus(ModelView):
+    "Sales Report Job Status"
+    __name__ = 'report.sales.job.status'
+
+    job = fields.Many2One('report.sales.job', 'Job', readonly=True)
+    state = fields.Selection(STATES, 'State', readonly=True)
+    started = fields.DateTime('Started', readonly=True)
+    finished = fields.DateTime('Finished', readonly=True)
+    message = fields.Text('Message', readonly=True)
+
+
+class SalesReportJobOutput(Report):
+    "Sales Report Job Output"
+    __name__ = 'report.sales.job.output'
+
+    @classmethod
+    def execute(cls, ids, data):
+        """
+        Return the report rendered by the job. The reports of the
+        definitions are returned to the users who may open the sales
+        report and read the same sales as when they were rendered.
+        """
+        pool = Pool()
+        Job = pool.get('report.sales.job')
+        SalesReport = pool.get('report.sales', type='report')
+
+        cls.check_access()
+        job_id = data.get('id') or ids[0]
+        SalesReport.check_access()
+        if Job.get_shared([('id', '=', job_id)]) is not None:
+            with Transaction().set_user(0):
+                return cls.get_output(Job(job_id))
+        return cls.get_output(Job(job_id))
+
+    @classmethod
+    def get_output(cls, job):
+        """
+        Return the result of execute for the output of the job
+        """
+        return (
+            job.output_format, job.output, False,
+            job.output_name.rsplit('.', 1)[0]
+        )
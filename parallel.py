@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+# Number of threads computing the report sections, each in its own read-only
+# transaction. With 0, the sections are computed one after another in the
+# transaction of the report.
+PARALLEL_WORKERS = config.getint(
+    'sales_reports', 'parallel_workers', default=0
+)
+# Number of days of the date range of the report computed by each shard
+PARALLEL_SHARD_DAYS = config.getint(
+    'sales_reports', 'parallel_shard_days', default=31
+)
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+
+
+def get_thread_pool():
+    """
+    Return the thread pool shared by the reports of the server process
+    """
+    global _thread_pool
+    with _thread_pool_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPool(PARALLEL_WORKERS)
+        return _thread_pool
+
+
+def split_dates(start_date, end_date, days):
+    """
+    Return a list of (start date, end date) tuples covering the dates from
+    start_date to end_date, both included, by slices of days
+    """
+    shards = []
+    step = datetime.timedelta(days=days)
+    while start_date <= end_date:
+        shard_end = min(
+            start_date + step - datetime.timedelta(days=1), end_date
+        )
+        shards.append((start_date, shard_end))
+        start_date = shard_end + datetime.timedelta(days=1)
+    return shards
+
+
+def _run_task(args):
+    database_name, user, context, report_name, method, arguments = args
+    with Transaction().start(
+            database_name, user, readonly=True, context=context):
+        Report = Pool().get(report_name, type='report')
+        return getattr(Report, method)(*arguments)
+
+
+class TaskResults(object):
+    """
+    The results of tasks computed in the current transaction
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def get(self):
+        return self.results
+
+
+def run_tasks(report_name, tasks):
+    """
+    Call the (method name, arguments) tasks on the report and return an
+    object whose get method returns their results in order.
+
+    The tasks run on the thread pool when the parallel_workers option is
+    set, otherwise they are run at once in the current transaction. The
+    results must not contain records as the transactions of the workers
+    are closed once the tasks are done.
+    """
+    if not PARALLEL_WORKERS:
+        Report = Pool().get(report_name, type='report')
+        return TaskResults([
+            getattr(Report, method)(*arguments)
+            for method, arguments in tasks
+        ])
+
+    transaction = Transaction()
+    context = dict(transaction.context)
+    return get_thread_pool().map_async(_run_task, [
+        (transaction.database.name, transaction.user, context, report_name,
+            method, arguments)
+        for method, arguments in tasks
+    ], chunksize=1)
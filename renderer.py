@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+import logging
+import threading
+import zipfile
+import subprocess
+from abc import ABCMeta, abstractmethod
+from StringIO import StringIO
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    import weasyprint
+except ImportError:
+    weasyprint = None
+try:
+    from PyPDF2 import PdfFileMerger
+except ImportError:
+    PdfFileMerger = None
+
+from trytond.config import config
+
+logger = logging.getLogger(__name__)
+
+# Engine converting the HTML reports to PDF: wkhtmltopdf or weasyprint
+PDF_BACKEND = config.get('sales_reports', 'pdf_backend', default='wkhtmltopdf')
+# Number of PDF conversions running at once in each server process
+PDF_WORKERS = config.getint('sales_reports', 'pdf_workers', default=4)
+# Number of PDF conversions waiting for a free renderer before new ones are
+# rejected
+PDF_QUEUE_SIZE = config.getint('sales_reports', 'pdf_queue_size', default=16)
+# Number of seconds a PDF conversion waits for a free renderer
+PDF_QUEUE_TIMEOUT = config.getint(
+    'sales_reports', 'pdf_queue_timeout', default=60
+)
+# Number of orders above which the PDF reports are rendered by parts of this
+# number of orders, converted in parallel. With 0, they are rendered at once.
+PDF_CHUNK_ORDERS = config.getint(
+    'sales_reports', 'pdf_chunk_orders', default=0
+)
+# How the parts are delivered: merged into a single PDF, which requires
+# PyPDF2, or as a zip archive
+PDF_CHUNK_OUTPUT = config.get(
+    'sales_reports', 'pdf_chunk_output', default='merge'
+)
+
+# Placeholders of the page number and count in the footer texts
+PAGE_PATTERN = re.compile(r'(\{page\}|\{pages\})')
+
+
+class RendererBusy(Exception):
+    """
+    Raised when no renderer is free to convert a report
+    """
+
+
+class RendererPool(object):
+    """
+    A bounded pool of renderer slots. The conversions exceeding the size of
+    the pool wait in a queue, and are rejected when the queue is full or
+    when they waited more than timeout seconds.
+    """
+
+    def __init__(self, size, queue_size, timeout):
+        self.size = size
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold a renderer slot for the duration of the block
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self):
+        with self._condition:
+            if self._running < self.size:
+                self._running += 1
+                return
+            if self._waiting >= self.queue_size:
+                raise RendererBusy('Too many reports waiting to be rendered')
+            self._waiting += 1
+            try:
+                self._wait()
+            finally:
+                self._waiting -= 1
+            self._running += 1
+
+    def _wait(self):
+        # Condition.wait does not tell if it timed out on Python 2
+        remaining = self.timeout
+        while self._running >= self.size:
+            if remaining <= 0:
+                raise RendererBusy('Timed out waiting for a free renderer')
+            start = time.time()
+            self._condition.wait(remaining)
+            remaining -= time.time() - start
+
+    def release(self):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify()
+
+
+class PDFRenderer(object):
+    """
+    Base class of the engines converting an HTML file to PDF.
+
+    The options are backend independent:
+
+        * page_size: the paper size, e.g. Letter or A4
+        * margin_top, margin_right, margin_bottom, margin_left: the page
+          margins as CSS lengths
+        * footer_left, footer_right: the footer texts in which {page} and
+          {pages} are replaced by the page number and count
+        * footer_font_size: the font size of the footer in points
+        * footer_line: draw a line above the footer
+        * footer_spacing: the space between the footer and the content in
+          millimeters
+    """
+    __metaclass__ = ABCMeta
+    name = None
+
+    @abstractmethod
+    def render(self, file_name, options):
+        """
+        Return the PDF content of the HTML file
+        """
+
+
+class WkhtmltopdfRenderer(PDFRenderer):
+    """
+    Convert the reports by running the wkhtmltopdf command
+    """
+    name = 'wkhtmltopdf'
+
+    def get_arguments(self, options):
+        """
+        Return the command line arguments for the options
+        """
+        def footer(text):
+            return PAGE_PATTERN.sub(
+                lambda m: {'{page}': '[page]', '{pages}': '[toPage]'}[
+                    m.group(0)], text
+            )
+
+        args = ['--page-size', options['page_size']]
+        for side in ('top', 'right', 'bottom', 'left'):
+            args += ['--margin-%s' % side, options['margin_%s' % side]]
+        if options.get('footer_left'):
+            args += ['--footer-left', footer(options['footer_left'])]
+        if options.get('footer_right'):
+            args += ['--footer-right', footer(options['footer_right'])]
+        if options.get('footer_font_size'):
+            args += ['--footer-font-size', str(options['footer_font_size'])]
+        if options.get('footer_line'):
+            args.append('--footer-line')
+        if options.get('footer_spacing'):
+            args += ['--footer-spacing', str(options['footer_spacing'])]
+        return [
+            a.encode('utf-8') if isinstance(a, unicode) else a for a in args
+        ]
+
+    def render(self, file_name, options):
+        output_name = file_name + '.pdf'
+        process = subprocess.Popen(
+            ['wkhtmltopdf'] + self.get_arguments(options) + [
+                file_name, output_name],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        _, error = process.communicate()
+        try:
+            # wkhtmltopdf exits with an error on some missing resources even
+            # though the document is converted
+            try:
+                with open(output_name, 'rb') as pdf_file:
+                    content = pdf_file.read()
+            except IOError:
+                content = None
+            if not content:
+                raise RuntimeError(
+                    'wkhtmltopdf failed with status %s: %s'
+                    % (process.returncode, error)
+                )
+            if process.returncode:
+                logger.warning(
+                    'wkhtmltopdf exited with status %s: %s',
+                    process.returncode, error
+                )
+            return content
+        finally:
+            try:
+                os.remove(output_name)
+            except OSError:
+                pass
+
+
+class WeasyPrintRenderer(PDFRenderer):
+    """
+    Convert the reports in process with WeasyPrint. The fonts are loaded
+    once per server process instead of once per report.
+    """
+    name = 'weasyprint'
+
+    def __init__(self):
+        self._stylesheets = {}
+
+    @staticmethod
+    def _css_string(text):
+        return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\A ')
+
+    def get_footer_content(self, text):
+        """
+        Return the CSS content value of the footer text
+        """
+        content = []
+        for part in PAGE_PATTERN.split(text):
+            if part == '{page}':
+                content.append('counter(page)')
+            elif part == '{pages}':
+                content.append('counter(pages)')
+            elif part:
+                content.append(self._css_string(part))
+        return ' '.join(content)
+
+    def get_stylesheet(self, options):
+        """
+        Return the CSS page rules for the options
+        """
+        box = []
+        if options.get('footer_font_size'):
+            box.append('font-size: %spt;' % options['footer_font_size'])
+        if options.get('footer_line'):
+            box.append('border-top: 1px solid black;')
+        if options.get('footer_spacing'):
+            box.append('margin-top: %smm;' % options['footer_spacing'])
+        box.append('vertical-align: top;')
+
+        rules = [
+            'size: %s;' % options['page_size'],
+            'margin: %s %s %s %s;' % (
+                options['margin_top'], options['margin_right'],
+                options['margin_bottom'], options['margin_left']),
+        ]
+        for position in ('left', 'right'):
+            text = options.get('footer_%s' % position)
+            if not text:
+                continue
+            rules.append('@bottom-%s { content: %s; %s }' % (
+                position, self.get_footer_content(text), ' '.join(box)
+            ))
+        return '@page { %s }' % ' '.join(rules)
+
+    def render(self, file_name, options):
+        if weasyprint is None:
+            raise RuntimeError('WeasyPrint is not installed')
+        key = tuple(sorted(options.items()))
+        stylesheet = self._stylesheets.get(key)
+        if stylesheet is None:
+            stylesheet = weasyprint.CSS(string=self.get_stylesheet(options))
+            # Only the latest footers are kept as they include the company
+            self._stylesheets = {key: stylesheet}
+        return weasyprint.HTML(filename=file_name).write_pdf(
+            stylesheets=[stylesheet]
+        )
+
+
+RENDERERS = {
+    WkhtmltopdfRenderer.name: WkhtmltopdfRenderer(),
+    WeasyPrintRenderer.name: WeasyPrintRenderer(),
+}
+
+RENDERER_POOL = RendererPool(PDF_WORKERS, PDF_QUEUE_SIZE, PDF_QUEUE_TIMEOUT)
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+
+
+def get_thread_pool():
+    """
+    Return the thread pool converting the parts of the reports
+    """
+    global _thread_pool
+    with _thread_pool_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPool(PDF_WORKERS)
+        return _thread_pool
+
+
+def render_pdf(file_name, options, backend=None):
+    """
+    Convert the HTML file to PDF with the backend, or the configured one,
+    once a renderer of the pool is free
+    """
+    renderer = RENDERERS[backend or PDF_BACKEND]
+    with RENDERER_POOL.slot():
+        return renderer.render(file_name, options)
+
+
+def render_pdf_async(file_name, options, backend=None):
+    """
+    Start converting the HTML file to PDF on the thread pool and return an
+    AsyncResult whose get method returns the PDF content
+    """
+    return get_thread_pool().apply_async(
+        render_pdf, (file_name, options, backend)
+    )
+
+
+def can_merge_pdf():
+    """
+    Return True if the PDF documents can be merged
+    """
+    return PdfFileMerger is not None
+
+
+def merge_pdf(contents):
+    """
+    Return a single PDF document made of the pages of the PDF contents
+    """
+    merger = PdfFileMerger()
+    for content in contents:
+        merger.append(StringIO(content))
+    output = StringIO()
+    merger.write(output)
+    merger.close()
+    return output.getvalue()
+
+
+def zip_files(files):
+    """
+    Return a zip archive of the (name, content) files
+    """
+    output = StringIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files:
+            archive.writestr(name, content)
+    return output.getvalue()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import urllib
+import logging
+import threading
+from contextlib import contextmanager
+
+from trytond import backend
+from trytond.config import config, parse_uri
+from trytond.transaction import Transaction
+
+__all__ = ['replica_connection', 'get_replica_lag']
+
+logger = logging.getLogger(__name__)
+
+# Name of the database replicating the database of the server. The queries
+# of the reports are run on it when set.
+REPLICA_DATABASE = config.get(
+    'sales_reports', 'replica_database', default=None
+)
+# URI of the PostgreSQL server of the replica, by default the server of the
+# database section
+REPLICA_URI = config.get('sales_reports', 'replica_uri', default=None)
+# Number of seconds the replica may lag behind before the reports fall back
+# to the database of the transaction
+REPLICA_MAX_LAG = config.getint(
+    'sales_reports', 'replica_max_lag', default=60
+)
+
+_databases = {}
+_databases_lock = threading.Lock()
+_local = threading.local()
+
+
+def _replica_database_class():
+    """
+    Return the PostgreSQL Database class connecting to REPLICA_URI
+    """
+    Database = backend.get('Database')
+
+    class ReplicaDatabase(Database):
+        _databases = {}
+        _connpool = None
+
+        @classmethod
+        def dsn(cls, name):
+            uri = parse_uri(REPLICA_URI)
+            assert uri.scheme == 'postgresql'
+            params = ['dbname=%s' % name]
+            if uri.hostname:
+                params.append('host=%s' % uri.hostname)
+            if uri.port:
+                params.append('port=%s' % uri.port)
+            if uri.username:
+                params.append('user=%s' % uri.username)
+            if uri.password:
+                params.append(
+                    'password=%s' % urllib.unquote_plus(uri.password)
+                )
+            return ' '.join(params)
+    return ReplicaDatabase
+
+
+def get_replica_database(name):
+    """
+    Return the connected Database of the replica named name
+    """
+    if backend.name() != 'postgresql':
+        # The connections of the other backends can not be shared by the
+        # threads
+        return backend.get('Database')(name).connect()
+    with _databases_lock:
+        database = _databases.get(name)
+        if database is None:
+            if REPLICA_URI:
+                database = _replica_database_class()(name)
+            else:
+                database = backend.get('Database')(name)
+            database = _databases[name] = database.connect()
+    return database
+
+
+def get_replica_lag(connection):
+    """
+    Return the number of seconds the replica of the connection lags behind
+    the primary database, 0 if it is not a standby server or None if it is
+    unknown
+    """
+    if backend.name() != 'postgresql':
+        return 0
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT CASE WHEN pg_is_in_recovery() '
+        'THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) '
+        'ELSE 0 END'
+    )
+    lag, = cursor.fetchone()
+    return lag
+
+
+@contextmanager
+def replica_connection(enabled=True, max_lag=None):
+    """
+    Run the queries of the transaction on a read-only connection to the
+    replica_database for the duration of the block, and yield True.
+
+    The queries stay on the connection of the transaction, and False is
+    yielded, unless enabled is set and the replica is configured, reachable
+    and lags less than max_lag seconds, by default replica_max_lag. The
+    records read from the replica are removed from the transaction cache
+    at the end of the block. The blocks nested in a block on the replica
+    stay on it.
+    """
+    if not enabled or not REPLICA_DATABASE:
+        yield False
+        return
+    if getattr(_local, 'connection', None) is Transaction().connection:
+        yield True
+        return
+    if max_lag is None:
+        max_lag = REPLICA_MAX_LAG
+
+    transaction = Transaction()
+    try:
+        database = get_replica_database(REPLICA_DATABASE)
+        connection = database.get_connection(readonly=True)
+    except Exception:
+        logger.warning(
+            'Unable to connect to the replica %s', REPLICA_DATABASE,
+            exc_info=True
+        )
+        yield False
+        return
+    if connection is transaction.connection:
+        # The replica is the database of the transaction
+        yield True
+        return
+
+    try:
+        try:
+            lag = get_replica_lag(connection)
+        except Exception:
+            logger.warning(
+                'Unable to get the lag of the replica %s', REPLICA_DATABASE,
+                exc_info=True
+            )
+            lag = None
+        if lag is None or lag > max_lag:
+            logger.warning(
+                'The replica %s lags behind by %s seconds',
+                REPLICA_DATABASE, lag
+            )
+            yield False
+            return
+
+        primary = transaction.connection
+        transaction.connection = _local.connection = connection
+        try:
+            yield True
+        finally:
+            transaction.connection = primary
+            _local.connection = None
+            transaction.cache.clear()
+    finally:
+        connection.rollback()
+        database.put_connection(connection)
@@ -1,192 +1,2449 @@
 # -*- coding: utf-8 -*-
-from itertools import groupby
+import os
+import re
+import json
+import time
+import hashlib
+import datetime
+import logging
+import tempfile
+from itertools import islice
 from decimal import Decimal
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
+from sql import Literal, Null
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Coalesce, Greatest
+
+from trytond import backend
+from trytond.cache import Cache, freeze
+from trytond.config import config
 from trytond.pool import Pool
+from trytond.protocols.jsonrpc import JSONEncoder
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.model import fields, ModelView
 from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateAction, StateView, Button
 from trytond.exceptions import UserError
+from trytond.pyson import Eval
+
+from openlabs_report_webkit import ReportWebkit
+
+from .renderer import render_pdf, render_pdf_async, can_merge_pdf, \
+    merge_pdf, zip_files, RendererBusy, PDF_CHUNK_ORDERS, PDF_CHUNK_OUTPUT
+from .instrument import profile, phase, current_profile
+from .export import EXPORT_FORMATS, Sheet, can_export, export_sheets
+from .template import create_environment, from_string, load_template
+from .singleflight import SINGLE_FLIGHT_DIR, SingleFlight, dump_reports, \
+    load_reports
+from .replica import replica_connection
+from .parallel import PARALLEL_WORKERS, PARALLEL_SHARD_DAYS, split_dates, \
+    run_tasks
+
+__all__ = ['SalesReport', 'SalesReportWizardStart', 'SalesReportWizard']
+
+logger = logging.getLogger(__name__)
+
+# Number of orders above which the report is rendered in streaming mode
+STREAM_THRESHOLD = config.getint(
+    'sales_reports', 'stream_threshold', default=5000
+)
+# Number of sales fetched at once in streaming mode
+STREAM_BATCH_SIZE = config.getint(
+    'sales_reports', 'stream_batch_size', default=1000
+)
+# Answer the totals and top products from the daily sales summary
+USE_SUMMARY = config.getboolean('sales_reports', 'use_summary', default=True)
+# Number of rendered reports kept in cache
+CACHE_SIZE = config.getint('sales_reports', 'cache_size', default=32)
+# Number of seconds a rendered report is kept in cache
+CACHE_DURATION = config.getint('sales_reports', 'cache_duration', default=3600)
+# Rendered reports larger than this number of bytes are not cached
+CACHE_MAX_BYTES = config.getint(
+    'sales_reports', 'cache_max_bytes', default=10 * 1024 * 1024
+)
+# Number of orders listed by the HTML preview of the report
+PREVIEW_ORDERS = config.getint('sales_reports', 'preview_orders', default=100)
+# Number of products listed in the top products section
+TOP_PRODUCTS = config.getint('sales_reports', 'top_products', default=10)
+# Estimated number of orders above which the wizard queues the report to be
+# rendered in background, 0 for no limit
+ADMISSION_BACKGROUND_ORDERS = config.getint(
+    'sales_reports', 'admission_background_orders', default=50000
+)
+# Estimated number of orders above which the report is refused, 0 for no
+# limit
+ADMISSION_MAX_ORDERS = config.getint(
+    'sales_reports', 'admission_max_orders', default=1000000
+)
+# Number of seconds the number of orders estimated for the filters of a
+# report is reused, so that the wizard and the report estimate it once
+ESTIMATE_DURATION = config.getint(
+    'sales_reports', 'estimate_duration', default=60
+)
+# Number of orders rendered per second, used to estimate the duration of a
+# report
+ADMISSION_ORDERS_PER_SECOND = config.getint(
+    'sales_reports', 'admission_orders_per_second', default=1000
+)
+# Matches the estimated number of rows of a PostgreSQL plan line
+PLAN_ROWS = re.compile(r' rows=(\d+) ')
+# Run EXPLAIN on the queries of each report and warn about sequential scans
+CHECK_PLANS = config.getboolean('sales_reports', 'check_plans', default=False)
+
+# The large tables which must not be scanned sequentially by the report
+PLAN_TABLES = [
+    'sale_sale', 'sale_line', 'sale_payment', 'payment_gateway_transaction',
+]
+# Matches the tables scanned sequentially in a plan line
+SEQUENTIAL_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.* USING )'),
+}
+
+
+class ReportCache(Cache):
+    """
+    A Cache whose entries expire duration seconds after being set.
+    """
+
+    def __init__(self, name, size_limit=1024, duration=None, context=True):
+        super(ReportCache, self).__init__(
+            name, size_limit=size_limit, context=context
+        )
+        self.duration = duration
+
+    def get(self, key, default=None):
+        result = super(ReportCache, self).get(key)
+        if result is None:
+            return default
+        expire, value = result
+        if expire is not None and expire < time.time():
+            return default
+        return value
+
+    def set(self, key, value):
+        expire = None
+        if self.duration is not None:
+            expire = time.time() + self.duration
+        super(ReportCache, self).set(key, (expire, value))
+        return value
+
+
+class HTMLFile(object):
+    """
+    Rendered HTML written to a temporary file instead of being held in
+    memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """
+        Return the content of the file and remove it
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(self.path)
+
+
+class HTMLChunks(list):
+    """
+    Rendered HTML of a report split in parts, as a list of HTMLFile. The
+    parts are converted separately and delivered merged or as a zip
+    archive depending on output.
+    """
+
+    def __init__(self, output=PDF_CHUNK_OUTPUT):
+        super(HTMLChunks, self).__init__()
+        self.output = output
+
+    def remove_files(self):
+        """
+        Remove the files of the parts left
+        """
+        for html_file in self:
+            try:
+                os.remove(html_file.path)
+            except OSError:
+                pass
+
+
+class TopProduct(namedtuple('TopProduct', [
+        'product', 'quantity', 'revenues'])):
+    """
+    A product of the top products section with the quantity sold in every
+    currency and the untaxed revenue in each currency as a list of
+    (currency, revenue) tuples
+    """
+    __slots__ = ()
+
+
+class SaleAmounts(namedtuple('SaleAmounts', [
+        'currency', 'untaxed', 'tax', 'total'])):
+    """
+    The currency id and the untaxed, tax and total amounts of a sale
+    computed from its lines.
+    """
+    __slots__ = ()
+
+
+class SaleRow(namedtuple('SaleRow', [
+        'id', 'number', 'sale_date', 'party_name', 'currency_code',
+        'untaxed_amount', 'tax_amount', 'total_amount', 'payment_available',
+        'state'])):
+    """
+    Read-only projection of the sale attributes displayed in the orders
+    table of the report.
+    """
+    __slots__ = ()
+
+    @property
+    def __url__(self):
+        return '%s/%d' % (Pool().get('sale.sale').__url__, self.id)
+
+
+class SaleStream(object):
+    """
+    Iterable over the rows of the sales selected by a query, most recent
+    first.
+
+    The rows are fetched by the report in batches of batch_size, so that
+    only one batch is loaded at a time.
+    """
+
+    def __init__(self, report, sale_query, batch_size=STREAM_BATCH_SIZE):
+        self.report = report
+        self.sale_query = sale_query
+        self.batch_size = batch_size
+        self._count = None
+
+    def __len__(self):
+        if self._count is None:
+            Sale = Pool().get('sale.sale')
+
+            cursor = Transaction().connection.cursor()
+            sale = Sale.__table__()
+            cursor.execute(*sale.select(
+                Count(Literal(1)), where=sale.id.in_(self.sale_query)
+            ))
+            self._count, = cursor.fetchone()
+        return self._count
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        return self.report.iter_sale_rows(self.sale_query, self.batch_size)
+
+
+class ReportMixin(ReportWebkit):
+    """
+    Mixin Class to inherit from, for all HTML reports.
+    """
+    _environments = {}
+
+    @classmethod
+    def execute(cls, ids, data):
+        """
+        Render the report, recording the duration, queries and rows of its
+        phases when instrumented
+        """
+        with profile(cls.__name__, data):
+            return super(ReportMixin, cls).execute(ids, data)
+
+    @classmethod
+    def render(cls, report, report_context):
+        with phase('render'):
+            return super(ReportMixin, cls).render(report, report_context)
+
+    @classmethod
+    def jinja_loader_func(cls, name):
+        """
+        Return the template from the module directories, reloaded when the
+        modification time of its file changes
+        """
+        return load_template(name)
+
+    @classmethod
+    def get_environment(cls):
+        """
+        Return the jinja environment of the report for the language of the
+        transaction.
+
+        The environments are created once per process and share the
+        templates compiled by the process.
+        """
+        key = (cls.__name__, Transaction().language)
+        env = cls._environments.get(key)
+        if env is None:
+            env = create_environment(cls.jinja_loader_func)
+            env.filters.update(cls.get_jinja_filters())
+            cls._environments[key] = env
+        return env
+
+    @classmethod
+    def get_report_template(cls, env, template_string, report=None):
+        """
+        Return the compiled template of the report. It is loaded from the
+        report file unless the report has a custom content.
+        """
+        if (report is not None and report.report
+                and not report.report_content_custom):
+            return env.get_template(report.report)
+        return from_string(env, template_string)
+
+    @classmethod
+    def render_template(cls, template_string, localcontext, translator):
+        """
+        Render the template using Jinja2.
+
+        If stream_html is set in the context, the template is rendered
+        incrementally into a temporary file and an HTMLFile is returned.
+        """
+        env = cls.get_environment()
+
+        # Update header and footer in context
+        company = localcontext['company']
+        localcontext.update({
+            'header': from_string(env, company.header_html or ''),
+            'footer': from_string(env, company.footer_html or ''),
+        })
+        report_template = cls.get_report_template(
+            env, template_string, localcontext.get('report')
+        )
+        if not localcontext.get('stream_html'):
+            return report_template.render(**localcontext).encode('utf-8')
+
+        with tempfile.NamedTemporaryFile(
+                suffix='.html', prefix='trytond_', delete=False
+        ) as html_file:
+            for chunk in report_template.generate(**localcontext):
+                html_file.write(chunk.encode('utf-8'))
+        return HTMLFile(html_file.name)
+
+    @classmethod
+    def convert(cls, report, data):
+        """
+        Convert the rendered report to PDF with the configured backend
+        """
+        output_format = report.extension or report.template_extension
+        if isinstance(data, HTMLChunks):
+            return cls.convert_chunks(report, data)
+        if Pool.test or output_format != "pdf":
+            if isinstance(data, HTMLFile):
+                data = data.read()
+            return super(ReportMixin, cls).convert(report, data)
+
+        with phase('convert'):
+            if not isinstance(data, HTMLFile):
+                return output_format, cls.html_to_pdf(data)
+            try:
+                return output_format, cls.html_file_to_pdf(data.path)
+            finally:
+                os.remove(data.path)
+
+    @classmethod
+    def html_file_to_pdf(cls, file_name, options=None):
+        """
+        Convert the html file to pdf once a renderer is free
+        """
+        if options is None:
+            options = cls.get_pdf_options()
+        try:
+            return render_pdf(file_name, options)
+        except RendererBusy:
+            cls.raise_renderer_busy()
+
+    @classmethod
+    def raise_renderer_busy(cls):
+        raise UserError(
+            "Too many reports are being rendered, please try again "
+            "in a few minutes."
+        )
+
+    @classmethod
+    def convert_chunks(cls, report, chunks):
+        """
+        Convert the parts of the report to PDF in parallel and return them
+        merged in a single PDF, or as a zip archive if requested. The parts
+        are zipped without conversion when the output format is not PDF.
+        """
+        output_format = report.extension or report.template_extension
+        name = re.sub(r'\W+', '_', report.name or 'report').lower()
+
+        def part_name(number, extension):
+            return '%s-%03d.%s' % (name, number, extension)
+
+        try:
+            if (output_format == 'pdf' and chunks.output == 'merge'
+                    and not can_merge_pdf()):
+                raise UserError(
+                    "The parts of the report can not be merged because "
+                    "PyPDF2 is not installed, please deliver them as a zip "
+                    "archive."
+                )
+            if Pool.test or output_format != "pdf":
+                return 'zip', zip_files([
+                    (part_name(number, output_format), chunk.read())
+                    for number, chunk in enumerate(chunks, 1)
+                ])
+
+            with phase('convert'):
+                options = cls.get_pdf_options()
+                results = [
+                    render_pdf_async(chunk.path, cls.get_chunk_pdf_options(
+                        options, number, len(chunks)))
+                    for number, chunk in enumerate(chunks, 1)
+                ]
+                # The files are removed once every conversion is done
+                for result in results:
+                    result.wait()
+                try:
+                    contents = [result.get() for result in results]
+                except RendererBusy:
+                    cls.raise_renderer_busy()
+
+                if chunks.output == 'merge':
+                    return output_format, merge_pdf(contents)
+                return 'zip', zip_files([
+                    (part_name(number, output_format), content)
+                    for number, content in enumerate(contents, 1)
+                ])
+        finally:
+            chunks.remove_files()
+
+    @classmethod
+    def html_to_pdf(cls, data, options=None):
+        """
+        Convert the html to pdf once a renderer is free
+        """
+        with tempfile.NamedTemporaryFile(
+                suffix='.html', prefix='trytond_', delete=False
+        ) as html_file:
+            html_file.write(
+                data.encode('utf-8') if isinstance(data, unicode) else data
+            )
+        try:
+            return cls.html_file_to_pdf(html_file.name, options)
+        finally:
+            os.remove(html_file.name)
+
+    @classmethod
+    def wkhtml_to_pdf(cls, data, options=None):
+        """
+        Convert the html to pdf with the configured backend
+        """
+        return cls.html_to_pdf(data, options)
+
+    @classmethod
+    def get_pdf_options(cls):
+        """
+        Return the page and footer options passed to the PDF backend
+        """
+        Company = Pool().get('company.company')
+
+        company = ''
+        if Transaction().context.get('company'):
+            company = Company(Transaction().context.get(
+                'company')).party.name
+        return {
+            'margin_bottom': '0.50in',
+            'margin_left': '0.50in',
+            'margin_right': '0.50in',
+            'margin_top': '0.50in',
+            'footer_font_size': 8,
+            'footer_left': company,
+            'footer_line': True,
+            'footer_right': '{page}/{pages}',
+            'footer_spacing': 5,
+            'page_size': 'Letter',
+        }
+
+    @classmethod
+    def get_chunk_pdf_options(cls, options, number, count):
+        """
+        Return the PDF options of the part number of count parts, whose
+        footer shows the part as its pages are numbered separately
+        """
+        options = dict(options)
+        part = 'Part %s of %s' % (number, count)
+        if options.get('footer_right'):
+            part += ' - ' + options['footer_right']
+        options['footer_right'] = part
+        return options
+
+
+class SalesReport(ReportMixin):
+    "Sales Report"
+    __name__ = 'report.sales'
+
+    _report_cache = ReportCache(
+        'report.sales.execute', size_limit=CACHE_SIZE,
+        duration=CACHE_DURATION
+    )
+    _estimate_cache = ReportCache(
+        'report.sales.estimate_orders', context=False,
+        duration=ESTIMATE_DURATION
+    )
+    # The identical reports requested at the same time are rendered once
+    _single_flight = SingleFlight(SINGLE_FLIGHT_DIR)
+    _batch_single_flight = SingleFlight(
+        SINGLE_FLIGHT_DIR, dump=dump_reports, load=load_reports
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(SalesReport, cls).__setup__()
+        cls.__rpc__['execute_batch'] = RPC()
+
+    @classmethod
+    def execute(cls, ids, data):
+        """
+        Return the report from the cache if it has been rendered for the
+        same data since the last change of the matching sales and payments.
+
+        Otherwise the identical requests received while the report is
+        rendered wait for it and share its result.
+
+        The report is read from the replica database when use_replica.
+        """
+        cls.check_access()
+
+        with replica_connection(cls.use_replica(data)):
+            key = cls.get_cache_key(data)
+            result = cls._report_cache.get(key)
+            if result is not None:
+                return result
+
+            def render():
+                # The previews list at most preview_orders orders
+                if data.get('output_format') == 'preview':
+                    result = cls.preview(data)
+                elif data.get('output_format') in EXPORT_FORMATS:
+                    cls.get_admission(data)
+                    result = cls.export(data)
+                else:
+                    cls.get_admission(data)
+                    result = super(SalesReport, cls).execute(ids, data)
+                if len(result[1]) <= CACHE_MAX_BYTES:
+                    cls._report_cache.set(key, result)
+                return result
+            return cls._single_flight.do(
+                cls.get_flight_key(data, key[1]), render
+            )
+
+    @classmethod
+    def estimate_orders(cls, data):
+        """
+        Return an estimate of the number of orders matching data, read from
+        the plan of the search with PostgreSQL and counted otherwise.
+
+        The estimate is kept estimate_duration seconds for the user, so
+        that the orders counted by the wizard are not counted again by the
+        report.
+        """
+        Sale = Pool().get('sale.sale')
+
+        transaction = Transaction()
+        key = (transaction.user, transaction.context.get('company')) + tuple(
+            data.get(name) for name in [
+                'start_date', 'end_date', 'channel', 'customer', 'product']
+        )
+        orders = cls._estimate_cache.get(key)
+        if orders is not None:
+            return orders
+
+        sale = Sale.__table__()
+        sale_query = Sale.search(
+            cls.get_sale_domain(data), order=[], query=True
+        )
+        if backend.name() == 'postgresql':
+            plan = cls.explain(sale.select(
+                sale.id, where=sale.id.in_(sale_query)
+            ))
+            match = PLAN_ROWS.search(plan[0]) if plan else None
+            if match:
+                return cls._estimate_cache.set(key, int(match.group(1)))
+        cursor = transaction.connection.cursor()
+        cursor.execute(*sale.select(
+            Count(Literal(1)), where=sale.id.in_(sale_query)
+        ))
+        return cls._estimate_cache.set(key, cursor.fetchone()[0])
+
+    @classmethod
+    def estimate_duration(cls, orders):
+        """
+        Return the expected duration of the report of orders as a timedelta
+        """
+        return datetime.timedelta(
+            seconds=orders // max(ADMISSION_ORDERS_PER_SECOND, 1)
+        )
+
+    @classmethod
+    def get_admission(cls, data, orders=None):
+        """
+        Return how the report of data must be rendered from the estimated
+        number of orders: 'background' above the admission_background_orders
+        option of the sales_reports configuration section, otherwise
+        'direct'. A UserError is raised above admission_max_orders.
+
+        The largest reports rendered directly are streamed anyway above
+        stream_threshold orders.
+        """
+        if orders is None:
+            orders = cls.estimate_orders(data)
+        if ADMISSION_MAX_ORDERS and orders > ADMISSION_MAX_ORDERS:
+            raise UserError(
+                "The report would list about %s orders, more than the %s "
+                "allowed. Please narrow the date range or filter by channel, "
+                "customer or product." % (orders, ADMISSION_MAX_ORDERS)
+            )
+        if ADMISSION_BACKGROUND_ORDERS and orders > ADMISSION_BACKGROUND_ORDERS:
+            return 'background'
+        return 'direct'
+
+    @classmethod
+    def use_replica(cls, data):
+        """
+        Return True if the queries of the report may run on the database
+        set by the replica_database option of the sales_reports
+        configuration section, unless replica is unset in data.
+
+        The replica is not used if it lags behind by more than
+        replica_max_lag seconds or can not be reached.
+        """
+        return bool(data.get('replica', True))
+
+    @classmethod
+    def execute_batch(cls, data, filter_sets):
+        """
+        Return the result of execute for each filter set of channel,
+        customer and product applied to data, or None for the filter sets
+        matching no order.
+
+        Like execute, the reports are read from the cache and stored in it,
+        the batch is refused above admission_max_orders orders in total,
+        and the identical batches requested at the same time are rendered
+        once. The sales of the filter sets missing from the cache are
+        searched and aggregated once by render_batch.
+        """
+        cls.check_access()
+        output_format = data.get('output_format')
+        if output_format in EXPORT_FORMATS:
+            cls.check_export(output_format)
+
+        datas = cls.get_batch_datas(data, filter_sets)
+        with replica_connection(cls.use_replica(data)):
+            keys = [cls.get_cache_key(d) for d in datas]
+            results = [cls._report_cache.get(key) for key in keys]
+            # The filter sets matching no order are searched again
+            missing = [i for i, result in enumerate(results) if result is None]
+            if not missing:
+                return results
+
+            def render():
+                cls.get_admission(data, sum(
+                    cls.estimate_orders(datas[i]) for i in missing
+                ))
+                rendered = cls.render_batch(
+                    data, [filter_sets[i] for i in missing]
+                )
+                for i, result in zip(missing, rendered):
+                    if (result is not None
+                            and len(result[1]) <= CACHE_MAX_BYTES):
+                        cls._report_cache.set(keys[i], result)
+                return rendered
+            rendered = cls._batch_single_flight.do(cls.get_flight_key(
+                [datas[i] for i in missing], [keys[i][1] for i in missing]
+            ), render)
+        for i, result in zip(missing, rendered):
+            results[i] = result
+        return results
+
+    @classmethod
+    def render_batch(cls, data, filter_sets):
+        """
+        Return the result of execute for each filter set applied to data,
+        or None for the filter sets matching no order, rendered from the
+        contexts of get_batch_contexts
+        """
+        ActionReport = Pool().get('ir.action.report')
+
+        output_format = data.get('output_format')
+        action_report, = ActionReport.search([
+            ('report_name', '=', cls.__name__),
+        ], limit=1)
+
+        results = []
+        with profile(cls.__name__, data):
+            for report_context in cls.get_batch_contexts(data, filter_sets):
+                if report_context is None:
+                    results.append(None)
+                    continue
+                if output_format in EXPORT_FORMATS:
+                    with phase('export'):
+                        oext, content = output_format, export_sheets(
+                            output_format,
+                            cls.get_export_sheets(report_context)
+                        )
+                else:
+                    oext, content = cls.convert(
+                        action_report,
+                        cls.render(action_report, report_context)
+                    )
+                results.append((
+                    oext, bytearray(content), action_report.direct_print,
+                    action_report.name
+                ))
+        return results
+
+    @staticmethod
+    def get_batch_datas(data, filter_sets):
+        """
+        Return the report data of each filter set applied to data
+        """
+        return [dict(data, **{
+            'customer': f.get('customer'),
+            'product': f.get('product'),
+            'channel': f.get('channel'),
+        }) for f in filter_sets]
+
+    @classmethod
+    def get_batch_contexts(cls, data, filter_sets):
+        """
+        Return the report context of each filter set applied to data, or
+        None if it matches no order.
+
+        The sales matching any filter set are read with a single query per
+        kind of rows: the orders, their channel, party and currency, their
+        payments and their product lines. The sections of each filter set
+        are then summed from the amounts of its sales.
+
+        The orders are streamed once. Only the orders of the reports which
+        are neither streamed nor rendered by parts are kept, the others are
+        read again from their own search when rendered, as by execute.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Currency = pool.get('currency.currency')
+
+        datas = cls.get_batch_datas(data, filter_sets)
+        if not datas:
+            return []
+
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+
+        with phase('search'):
+            sale_query = Sale.search(
+                ['OR'] + [cls.get_sale_domain(d) for d in datas],
+                order=[], query=True
+            )
+            cursor.execute(*sale.select(
+                sale.id, sale.channel, sale.party, sale.currency,
+                where=sale.id.in_(sale_query)
+            ))
+            keys = dict((r[0], r[1:]) for r in cursor.fetchall())
+
+        with phase('top_products'):
+            cursor.execute(*line.select(
+                line.sale, line.product, Sum(line.quantity),
+                Sum(line.quantity * line.unit_price),
+                where=line.sale.in_(sale_query) & (line.product != Null),
+                group_by=[line.sale, line.product],
+            ))
+            lines = defaultdict(list)
+            for sale_id, product_id, quantity, revenue in cursor.fetchall():
+                lines[sale_id].append(
+                    (product_id, quantity, cls._to_decimal(revenue))
+                )
+
+        def matches(data, sale_id):
+            channel_id = data.get('channel')
+            customer_id = data.get('customer')
+            product_id = data.get('product')
+            return (
+                (not channel_id or keys[sale_id][0] == channel_id)
+                and (not customer_id or keys[sale_id][1] == customer_id)
+                and (not product_id or any(
+                        l[0] == product_id for l in lines[sale_id])))
+
+        sale_ids = [
+            [sale_id for sale_id in keys if matches(d, sale_id)]
+            for d in datas
+        ]
+        modes = [
+            (cls.use_streaming(d, len(ids)),
+                cls.get_chunk_orders(d, len(ids)))
+            for d, ids in zip(datas, sale_ids)
+        ]
+        listed = [
+            [] if ids and not streaming and not chunk_orders else None
+            for ids, (streaming, chunk_orders) in zip(sale_ids, modes)
+        ]
+
+        amounts = {}
+        with phase('orders'):
+            for row in cls.iter_sale_rows(sale_query):
+                amounts[row.id] = (
+                    row.untaxed_amount, row.tax_amount, row.total_amount,
+                    row.payment_available,
+                )
+                for d, sales in zip(datas, listed):
+                    if sales is not None and matches(d, row.id):
+                        sales.append(row)
+
+        with phase('payments'):
+            gateways, _, _, pbsg = cls.get_payments(sale_query)
+
+        currencies = dict((c.id, c) for c in Currency.browse(
+            list(set(k[2] for k in keys.itervalues()))
+        ))
+        gateways = dict((g.id, g) for g in gateways)
+
+        contexts = []
+        for data, ids, (streaming, chunk_orders), sales in zip(
+                datas, sale_ids, modes, listed):
+            if not ids:
+                contexts.append(None)
+                continue
+            if sales is None:
+                sales = SaleStream(cls, Sale.search(
+                    cls.get_sale_domain(data), order=[], query=True
+                ))
+            sections = cls.sum_batch_sections(
+                data, ids, keys, amounts, pbsg, lines, currencies, gateways
+            )
+            contexts.append(cls.get_sections_context(
+                None, data, sales, len(ids), sections, streaming,
+                chunk_orders
+            ))
+        return contexts
+
+    @classmethod
+    def sum_batch_sections(
+            cls, data, sale_ids, keys, amounts, pbsg, lines, currencies,
+            gateways):
+        """
+        Return the sections like get_sections summed for the sales of
+        sale_ids, with keys the channel, party and currency ids by sale id,
+        amounts the untaxed, tax, total and available payment amounts by
+        sale id, pbsg the payments by sale and gateway id, and lines the
+        product id, quantity and revenue of the lines by sale id
+        """
+        sales_by_currency = defaultdict(
+            lambda: defaultdict(lambda: Decimal('0'))
+        )
+        pbgc = defaultdict(lambda: defaultdict(lambda: Decimal('0')))
+        pbc = defaultdict(lambda: Decimal('0'))
+        products = defaultdict(
+            lambda: [0, defaultdict(lambda: Decimal('0'))]
+        )
+
+        for sale_id in sale_ids:
+            currency_id = keys[sale_id][2]
+            currency = currencies[currency_id]
+            sums = sales_by_currency[currency]
+            untaxed, tax, total, payment_available = amounts[sale_id]
+            sums['untaxed'] += untaxed
+            sums['tax'] += tax
+            sums['total'] += total
+            sums['payment_available'] += payment_available
+            for gateway_id, amount in pbsg.get(sale_id, {}).iteritems():
+                pbgc[gateways[gateway_id]][currency] += amount
+                pbc[currency] += amount
+            for product_id, quantity, revenue in lines[sale_id]:
+                totals = products[product_id]
+                totals[0] += quantity
+                totals[1][currency_id] += revenue
+
+        top_10_products = []
+        if not data.get('product'):
+            if data.get('top_products_by') == 'revenue':
+                def rank(product):
+                    return (-sum(product[1][1].itervalues()), product[0])
+            else:
+                def rank(product):
+                    return (-product[1][0], product[0])
+            ranked = sorted(products.iteritems(), key=rank)[
+                :data.get('top_products') or TOP_PRODUCTS]
+            top_10_products = cls._browse_top_products(
+                (product_id, quantity, revenues.items())
+                for product_id, (quantity, revenues) in ranked
+            )
+        return (
+            sales_by_currency, set(pbgc), pbgc, pbc, pbsg, top_10_products
+        )
+
+    @classmethod
+    def export(cls, data):
+        """
+        Return the orders, totals, payments and top products of the report
+        in the CSV or XLSX output_format of data, like execute but without
+        rendering the template.
+
+        The orders are streamed to the file, so the memory does not grow
+        with their number.
+        """
+        ActionReport = Pool().get('ir.action.report')
+
+        output_format = data['output_format']
+        cls.check_export(output_format)
+        action_report, = ActionReport.search([
+            ('report_name', '=', cls.__name__),
+        ], limit=1)
+
+        with profile(cls.__name__, data):
+            report_context = cls.get_context(
+                None, dict(data, streaming=True, chunk_orders=0)
+            )
+            with phase('export'):
+                content = export_sheets(
+                    output_format, cls.get_export_sheets(report_context)
+                )
+        return (
+            output_format, bytearray(content), False, action_report.name
+        )
+
+    @classmethod
+    def preview(cls, data):
+        """
+        Return the report rendered as HTML, like execute but without the
+        conversion to PDF. The totals, payments and top products are
+        complete but only the first preview_orders orders are listed.
+        """
+        ActionReport = Pool().get('ir.action.report')
+
+        action_report, = ActionReport.search([
+            ('report_name', '=', cls.__name__),
+        ], limit=1)
+
+        with profile(cls.__name__, data):
+            report_context = cls.get_context(None, dict(
+                data, streaming=False, chunk_orders=0,
+                preview_orders=data.get('preview_orders') or PREVIEW_ORDERS
+            ))
+            content = cls.render(action_report, report_context)
+        return 'html', bytearray(content), False, action_report.name
+
+    @classmethod
+    def check_export(cls, output_format):
+        """
+        Raise a UserError if the data can not be exported in output_format
+        """
+        if not can_export(output_format):
+            raise UserError(
+                "The report can not be exported in %s." % output_format
+            )
+
+    @classmethod
+    def get_export_sheets(cls, report_context):
+        """
+        Return the list of Sheet of the orders, the totals per currency,
+        the payments and the top products of the report context
+        """
+        gateways = sorted(report_context['gateways'], key=lambda g: g.name)
+        detailed_payments = report_context['detailed_payments']
+        pbsg = report_context['pbsg']
+
+        header = [
+            'Order #', 'Date', 'Customer', 'Currency', 'Untaxed', 'Tax',
+            'Total', 'Payment Available',
+        ]
+        if detailed_payments:
+            header += [gateway.name for gateway in gateways]
+        header.append('Current Status')
+
+        def orders():
+            for sale in report_context['sales']:
+                row = [
+                    sale.number, sale.sale_date, sale.party_name,
+                    sale.currency_code, sale.untaxed_amount, sale.tax_amount,
+                    sale.total_amount, sale.payment_available,
+                ]
+                if detailed_payments:
+                    payments = pbsg.get(sale.id, {})
+                    row += [
+                        payments.get(gateway.id, Decimal('0'))
+                        for gateway in gateways
+                    ]
+                row.append(sale.state.capitalize())
+                yield row
+
+        sales_by_currency = report_context['sales_by_currency']
+        # The amounts summed by SQLite are floats
+        totals = [
+            [currency.code] + [
+                currency.round(amounts[name]) for name in (
+                    'untaxed', 'tax', 'total', 'payment_available')
+            ] for currency, amounts in sorted(
+                sales_by_currency.iteritems(), key=lambda c: c[0].code)
+        ]
+
+        payments = [
+            [gateway.name, currency.code, currency.round(amount)]
+            for gateway in gateways
+            for currency, amount in sorted(
+                report_context['pbgc'][gateway].iteritems(),
+                key=lambda c: c[0].code)
+        ] + [
+            ['Total', currency.code, currency.round(amount)]
+            for currency, amount in sorted(
+                report_context['pbc'].iteritems(), key=lambda c: c[0].code)
+        ]
+
+        sheets = [
+            Sheet('Orders', header, orders()),
+            Sheet('Totals', [
+                'Currency', 'Untaxed', 'Tax', 'Total', 'Payment Available',
+            ], totals),
+            Sheet('Payments', ['Gateway', 'Currency', 'Amount'], payments),
+        ]
+        if not report_context['product']:
+            # One row per currency of each product, with the quantity sold
+            # in every currency on the first one
+            sheets.append(Sheet(
+                'Top Products', ['Product', 'Quantity', 'Currency', 'Revenue'],
+                [
+                    [top.product.rec_name if first else '',
+                        top.quantity if first else '', currency.code,
+                        currency.round(revenue)]
+                    for top in report_context['top_10_products']
+                    for first, (currency, revenue) in zip(
+                        [True] + [False] * len(top.revenues), top.revenues)
+                ]
+            ))
+        return sheets
+
+    @classmethod
+    def get_cache_key(cls, data):
+        """
+        Return the key of the report in the cache for the data.
+
+        The key contains the data and a version of the matching sales made
+        of their number and the last create or write date of the sales,
+        their payments and payment transactions.
+        """
+        return (freeze(data), cls.get_data_version(data))
+
+    @classmethod
+    def get_flight_key(cls, data, version):
+        """
+        Return the key of the report rendered for the identical concurrent
+        requests.
+
+        The requests are identical if they have the same data and data
+        version in the same database, language and company, and the users
+        have the same access rules on the sales.
+        """
+        Rule = Pool().get('ir.rule')
+
+        transaction = Transaction()
+        return hashlib.sha1(json.dumps([
+            transaction.database.name, transaction.language,
+            transaction.context.get('company'), Rule.domain_get('sale.sale'),
+            data, version,
+        ], cls=JSONEncoder, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def get_data_version(cls, data):
+        """
+        Return a tuple changing whenever a sale, payment or payment
+        transaction matching the data is created, written or deleted
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        cursor = Transaction().connection.cursor()
+        sale_query = Sale.search(
+            cls.get_sale_domain(data), order=[], query=True
+        )
+
+        def last_change(table):
+            return Max(Coalesce(table.write_date, table.create_date))
+
+        sale = Sale.__table__()
+        cursor.execute(*sale.select(
+            Count(Literal(1)), last_change(sale),
+            where=sale.id.in_(sale_query),
+        ))
+        version = cursor.fetchone()
+
+        if cls._has_payment_tables():
+            Payment = pool.get('sale.payment')
+            GatewayTransaction = pool.get('payment_gateway.transaction')
+
+            payment = Payment.__table__()
+            transaction = GatewayTransaction.__table__()
+            cursor.execute(*payment.join(
+                transaction, type_='LEFT',
+                condition=transaction.sale_payment == payment.id
+            ).select(
+                Count(Literal(1)), last_change(payment),
+                last_change(transaction),
+                where=payment.sale.in_(sale_query),
+            ))
+            version += cursor.fetchone()
+        return tuple(version)
+
+    @classmethod
+    def get_sale_domain(cls, data):
+        """
+        Return the domain used to search the sales matching the wizard
+        data
+        """
+        domain = [
+            ('state', 'in', ['confirmed', 'processing', 'done']),
+            ('sale_date', '>=', data['start_date']),
+            ('sale_date', '<=', data['end_date'])
+        ]
+
+        if data.get('customer'):
+            domain.append(('party', '=', data['customer']))
+        if data.get('product'):
+            domain.append(('lines.product', '=', data['product']))
+        if data.get('channel'):
+            domain.append(('channel', '=', data['channel']))
+        return domain
+
+    @staticmethod
+    def _to_decimal(value):
+        """
+        Return the value of an SQL aggregate as a Decimal. SQLite returns
+        floats for SUM over numeric columns.
+        """
+        if value is None:
+            return Decimal('0')
+        if not isinstance(value, Decimal):
+            return Decimal(str(value))
+        return value
+
+    @classmethod
+    def _has_amount_cache(cls):
+        """
+        Return True if the sale model stores the cached amounts
+        """
+        Sale = Pool().get('sale.sale')
+
+        return all(
+            name in Sale._fields for name in (
+                'untaxed_amount_cache', 'tax_amount_cache',
+                'total_amount_cache',
+            )
+        )
+
+    @classmethod
+    def _has_payment_tables(cls):
+        """
+        Return True if the payment transactions can be aggregated in SQL
+        """
+        pool = Pool()
+        try:
+            GatewayTransaction = pool.get('payment_gateway.transaction')
+        except KeyError:
+            return False
+        return 'sale_payment' in GatewayTransaction._fields
+
+    @classmethod
+    def _get_sales_by_currency_orm(cls, sales, names=None):
+        """
+        Compute the totals per currency by reading the function fields of
+        each sale.
+
+        The totals are summed in a single pass keyed by currency id, and
+        only the currencies of the sales are read.
+
+        :param sales: List of sale active records
+        :param names: List of the totals to compute, defaults to all
+        """
+        Currency = Pool().get('currency.currency')
+
+        if names is None:
+            names = ['untaxed', 'tax', 'total', 'payment_available']
+        field_names = {
+            'untaxed': 'untaxed_amount',
+            'tax': 'tax_amount',
+            'total': 'total_amount',
+            'payment_available': 'payment_available',
+        }
+        totals = defaultdict(lambda: dict((n, Decimal('0')) for n in names))
+        for sale in sales:
+            amounts = totals[sale.currency.id]
+            for name in names:
+                amounts[name] += getattr(sale, field_names[name])
+
+        sales_by_currency = defaultdict(
+            lambda: defaultdict(lambda: Decimal('0'))
+        )
+        for currency in Currency.browse(totals.keys()):
+            sales_by_currency[currency].update(totals[currency.id])
+        return sales_by_currency
+
+    @classmethod
+    def get_sales_by_currency(cls, sale_query):
+        """
+        Return the untaxed, tax, total and available payment amounts of the
+        sales selected by sale_query grouped by currency.
+
+        The amounts are summed in the database from the amount cache
+        stored on confirmed sales and from the payment tables. Sales
+        without cached amounts, or databases without the cache columns,
+        are computed with the ORM.
+
+        :param sale_query: A python-sql query returning the sale ids
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Currency = pool.get('currency.currency')
+
+        amount_names = ['untaxed', 'tax', 'total']
+        sales_by_currency = defaultdict(
+            lambda: defaultdict(lambda: Decimal('0'))
+        )
+
+        def add(totals):
+            for currency, amounts in totals.iteritems():
+                for name, amount in amounts.iteritems():
+                    sales_by_currency[currency][name] += amount
+
+        if cls._has_amount_cache():
+            cursor = Transaction().connection.cursor()
+            sale = Sale.__table__()
+            cached = (
+                (sale.untaxed_amount_cache != None)  # noqa
+                & (sale.tax_amount_cache != None)  # noqa
+                & (sale.total_amount_cache != None)  # noqa
+            )
+            cursor.execute(*sale.select(
+                sale.currency,
+                Sum(sale.untaxed_amount_cache),
+                Sum(sale.tax_amount_cache),
+                Sum(sale.total_amount_cache),
+                where=sale.id.in_(sale_query) & cached,
+                group_by=sale.currency,
+            ))
+            rows = cursor.fetchall()
+            currencies = dict(
+                (c.id, c) for c in Currency.browse([r[0] for r in rows])
+            )
+            add(dict(
+                (currencies[currency_id], {
+                    'untaxed': cls._to_decimal(untaxed),
+                    'tax': cls._to_decimal(tax),
+                    'total': cls._to_decimal(total),
+                }) for currency_id, untaxed, tax, total in rows
+            ))
+            uncached_ids = cls._fetch_ids(sale.select(
+                sale.id, where=sale.id.in_(sale_query) & ~cached
+            ))
+        else:
+            uncached_ids = cls._fetch_ids(sale_query)
+
+        if uncached_ids:
+            totals = defaultdict(lambda: defaultdict(lambda: Decimal('0')))
+            for amounts in cls.get_sale_amounts(uncached_ids).itervalues():
+                for name in amount_names:
+                    totals[amounts.currency][name] += getattr(amounts, name)
+            add(dict(
+                (currency, totals[currency.id])
+                for currency in Currency.browse(totals.keys())
+            ))
+
+        if cls._has_payment_tables():
+            rows = cls._get_payment_available_by_currency(sale_query)
+            currencies = dict(
+                (c.id, c) for c in Currency.browse([r[0] for r in rows])
+            )
+            add(dict(
+                (currencies[currency_id], {'payment_available': amount})
+                for currency_id, amount in rows
+            ))
+        else:
+            add(cls._get_sales_by_currency_orm(
+                Sale.browse(cls._fetch_ids(sale_query)),
+                ['payment_available']
+            ))
+
+        # Every currency shows all the totals, even if it has no payment
+        for amounts in sales_by_currency.itervalues():
+            for name in amount_names + ['payment_available']:
+                amounts.setdefault(name, Decimal('0'))
+        return sales_by_currency
+
+    @classmethod
+    def get_sale_amounts(cls, sale_ids):
+        """
+        Return the SaleAmounts by id of the sales, computed from their
+        lines like the amounts of the sale module.
+
+        The lines and their taxes are read with a query per slice of
+        sales. The taxes are affine in the unit price, so each set of
+        taxes is computed for a unit price of 0 and 1 only, and the taxes
+        of each line are derived from these coefficients. The tax amounts
+        are rounded per sale and tax, or per line when the tax rounding of
+        the accounting configuration is by line.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        LineTax = pool.get('sale.line-account.tax')
+        Tax = pool.get('account.tax')
+        Currency = pool.get('currency.currency')
+        Configuration = pool.get('account.configuration')
+        Date = pool.get('ir.date')
+
+        if not sale_ids:
+            return {}
+
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+        line_tax = LineTax.__table__()
+
+        sale_currencies = {}
+        lines = []
+        line_taxes = defaultdict(list)
+        for sub_ids in grouped_slice(sale_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*sale.select(
+                sale.id, sale.currency, where=reduce_ids(sale.id, sub_ids)
+            ))
+            sale_currencies.update(cursor.fetchall())
+            cursor.execute(*line.select(
+                line.id, line.sale, line.quantity, line.unit_price,
+                where=reduce_ids(line.sale, sub_ids) & (line.type == 'line'),
+                order_by=[line.sale, line.sequence, line.id]
+            ))
+            lines.extend(cursor.fetchall())
+            cursor.execute(*line_tax.join(
+                line, condition=line_tax.line == line.id
+            ).select(
+                line_tax.line, line_tax.tax,
+                where=reduce_ids(line.sale, sub_ids)
+            ))
+            for line_id, tax_id in cursor.fetchall():
+                line_taxes[line_id].append(tax_id)
+
+        currencies = dict(
+            (c.id, c) for c in Currency.browse(list(set(
+                sale_currencies.itervalues()
+            )))
+        )
+        round_lines = Configuration(1).tax_rounding == 'line'
+        today = Date.today()
+
+        # The base and amount of each tax as (rate, fixed) coefficients of
+        # the unit price, by set of tax ids
+        coefficients = {}
+
+        def get_coefficients(tax_ids):
+            key = tuple(sorted(tax_ids))
+            if key not in coefficients:
+                taxes = Tax.browse(key)
+                zero = Tax.compute(taxes, Decimal('0'), 1, today)
+                one = Tax.compute(taxes, Decimal('1'), 1, today)
+                coefficients[key] = [
+                    (t0['tax'].id,
+                        t1['base'] - t0['base'], t0['base'],
+                        t1['amount'] - t0['amount'], t0['amount'])
+                    for t0, t1 in zip(zero, one)
+                ]
+            return coefficients[key]
+
+        untaxed_amounts = defaultdict(lambda: Decimal('0'))
+        # Tax amounts by sale, keyed by tax and sign of the base like the
+        # tax lines of the sale module
+        tax_amounts = defaultdict(lambda: defaultdict(lambda: Decimal('0')))
+        for line_id, sale_id, quantity, unit_price in lines:
+            currency = currencies[sale_currencies[sale_id]]
+            quantity = Decimal(str(quantity or 0.0))
+            unit_price = cls._to_decimal(unit_price or 0)
+            untaxed_amounts[sale_id] += currency.round(quantity * unit_price)
+            if not line_taxes[line_id]:
+                continue
+            sale_taxes = tax_amounts[sale_id]
+            for (tax_id, base_rate, base_fixed, amount_rate,
+                    amount_fixed) in get_coefficients(line_taxes[line_id]):
+                base = (base_rate * unit_price + base_fixed) * quantity
+                key = (tax_id, base >= 0)
+                sale_taxes[key] += (
+                    amount_rate * unit_price + amount_fixed) * quantity
+                if round_lines:
+                    sale_taxes[key] = currency.round(sale_taxes[key])
+
+        result = {}
+        for sale_id, currency_id in sale_currencies.iteritems():
+            currency = currencies[currency_id]
+            untaxed = untaxed_amounts[sale_id]
+            tax = sum(
+                (currency.round(a) for a in tax_amounts[sale_id].itervalues()),
+                Decimal('0')
+            )
+            result[sale_id] = SaleAmounts(
+                currency_id, untaxed, tax, untaxed + tax
+            )
+        return result
+
+    @classmethod
+    def _get_payment_available_query(cls, sale_query=None, sale_ids=None):
+        """
+        Return a python-sql query of the available payment amount per sale
+        for the sales selected by sale_query, or with the ids sale_ids, with
+        the columns sale and amount.
+
+        The available amount of a payment is its amount minus the charge
+        transactions consumed from it, never below zero. Only the
+        transactions of the payments of the selected sales are summed.
+        """
+        pool = Pool()
+        Payment = pool.get('sale.payment')
+        GatewayTransaction = pool.get('payment_gateway.transaction')
+
+        payment = Payment.__table__()
+        sale_payment = Payment.__table__()
+        transaction = GatewayTransaction.__table__()
+
+        def selected(column):
+            if sale_ids is not None:
+                return reduce_ids(column, sale_ids)
+            return column.in_(sale_query)
+
+        consumed = transaction.select(
+            transaction.sale_payment,
+            Sum(transaction.amount).as_('amount'),
+            where=(
+                (transaction.type == 'charge')
+                & transaction.state.in_(['authorized', 'completed', 'posted'])
+                & transaction.sale_payment.in_(sale_payment.select(
+                    sale_payment.id, where=selected(sale_payment.sale)
+                ))
+            ),
+            group_by=transaction.sale_payment,
+        )
+        return payment.join(
+            consumed, type_='LEFT',
+            condition=consumed.sale_payment == payment.id
+        ).select(
+            payment.sale.as_('sale'),
+            Sum(Greatest(
+                payment.amount - Coalesce(consumed.amount, 0), 0
+            )).as_('amount'),
+            where=selected(payment.sale),
+            group_by=payment.sale,
+        )
+
+    @classmethod
+    def get_payment_available(cls, sale_ids):
+        """
+        Return a dictionary of the available payment amount by sale id for
+        the sales with the ids sale_ids which have payments
+        """
+        cursor = Transaction().connection.cursor()
+        result = {}
+        for sub_ids in grouped_slice(sale_ids):
+            cursor.execute(*cls._get_payment_available_query(
+                sale_ids=list(sub_ids)
+            ))
+            for sale_id, amount in cursor.fetchall():
+                result[sale_id] = cls._to_decimal(amount)
+        return result
+
+    @classmethod
+    def _get_payment_available_by_currency(cls, sale_query):
+        """
+        Return a list of (currency id, available amount) tuples for the
+        payments of the sales selected by sale_query.
+        """
+        Sale = Pool().get('sale.sale')
+
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+        available = cls._get_payment_available_query(sale_query)
+
+        cursor.execute(*sale.join(
+            available, condition=available.sale == sale.id
+        ).select(
+            sale.currency,
+            Sum(available.amount),
+            group_by=sale.currency,
+        ))
+        return [
+            (currency_id, cls._to_decimal(amount))
+            for currency_id, amount in cursor.fetchall()
+        ]
+
+    @classmethod
+    def iter_sale_rows(cls, sale_query, batch_size=STREAM_BATCH_SIZE):
+        """
+        Yield a SaleRow for each sale selected by sale_query, most recent
+        first.
+
+        Each batch of batch_size rows is read with a single query joining
+        the party and the currency. The next batch starts after the sale
+        date and id of the last row of the previous one. The available
+        payment amounts are then summed for the ids of the batch only, and
+        the amounts missing from the sale amount cache are computed for
+        the batch.
+
+        The party is displayed as the default rec_name of the party module,
+        its name or else its code between brackets, read from the party
+        table. The overrides of Party.get_rec_name are intentionally
+        bypassed so that no party is instantiated.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Party = pool.get('party.party')
+        Currency = pool.get('currency.currency')
+
+        has_amount_cache = cls._has_amount_cache()
+        has_payment_tables = cls._has_payment_tables()
+
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+        party = Party.__table__()
+        currency = Currency.__table__()
+
+        query = sale.join(
+            party, condition=sale.party == party.id
+        ).join(
+            currency, condition=sale.currency == currency.id
+        )
+        columns = [
+            sale.id, sale.sale_date, sale.number, party.name, party.code,
+            currency.code, sale.state,
+        ]
+        if has_amount_cache:
+            columns += [
+                sale.untaxed_amount_cache, sale.tax_amount_cache,
+                sale.total_amount_cache,
+            ]
+        else:
+            columns += [Literal(None), Literal(None), Literal(None)]
+
+        last = None
+        while True:
+            where = sale.id.in_(sale_query)
+            if last is not None:
+                where &= (
+                    (sale.sale_date < last.sale_date)
+                    | ((sale.sale_date == last.sale_date)
+                        & (sale.id < last.id))
+                )
+            cursor.execute(*query.select(
+                *columns,
+                where=where,
+                order_by=[sale.sale_date.desc, sale.id.desc],
+                limit=batch_size
+            ))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            # Rows without cached amounts
+            amounts = cls.get_sale_amounts([
+                row[0] for row in rows if None in row[7:10]
+            ])
+            batch_ids = [row[0] for row in rows]
+            if has_payment_tables:
+                available = cls.get_payment_available(batch_ids)
+            else:
+                available = dict(
+                    (v['id'], v['payment_available'])
+                    for v in Sale.read(batch_ids, ['payment_available'])
+                )
+
+            for (sale_id, sale_date, number, party_name, party_code,
+                    currency_code, state, untaxed, tax, total) in rows:
+                if sale_id in amounts:
+                    _, untaxed, tax, total = amounts[sale_id]
+                payment_available = available.get(sale_id, 0)
+                last = SaleRow(
+                    sale_id, number, sale_date,
+                    party_name or ('[%s]' % party_code if party_code else ''),
+                    currency_code,
+                    cls._to_decimal(untaxed),
+                    cls._to_decimal(tax),
+                    cls._to_decimal(total),
+                    cls._to_decimal(payment_available),
+                    state,
+                )
+                yield last
+
+    @classmethod
+    def _fetch_ids(cls, query):
+        """
+        Execute the query and return the ids in its first column
+        """
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*query)
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def get_payments(cls, sale_query, detailed=True):
+        """
+        Return the gateways used and the payment amounts of the sales
+        selected by sale_query as a tuple of:
+
+            * the set of gateways
+            * payments by gateway and currency
+            * payments by currency for total
+            * payments by sale id and gateway id for detailed payment
+              information, left empty unless detailed is set
+
+        The amounts are summed with a single query grouped by gateway and
+        currency, and also by sale when detailed. They are accumulated by
+        ids and only the gateways and currencies found are read, in batch.
+
+        :param sale_query: A python-sql query returning the sale ids
+        :param detailed: Compute the payments by sale and gateway
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Payment = pool.get('sale.payment')
+
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+        payment = Payment.__table__()
+
+        group_by = [payment.gateway, sale.currency]
+        if detailed:
+            group_by.insert(0, payment.sale)
+        cursor.execute(*payment.join(
+            sale, condition=payment.sale == sale.id
+        ).select(
+            *(group_by + [Sum(payment.amount)]),
+            where=sale.id.in_(sale_query),
+            group_by=group_by
+        ))
+
+        # Payments by gateway id and currency id
+        amounts = defaultdict(lambda: Decimal('0'))
+        # Payments by sale and gateway for detailed payment information
+        pbsg = defaultdict(lambda: defaultdict(lambda: Decimal('0')))
+
+        for row in cursor.fetchall():
+            if detailed:
+                sale_id, row = row[0], row[1:]
+            gateway_id, currency_id, amount = row
+            amount = cls._to_decimal(amount)
+            amounts[(gateway_id, currency_id)] += amount
+            if detailed:
+                pbsg[sale_id][gateway_id] += amount
+
+        return cls._browse_payments(amounts) + (pbsg,)
+
+    @classmethod
+    def _browse_payments(cls, amounts):
+        """
+        Return the set of gateways, the payments by gateway and currency and
+        the payments by currency of the amounts by (gateway id, currency id)
+        with the gateways and currencies read in batch
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        Currency = pool.get('currency.currency')
+
+        gateways = dict((g.id, g) for g in Gateway.browse(
+            list(set(k[0] for k in amounts))
+        ))
+        currencies = dict((c.id, c) for c in Currency.browse(
+            list(set(k[1] for k in amounts))
+        ))
+
+        # Payments by gateway and currency
+        pbgc = defaultdict(lambda: defaultdict(lambda: Decimal('0')))
+        # Payments by currency for total
+        pbc = defaultdict(lambda: Decimal('0'))
+
+        for (gateway_id, currency_id), amount in amounts.iteritems():
+            gateway = gateways[gateway_id]
+            currency = currencies[currency_id]
+            pbgc[gateway][currency] += amount
+            pbc[currency] += amount
+
+        return set(gateways.values()), pbgc, pbc
+
+    @classmethod
+    def use_streaming(cls, data, sale_count):
+        """
+        Return True if the report must be rendered in streaming mode.
+
+        The streaming mode is used when requested in data or when the
+        number of orders exceeds the stream_threshold option of the
+        sales_reports configuration section.
+        """
+        if data.get('streaming') is not None:
+            return bool(data['streaming'])
+        return sale_count > STREAM_THRESHOLD
+
+    @classmethod
+    def get_chunk_orders(cls, data, sale_count):
+        """
+        Return the number of orders of each part of the report when it is
+        rendered by parts or None.
+
+        The PDF reports are rendered by parts when the number of orders
+        exceeds the chunk_orders of data or the pdf_chunk_orders option of
+        the sales_reports configuration section.
+        """
+        chunk_orders = data.get('chunk_orders')
+        if chunk_orders is None:
+            chunk_orders = PDF_CHUNK_ORDERS
+        if chunk_orders and sale_count > chunk_orders:
+            return chunk_orders
+
+    @classmethod
+    def render_template(cls, template_string, localcontext, translator):
+        """
+        Render the report converted to PDF by parts of chunk_orders orders
+        into an HTMLChunks. The totals and summaries are rendered by the
+        last part only.
+        """
+        report = localcontext.get('report')
+        chunk_orders = localcontext.get('chunk_orders')
+        if (not chunk_orders or report is None
+                or (report.extension or report.template_extension) != 'pdf'):
+            return super(SalesReport, cls).render_template(
+                template_string, localcontext, translator
+            )
+
+        sales = iter(localcontext['sales'])
+        count = -(-localcontext['sale_count'] // chunk_orders)
+        chunks = HTMLChunks(localcontext.get('chunk_output'))
+        try:
+            for number in xrange(1, count + 1):
+                chunks.append(super(SalesReport, cls).render_template(
+                    template_string, dict(
+                        localcontext,
+                        sales=list(islice(sales, chunk_orders)),
+                        chunk=number,
+                        chunks=count,
+                        stream_html=True,
+                    ), translator
+                ))
+        except Exception:
+            chunks.remove_files()
+            raise
+        return chunks
 
-from openlabs_report_webkit import ReportWebkit
+    @classmethod
+    def use_summary(cls, data):
+        """
+        Return True if the totals and top products can be computed from the
+        daily sales summary.
 
-__all__ = ['SalesReport', 'SalesReportWizardStart', 'SalesReportWizard']
+        The summary does not record which sales contain a product, so it
+        can not be used when the report is filtered on a product.
+        """
+        return USE_SUMMARY and not data.get('product')
 
+    @classmethod
+    def get_summary_query(cls, data):
+        """
+        Return a python-sql query of the ids of the daily sales summary
+        rows matching the wizard data
+        """
+        Summary = Pool().get('report.sales.summary')
 
-class ReportMixin(ReportWebkit):
-    """
-    Mixin Class to inherit from, for all HTML reports.
-    """
+        domain = [
+            ('date', '>=', data['start_date']),
+            ('date', '<=', data['end_date']),
+        ]
+        if data.get('customer'):
+            domain.append(('party', '=', data['customer']))
+        if data.get('channel'):
+            domain.append(('channel', '=', data['channel']))
+        return Summary.search(domain, order=[], query=True)
 
     @classmethod
-    def wkhtml_to_pdf(cls, data, options=None):
+    def get_sales_by_currency_from_summary(cls, summary_query, sale_query):
         """
-        Call wkhtmltopdf to convert the html to pdf
+        Return the totals per currency like get_sales_by_currency, summing
+        the amounts from the daily sales summary rows of summary_query.
+
+        The available payment amounts depend on the payment transactions and
+        are still computed from the sales selected by sale_query.
         """
-        Company = Pool().get('company.company')
+        pool = Pool()
+        Summary = pool.get('report.sales.summary')
+        Sale = pool.get('sale.sale')
+        Currency = pool.get('currency.currency')
 
-        company = ''
-        if Transaction().context.get('company'):
-            company = Company(Transaction().context.get(
-                'company')).party.name
-        options = {
-            'margin-bottom': '0.50in',
-            'margin-left': '0.50in',
-            'margin-right': '0.50in',
-            'margin-top': '0.50in',
-            'footer-font-size': '8',
-            'footer-left': company,
-            'footer-line': '',
-            'footer-right': '[page]/[toPage]',
-            'footer-spacing': '5',
-            'page-size': 'Letter',
-        }
-        return super(ReportMixin, cls).wkhtml_to_pdf(
-            data, options=options
+        cursor = Transaction().connection.cursor()
+        summary = Summary.__table__()
+
+        cursor.execute(*summary.select(
+            summary.currency,
+            Sum(summary.untaxed_amount),
+            Sum(summary.tax_amount),
+            Sum(summary.total_amount),
+            where=summary.id.in_(summary_query)
+            & (summary.product == None),  # noqa
+            group_by=summary.currency,
+        ))
+        totals = dict(
+            (currency_id, {
+                'untaxed': cls._to_decimal(untaxed),
+                'tax': cls._to_decimal(tax),
+                'total': cls._to_decimal(total),
+                'payment_available': Decimal('0'),
+            }) for currency_id, untaxed, tax, total in cursor.fetchall()
         )
 
+        if cls._has_payment_tables():
+            available = cls._get_payment_available_by_currency(sale_query)
+            for currency_id, amount in available:
+                if currency_id in totals:
+                    totals[currency_id]['payment_available'] = amount
+        else:
+            for currency, amounts in cls._get_sales_by_currency_orm(
+                    Sale.browse(cls._fetch_ids(sale_query)),
+                    ['payment_available']).iteritems():
+                if currency.id in totals:
+                    totals[currency.id]['payment_available'] = \
+                        amounts['payment_available']
 
-class SalesReport(ReportMixin):
-    "Sales Report"
-    __name__ = 'report.sales'
+        sales_by_currency = defaultdict(
+            lambda: defaultdict(lambda: Decimal('0'))
+        )
+        for currency in Currency.browse(totals.keys()):
+            sales_by_currency[currency].update(totals[currency.id])
+        return sales_by_currency
 
     @classmethod
-    def get_context(cls, records, data):
-        Sale = Pool().get('sale.sale')
-        Channel = Pool().get('sale.channel')
-        Party = Pool().get('party.party')
-        Product = Pool().get('product.product')
+    def get_top_products_from_summary(
+            cls, summary_query, limit=TOP_PRODUCTS, rank_by='quantity'):
+        """
+        Return a list of TopProduct of the most sold products in the daily
+        sales summary rows of summary_query, ranked by quantity or revenue
+        in every currency
+        """
+        Summary = Pool().get('report.sales.summary')
 
-        domain = [
-            ('state', 'in', ['confirmed', 'processing', 'done']),
-            ('sale_date', '>=', data['start_date']),
-            ('sale_date', '<=', data['end_date'])
+        cursor = Transaction().connection.cursor()
+        summary = Summary.__table__()
+
+        quantity = Sum(summary.quantity)
+        revenue = Sum(summary.untaxed_amount)
+        cursor.execute(*summary.select(
+            summary.product, quantity,
+            where=summary.id.in_(summary_query)
+            & (summary.product != None),  # noqa
+            group_by=[summary.product],
+            order_by=[
+                (revenue if rank_by == 'revenue' else quantity).desc,
+                summary.product,
+            ],
+            limit=limit,
+        ))
+        ranking = cursor.fetchall()
+        revenues = []
+        for sub_ids in grouped_slice([r[0] for r in ranking]):
+            cursor.execute(*summary.select(
+                summary.product, summary.currency, revenue,
+                where=summary.id.in_(summary_query)
+                & reduce_ids(summary.product, sub_ids),
+                group_by=[summary.product, summary.currency],
+            ))
+            revenues.extend(cursor.fetchall())
+        return cls._browse_top_products(
+            cls._group_top_products(ranking, revenues)
+        )
+
+    @classmethod
+    def get_top_products_query(
+            cls, sale_query, limit=TOP_PRODUCTS, rank_by='quantity'):
+        """
+        Return a python-sql query of the product and quantity of the most
+        sold products of the sales selected by sale_query, ranked by
+        quantity or revenue in every currency.
+
+        The sales are filtered by joining sale_query instead of binding
+        their ids.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        line = SaleLine.__table__()
+
+        quantity = Sum(line.quantity)
+        revenue = Sum(line.quantity * line.unit_price)
+        return line.select(
+            line.product, quantity,
+            where=line.sale.in_(sale_query) & (line.product != Null),
+            group_by=[line.product],
+            order_by=[
+                (revenue if rank_by == 'revenue' else quantity).desc,
+                line.product,
+            ],
+            limit=limit,
+        )
+
+    @classmethod
+    def get_top_products_revenue_query(cls, sale_query, product_ids):
+        """
+        Return a python-sql query of the product, currency and revenue of
+        the products of product_ids in the sales selected by sale_query
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+
+        return line.join(
+            sale, condition=line.sale == sale.id
+        ).select(
+            line.product, sale.currency,
+            Sum(line.quantity * line.unit_price),
+            where=sale.id.in_(sale_query)
+            & reduce_ids(line.product, product_ids),
+            group_by=[line.product, sale.currency],
+        )
+
+    @staticmethod
+    def _group_top_products(ranking, revenues):
+        """
+        Return the (product id, quantity, revenues) tuples of the ranked
+        (product id, quantity) rows with the (currency id, revenue) tuples
+        of their (product id, currency id, revenue) rows
+        """
+        revenues_by_product = defaultdict(list)
+        for product_id, currency_id, revenue in revenues:
+            revenues_by_product[product_id].append((currency_id, revenue))
+        return [
+            (product_id, quantity, revenues_by_product[product_id])
+            for product_id, quantity in ranking
         ]
 
-        customer_id = data.get('customer')
-        product_id = data.get('product')
-        channel_id = data.get('channel')
-        detailed_payments = data.get('detailed_payments')
+    @classmethod
+    def _browse_top_products(cls, rows):
+        """
+        Return the list of TopProduct of the (product id, quantity,
+        revenues) rows, with revenues a list of (currency id, revenue)
+        tuples, and the products and currencies read in batch
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Currency = pool.get('currency.currency')
 
-        if customer_id:
-            domain.append(('party', '=', customer_id))
-        if product_id:
-            domain.append(('lines.product', '=', product_id))
-        if channel_id:
-            domain.append(('channel', '=', channel_id))
+        rows = list(rows)
+        products = dict(
+            (p.id, p) for p in Product.browse(list(set(r[0] for r in rows)))
+        )
+        currencies = dict((c.id, c) for c in Currency.browse(list(set(
+            currency_id for r in rows for currency_id, _ in r[2]
+        ))))
+        return [
+            TopProduct(
+                products[product_id], quantity, sorted([
+                    (currencies[currency_id], cls._to_decimal(revenue))
+                    for currency_id, revenue in revenues
+                ], key=lambda r: r[0].code)
+            ) for product_id, quantity, revenues in rows
+        ]
 
-        sales = Sale.search(domain, order=[('sale_date', 'desc')])
+    @classmethod
+    def get_top_products(cls, data, sale_query, summary_query=None):
+        """
+        Return a list of TopProduct of the most sold products of the sales
+        selected by sale_query, or of the daily sales summary rows of
+        summary_query when given.
 
-        if not sales:
-            raise UserError(
-                "There are no orders matching the filters."
+        The number of products and the ranking are read from the
+        top_products and top_products_by keys of data.
+        """
+        limit = data.get('top_products') or TOP_PRODUCTS
+        rank_by = data.get('top_products_by') or 'quantity'
+
+        if summary_query is not None:
+            return cls.get_top_products_from_summary(
+                summary_query, limit, rank_by
             )
+        if data.get('product'):
+            return []
 
-        sales_by_currency = defaultdict(dict)
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*cls.get_top_products_query(
+            sale_query, limit, rank_by
+        ))
+        ranking = cursor.fetchall()
+        revenues = []
+        for sub_ids in grouped_slice([r[0] for r in ranking]):
+            cursor.execute(*cls.get_top_products_revenue_query(
+                sale_query, sub_ids
+            ))
+            revenues.extend(cursor.fetchall())
+        return cls._browse_top_products(
+            cls._group_top_products(ranking, revenues)
+        )
 
-        def key(sale):
-            return sale.currency
+    @classmethod
+    def get_sections(cls, data, sale_query):
+        """
+        Return the sections of the report as a tuple of the totals per
+        currency, the gateways, the payments by gateway and currency, by
+        currency and by sale and gateway, and the top products.
+        """
+        summary_query = None
+        with phase('totals'):
+            if cls.use_summary(data):
+                summary_query = cls.get_summary_query(data)
+                sales_by_currency = cls.get_sales_by_currency_from_summary(
+                    summary_query, sale_query
+                )
+            else:
+                sales_by_currency = cls.get_sales_by_currency(sale_query)
 
-        for currency, cur_sales in groupby(sorted(sales, key=key), key):
-            cur_sales = list(cur_sales)
-            sales_by_currency[currency]['total'] = sum([
-                sale.total_amount for sale in cur_sales
-            ])
-            sales_by_currency[currency]['tax'] = sum([
-                sale.tax_amount for sale in cur_sales
-            ])
-            sales_by_currency[currency]['untaxed'] = sum([
-                sale.untaxed_amount for sale in cur_sales
-            ])
-            sales_by_currency[currency]['payment_available'] = sum([
-                sale.payment_available for sale in cur_sales
-            ])
+        with phase('payments'):
+            gateways, pbgc, pbc, pbsg = cls.get_payments(
+                sale_query, bool(data.get('detailed_payments'))
+            )
 
-        gateways = set()
+        with phase('top_products'):
+            top_10_products = cls.get_top_products(
+                data, sale_query, summary_query
+            )
+        return sales_by_currency, gateways, pbgc, pbc, pbsg, top_10_products
 
-        # Payments by gateway and currency
-        pbgc = defaultdict(lambda: defaultdict(lambda: Decimal('0')))
-        # Payments by currency for total
-        pbc = defaultdict(lambda: Decimal('0'))
-        # Payments by sale and gateway for detailed payment information
+    @classmethod
+    def use_parallel(cls, data):
+        """
+        Return True if the sections of the report are computed by shards of
+        the date range, which run in parallel when the parallel_workers
+        option of the sales_reports configuration section is set.
+        """
+        if data.get('parallel') is not None:
+            return bool(data['parallel'])
+        return bool(PARALLEL_WORKERS)
+
+    @classmethod
+    def start_parallel_sections(cls, data):
+        """
+        Start computing the totals and payments of each shard of the date
+        range and the top products of the whole range.
+
+        The totals and payments are sums, so the partial results of the
+        shards are merged by merge_parallel_sections. The top products can
+        not be merged from the top products of each shard and are computed
+        by a single task.
+        """
+        tasks = [
+            ('get_shard_sections', (
+                dict(data, start_date=start_date, end_date=end_date),
+            ))
+            for start_date, end_date in split_dates(
+                data['start_date'], data['end_date'], PARALLEL_SHARD_DAYS
+            )
+        ]
+        tasks.append(('get_top_product_ids', (data,)))
+        return run_tasks(cls.__name__, tasks)
+
+    @classmethod
+    def get_shard_sections(cls, data):
+        """
+        Return the totals per currency and the payments of the sales
+        matching data as dictionaries keyed by ids
+        """
+        Sale = Pool().get('sale.sale')
+
+        sale_query = Sale.search(
+            cls.get_sale_domain(data), order=[], query=True
+        )
+        if cls.use_summary(data):
+            sales_by_currency = cls.get_sales_by_currency_from_summary(
+                cls.get_summary_query(data), sale_query
+            )
+        else:
+            sales_by_currency = cls.get_sales_by_currency(sale_query)
+        _, pbgc, _, pbsg = cls.get_payments(
+            sale_query, bool(data.get('detailed_payments'))
+        )
+
+        return {
+            'sales_by_currency': dict(
+                (currency.id, dict(amounts))
+                for currency, amounts in sales_by_currency.iteritems()
+            ),
+            'pbgc': dict(
+                (gateway.id, dict(
+                    (currency.id, amount)
+                    for currency, amount in amounts.iteritems()
+                )) for gateway, amounts in pbgc.iteritems()
+            ),
+            'pbsg': dict(
+                (sale_id, dict(amounts))
+                for sale_id, amounts in pbsg.iteritems()
+            ),
+        }
+
+    @classmethod
+    def get_top_product_ids(cls, data):
+        """
+        Return the top products of the sales matching data as a list of
+        (product id, quantity, revenues) tuples, with revenues a list of
+        (currency id, revenue) tuples
+        """
+        Sale = Pool().get('sale.sale')
+
+        sale_query = Sale.search(
+            cls.get_sale_domain(data), order=[], query=True
+        )
+        summary_query = None
+        if cls.use_summary(data):
+            summary_query = cls.get_summary_query(data)
+        return [
+            (top.product.id, top.quantity, [
+                (currency.id, revenue) for currency, revenue in top.revenues
+            ]) for top in cls.get_top_products(data, sale_query, summary_query)
+        ]
+
+    @classmethod
+    def merge_parallel_sections(cls, results):
+        """
+        Return the sections like get_sections from the results of the tasks
+        started by start_parallel_sections
+        """
+        Currency = Pool().get('currency.currency')
+
+        results = list(results)
+        top_product_ids = results.pop()
+
+        totals = defaultdict(lambda: defaultdict(lambda: Decimal('0')))
+        payments = defaultdict(lambda: Decimal('0'))
         pbsg = defaultdict(lambda: defaultdict(lambda: Decimal('0')))
 
-        for sale in sales:
-            for payment in sale.payments:
-                # TODO: This is too expensive. This is as simple as a join
-                # and a group by statement on sale_payment
-                gateways.add(payment.gateway)
+        # The shards are summed by ids, and the records are read once
+        for shard in results:
+            for currency_id, amounts in \
+                    shard['sales_by_currency'].iteritems():
+                for name, amount in amounts.iteritems():
+                    totals[currency_id][name] += amount
+            for gateway_id, amounts in shard['pbgc'].iteritems():
+                for currency_id, amount in amounts.iteritems():
+                    payments[(gateway_id, currency_id)] += amount
+            for sale_id, amounts in shard['pbsg'].iteritems():
+                for gateway_id, amount in amounts.iteritems():
+                    pbsg[sale_id][gateway_id] += amount
+
+        sales_by_currency = defaultdict(
+            lambda: defaultdict(lambda: Decimal('0'))
+        )
+        for currency in Currency.browse(totals.keys()):
+            sales_by_currency[currency].update(totals[currency.id])
+        gateways, pbgc, pbc = cls._browse_payments(payments)
 
-                pbsg[sale.id][payment.gateway.id] += payment.amount
-                pbgc[payment.gateway][sale.currency] += payment.amount
-                pbc[sale.currency] += payment.amount
+        top_10_products = cls._browse_top_products(top_product_ids)
+        return (
+            sales_by_currency, gateways, pbgc, pbc, pbsg, top_10_products
+        )
+
+    @classmethod
+    def get_report_queries(cls, data):
+        """
+        Return a list of (name, python-sql query) tuples of the main
+        queries run by the report for the data
+        """
+        Sale = Pool().get('sale.sale')
+
+        sale_query = Sale.search(
+            cls.get_sale_domain(data), order=[], query=True
+        )
+        queries = [
+            ('sales', sale_query),
+            ('top_products', cls.get_top_products_query(sale_query)),
+        ]
+        if cls._has_payment_tables():
+            queries.append((
+                'payment_available',
+                cls._get_payment_available_query(sale_query),
+            ))
+        return queries
 
-        # Top 10 products
+    @classmethod
+    def explain(cls, query):
+        """
+        Return the lines of the plan of the python-sql query
+        """
         cursor = Transaction().connection.cursor()
-        top_10_products = []
-        if not product_id:
-            query = """
-                SELECT
-                    product,
-                    SUM(quantity) AS quantity
-                    FROM sale_line
-                    WHERE sale IN %s AND product IS NOT NULL
-                    GROUP BY product
-                    ORDER BY quantity DESC
-                    LIMIT 10"""
-            cursor.execute(
-                query, (tuple(map(int, sales)),))
-            for top_product_id, quantity in cursor.fetchall():
-                top_10_products.append((Product(top_product_id), quantity))
+        sql, params = tuple(query)
+        if backend.name() == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            # The last column is the detail of the plan step
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute('EXPLAIN ' + sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def check_query_plans(cls, data):
+        """
+        Run EXPLAIN on the queries of the report for the data and return a
+        dictionary of the large tables scanned sequentially by query name.
+        A warning is logged for each of them.
+        """
+        pattern = SEQUENTIAL_SCAN.get(backend.name())
+        if pattern is None:
+            return {}
+
+        scans = {}
+        for name, query in cls.get_report_queries(data):
+            plan = cls.explain(query)
+            tables = set()
+            for line in plan:
+                match = pattern.search(line.strip())
+                if match and match.group(1) in PLAN_TABLES:
+                    tables.add(match.group(1))
+            if tables:
+                scans[name] = tables
+                logger.warning(
+                    'Sequential scan of %s in the %s query of %s:\n%s',
+                    ', '.join(sorted(tables)), name, cls.__name__,
+                    '\n'.join(plan)
+                )
+        return scans
+
+    @classmethod
+    def browse_prefetched(cls, model_name, ids, names):
+        """
+        Return a dictionary of the records of the model by id, whose field
+        names are read at once for all of them.
+
+        The records are browsed together so they share their cache, and
+        reading a field of one record reads it for all of them.
+        """
+        Model = Pool().get(model_name)
+
+        records = Model.browse(sorted(set(ids)))
+        if records:
+            for name in names:
+                getattr(records[0], name)
+        return dict((r.id, r) for r in records)
+
+    @classmethod
+    def prefetch_records(
+            cls, sales_by_currency, gateways, pbgc, pbc, top_10_products,
+            customer_id=None, product_id=None, channel_id=None):
+        """
+        Return the sections and the filters of the report with their
+        records replaced by records read in batch per model, with the
+        fields used by the template. Rendering the template then does not
+        query the database.
+        """
+        currency_ids = [c.id for c in sales_by_currency] + [
+            c.id for c in pbc] + [
+            c.id for amounts in pbgc.itervalues() for c in amounts] + [
+            c.id for t in top_10_products for c, _ in t.revenues]
+        currencies = cls.browse_prefetched(
+            'currency.currency', currency_ids, ['code']
+        )
+        gateways = cls.browse_prefetched(
+            'payment_gateway.gateway',
+            [g.id for g in gateways] + [g.id for g in pbgc], ['name']
+        )
+        products = cls.browse_prefetched(
+            'product.product',
+            [t.product.id for t in top_10_products] + filter(
+                None, [product_id]), ['rec_name']
+        )
+        parties = cls.browse_prefetched(
+            'party.party', filter(None, [customer_id]), ['rec_name']
+        )
+        channels = cls.browse_prefetched(
+            'sale.channel', filter(None, [channel_id]), ['rec_name']
+        )
+
+        return (
+            dict(
+                (currencies[c.id], amounts)
+                for c, amounts in sales_by_currency.iteritems()
+            ),
+            set(gateways.values()),
+            dict(
+                (gateways[g.id], dict(
+                    (currencies[c.id], amount)
+                    for c, amount in amounts.iteritems()
+                )) for g, amounts in pbgc.iteritems()
+            ),
+            dict((currencies[c.id], amount) for c, amount in pbc.iteritems()),
+            [
+                top._replace(
+                    product=products[top.product.id],
+                    revenues=[
+                        (currencies[c.id], revenue)
+                        for c, revenue in top.revenues
+                    ]
+                ) for top in top_10_products
+            ],
+            parties.get(customer_id),
+            products.get(product_id),
+            channels.get(channel_id),
+        )
+
+    @classmethod
+    def get_context(cls, records, data):
+        Sale = Pool().get('sale.sale')
+
+        if CHECK_PLANS:
+            cls.check_query_plans(data)
+
+        with phase('search'):
+            domain = cls.get_sale_domain(data)
+            sale_query = Sale.search(domain, order=[], query=True)
+
+            sales = SaleStream(cls, sale_query)
+            sale_count = len(sales)
+        if not sale_count:
+            raise UserError(
+                "There are no orders matching the filters."
+            )
+        streaming = cls.use_streaming(data, sale_count)
+        chunk_orders = cls.get_chunk_orders(data, sale_count)
+
+        results = None
+        if cls.use_parallel(data):
+            # The orders are read while the sections are computed
+            results = cls.start_parallel_sections(data)
+        if data.get('preview_orders'):
+            with phase('orders'):
+                sales = list(islice(
+                    SaleStream(cls, sale_query, data['preview_orders']),
+                    data['preview_orders']
+                ))
+        elif not streaming and not chunk_orders:
+            with phase('orders'):
+                sales = list(sales)
+
+        if results is not None:
+            with phase('sections'):
+                sections = cls.merge_parallel_sections(results.get())
+        else:
+            sections = cls.get_sections(data, sale_query)
+        return cls.get_sections_context(
+            records, data, sales, sale_count, sections, streaming,
+            chunk_orders
+        )
+
+    @classmethod
+    def get_sections_context(
+            cls, records, data, sales, sale_count, sections, streaming=False,
+            chunk_orders=None):
+        """
+        Return the report context of the orders and of the sections
+        returned by get_sections
+        """
+        customer_id = data.get('customer')
+        product_id = data.get('product')
+        channel_id = data.get('channel')
+        detailed_payments = data.get('detailed_payments')
+
+        (sales_by_currency, gateways, pbgc, pbc, pbsg,
+            top_10_products) = sections
 
         report_context = super(SalesReport, cls).get_context(
             records, data
         )
 
+        (sales_by_currency, gateways, pbgc, pbc, top_10_products, customer,
+            product, channel) = cls.prefetch_records(
+                sales_by_currency, gateways, pbgc, pbc, top_10_products,
+                customer_id, product_id, channel_id
+        )
         report_context.update({
             'sales': sales,
+            'sale_count': sale_count,
             'pbgc': pbgc,
             'pbc': pbc,
             'pbsg': pbsg,
             'top_10_products': top_10_products,
+            'top_products_by': data.get('top_products_by') or 'quantity',
             'sales_by_currency': sales_by_currency,
-            'customer': customer_id and Party(customer_id),
-            'product': product_id and Product(product_id),
-            'channel': channel_id and Channel(channel_id),
+            'customer': customer,
+            'product': product,
+            'channel': channel,
             'start_date': data['start_date'],
             'end_date': data['end_date'],
             'detailed_payments': detailed_payments,
             'gateways': gateways,
+            'stream_html': streaming,
+            # The report is rendered by parts of chunk_orders orders when
+            # converted to PDF
+            'chunk_orders': chunk_orders,
+            'chunk_output': data.get('chunk_output') or PDF_CHUNK_OUTPUT,
+            'chunk': None,
+            'chunks': None,
+            # Only the first orders are listed by the preview
+            'preview_orders': data.get('preview_orders'),
+            # The phases computed so far are shown at the end of the report
+            'profile': current_profile() if data.get('debug') else None,
         })
 
         return report_context
 
 
-class SalesReportWizardStart(ModelView):
+class SalesReportOptions(object):
     """
-    Sales Report Wizard View
+    The filters and options of the sales report, shared by the wizard and
+    the report definitions
     """
-    __name__ = 'report.sales.wizard.start'
-
     customer = fields.Many2One('party.party', 'Customer')
     product = fields.Many2One('product.product', 'Product')
     channel = fields.Many2One('sale.channel', 'Channel')
-    start_date = fields.Date('Start Date', required=True)
-    end_date = fields.Date('End Date', required=True)
     detailed_payments = fields.Boolean("Show Payment Details?")
+    top_products = fields.Integer("Top Products", required=True)
+    top_products_by = fields.Selection([
+        ('quantity', 'Quantity'),
+        ('revenue', 'Revenue'),
+    ], "Rank Top Products By", required=True)
+    output_format = fields.Selection(
+        'get_output_formats', "Output Format", required=True,
+        help="Export the data as a spreadsheet or preview the report with "
+        "its first orders instead of the report"
+    )
+    chunk_output = fields.Selection([
+        ('merge', 'Single PDF'),
+        ('zip', 'Zip Archive of Parts'),
+    ], "Large Reports", required=True,
+        help="How the parts of the large reports are delivered")
 
     @staticmethod
-    def default_start_date():
-        Date = Pool().get('ir.date')
+    def get_output_formats():
+        """
+        Return the output formats, the spreadsheets only when they can be
+        exported
+        """
+        return [
+            ('report', 'Report'),
+        ] + [
+            (output_format, name) for output_format, name in [
+                ('csv', 'CSV'),
+                ('xlsx', 'Excel (XLSX)'),
+            ] if can_export(output_format)
+        ] + [
+            ('preview', 'HTML Preview'),
+        ]
 
-        return Date.today()
+    @staticmethod
+    def default_top_products():
+        return TOP_PRODUCTS
 
     @staticmethod
-    def default_end_date():
-        Date = Pool().get('ir.date')
+    def default_top_products_by():
+        return 'quantity'
 
-        return Date.today()
+    @staticmethod
+    def default_output_format():
+        return 'report'
+
+    @staticmethod
+    def default_chunk_output():
+        return PDF_CHUNK_OUTPUT
 
     @classmethod
     def default_channel(cls):
@@ -200,6 +2457,99 @@ class SalesReportWizardStart(ModelView):
         return user.current_channel and \
             user.current_channel.id
 
+    def get_option(self, name, default=None):
+        """
+        Return the value of the option name, or default if it is missing
+        from the data of older clients
+        """
+        return getattr(self, name, default)
+
+    def get_report_data(self, start_date, end_date):
+        """
+        Return the data of the sales report from start_date to end_date
+        """
+        return {
+            'channel': self.channel and self.channel.id,
+            'customer': self.customer and self.customer.id,
+            'product': self.product and self.product.id,
+            'start_date': start_date,
+            'end_date': end_date,
+            'detailed_payments': bool(self.detailed_payments),
+            'top_products': self.get_option('top_products'),
+            'top_products_by': self.get_option('top_products_by'),
+            'chunk_output': self.get_option('chunk_output'),
+            'output_format': self.get_option('output_format'),
+        }
+
+
+class SalesReportWizardStart(SalesReportOptions, ModelView):
+    """
+    Sales Report Wizard View
+    """
+    __name__ = 'report.sales.wizard.start'
+
+    start_date = fields.Date('Start Date', required=True)
+    end_date = fields.Date('End Date', required=True)
+    background = fields.Boolean(
+        "Generate in Background",
+        help="Queue the report and render it in the background"
+    )
+    estimated_orders = fields.Integer(
+        'Estimated Orders', readonly=True,
+        help="The approximate number of orders of the report"
+    )
+    estimated_duration = fields.TimeDelta(
+        'Estimated Duration', readonly=True,
+        help="The approximate time needed to render the report"
+    )
+
+    @staticmethod
+    def default_start_date():
+        Date = Pool().get('ir.date')
+
+        return Date.today()
+
+    @staticmethod
+    def default_end_date():
+        Date = Pool().get('ir.date')
+
+        return Date.today()
+
+    @fields.depends('start_date', 'end_date', 'channel', 'customer', 'product')
+    def on_change_with_estimated_orders(self, name=None):
+        SalesReport = Pool().get('report.sales', type='report')
+
+        if not self.start_date or not self.end_date:
+            return None
+        return SalesReport.estimate_orders({
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'channel': self.channel and self.channel.id,
+            'customer': self.customer and self.customer.id,
+            'product': self.product and self.product.id,
+        })
+
+    @fields.depends('estimated_orders', methods=['estimated_orders'])
+    def on_change_with_estimated_duration(self, name=None):
+        SalesReport = Pool().get('report.sales', type='report')
+
+        if self.estimated_orders is None:
+            return None
+        return SalesReport.estimate_duration(self.estimated_orders)
+
+    def on_change_with(self, fieldnames):
+        # The estimated duration is computed from the orders estimated for
+        # the same change, which are counted once
+        changes = {}
+        if 'estimated_orders' in fieldnames:
+            self.estimated_orders = changes['estimated_orders'] = \
+                self.on_change_with_estimated_orders()
+            fieldnames = [f for f in fieldnames if f != 'estimated_orders']
+        changes.update(super(SalesReportWizardStart, self).on_change_with(
+            fieldnames
+        ))
+        return changes
+
 
 class SalesReportWizard(Wizard):
     """
@@ -215,20 +2565,70 @@ class SalesReportWizard(Wizard):
         ]
     )
     generate = StateAction('sales_reports.report_sales')
+    status = StateView(
+        'report.sales.job.status',
+        'sales_reports.report_sales_job_status_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+            Button('Refresh', 'status', 'tryton-refresh', default=True),
+            Button('Open', 'open_', 'tryton-print', states={
+                'invisible': Eval('state') != 'done',
+            }),
+        ]
+    )
+    open_ = StateAction('sales_reports.report_sales_job_output')
 
     def do_generate(self, action):
         """
-        Sends the wizard data to report
+        Sends the wizard data to report, or queues the report when it is
+        generated in background. The report rendered in advance for the same
+        data is opened instead if the sales did not change since.
+
+        The reports with too many orders are refused, and the large ones
+        are generated in background, except the previews.
         """
-        data = {
-            'channel': self.start.channel and self.start.channel.id,
-            'customer': self.start.customer and self.start.customer.id,
-            'product': self.start.product and self.start.product.id,
-            'start_date': self.start.start_date,
-            'end_date': self.start.end_date,
-            'detailed_payments': self.start.detailed_payments
-        }
+        pool = Pool()
+        Job = pool.get('report.sales.job')
+        SalesReport = pool.get('report.sales', type='report')
+
+        data = self.start.get_report_data(
+            self.start.start_date, self.start.end_date
+        )
+        if not self.in_background():
+            job = Job.find_rendered(data)
+            if job is not None:
+                return self.states['open_'].get_action(), {'id': job.id}
+        # The previews are cheap whatever the number of orders
+        if (data.get('output_format') != 'preview'
+                and SalesReport.get_admission(data) == 'background'):
+            self.start.background = True
+        if self.in_background():
+            self.status.job = Job.enqueue(data)
+            return
         return action, data
 
+    def in_background(self):
+        """
+        Return True if the report must be generated in background
+        """
+        return bool(self.start.get_option('background', False))
+
     def transition_generate(self):
+        if self.in_background():
+            return 'status'
+        return 'end'
+
+    def default_status(self, fields):
+        job = self.status.job
+        return {
+            'job': job.id,
+            'state': job.state,
+            'started': job.started,
+            'finished': job.finished,
+            'message': job.message,
+        }
+
+    def do_open_(self, action):
+        return action, {'id': self.status.job.id}
+
+    def transition_open_(self):
         return 'end'
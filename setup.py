@@ -64,6 +64,47 @@ class PostgresTest(Command):
         sys.exit(-1)
 
 
+class Benchmark(Command):
+    """
+    Run the benchmark of the sales report
+    """
+    description = "Benchmark the sales report"
+
+    user_options = [
+        ('orders=', None, 'comma separated numbers of orders to benchmark'),
+        ('output=', None, 'file to write the JSON results to'),
+        ('postgres', None, 'run on Postgresql instead of SQLite'),
+    ]
+
+    def initialize_options(self):
+        self.orders = '1000,10000,100000'
+        self.output = None
+        self.postgres = False
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        if self.postgres:
+            os.environ['TRYTOND_DATABASE_URI'] = 'postgresql://'
+            os.environ['DB_NAME'] = 'test_' + str(int(time.time()))
+        else:
+            os.environ['TRYTOND_DATABASE_URI'] = 'sqlite://'
+            os.environ['DB_NAME'] = ':memory:'
+        os.environ['BENCHMARK_ORDERS'] = self.orders
+        if self.output:
+            os.environ['BENCHMARK_OUTPUT'] = self.output
+
+        from tests.benchmark import SalesReportBenchmark
+        test_result = unittest.TextTestRunner(verbosity=3).run(
+            unittest.TestSuite([SalesReportBenchmark('test_benchmark')])
+        )
+
+        if test_result.wasSuccessful():
+            sys.exit(0)
+        sys.exit(-1)
+
+
 config = ConfigParser.ConfigParser()
 config.readfp(open('tryton.cfg'))
 info = dict(config.items('tryton'))
@@ -136,6 +177,10 @@ setup(
     ],
     license='BSD',
     install_requires=requires,
+    extras_require={
+        'pdf_merge': ['PyPDF2'],
+        'xlsx': ['xlsxwriter'],
+    },
     zip_safe=False,
     entry_points="""
     [trytond.modules]
@@ -146,5 +191,6 @@ setup(
     cmdclass={
         'test': SQLiteTest,
         'test_on_postgres': PostgresTest,
+        'benchmark': Benchmark,
     }
 )
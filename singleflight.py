@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import errno
+import fcntl
+import logging
+import tempfile
+import threading
+
+from trytond.config import config
+
+__all__ = [
+    'SingleFlight', 'dump_report', 'load_report', 'dump_reports',
+    'load_reports',
+]
+
+logger = logging.getLogger(__name__)
+
+# Directory of the lock files shared by the server processes, so that the
+# identical reports requested from different processes are rendered once.
+# Without it, the requests are only de-duplicated within each process.
+SINGLE_FLIGHT_DIR = config.get(
+    'sales_reports', 'single_flight_dir', default=None
+)
+# Number of seconds a request waits for an identical request being rendered
+# before rendering the report itself
+SINGLE_FLIGHT_TIMEOUT = config.getint(
+    'sales_reports', 'single_flight_timeout', default=300
+)
+# Number of seconds between two attempts to take a lock file
+POLL_INTERVAL = 0.2
+
+
+def dump_report(result, output):
+    """
+    Write the (extension, content, direct print, name) result of a report
+    to the output file
+    """
+    oext, content, direct_print, name = result
+    is_unicode = isinstance(content, unicode)
+    output.write(json.dumps([oext, direct_print, name, is_unicode]) + '\n')
+    output.write(content.encode('utf-8') if is_unicode else content)
+
+
+def load_report(input_):
+    """
+    Return the result of a report written by dump_report to the input file
+    """
+    oext, direct_print, name, is_unicode = json.loads(input_.readline())
+    content = input_.read()
+    if is_unicode:
+        content = content.decode('utf-8')
+    else:
+        content = bytearray(content)
+    return oext, content, direct_print, name
+
+
+def dump_reports(results, output):
+    """
+    Write the list of results of reports, or None, to the output file
+    """
+    headers, contents = [], []
+    for result in results:
+        if result is None:
+            headers.append(None)
+            continue
+        oext, content, direct_print, name = result
+        is_unicode = isinstance(content, unicode)
+        if is_unicode:
+            content = content.encode('utf-8')
+        headers.append([oext, direct_print, name, is_unicode, len(content)])
+        contents.append(content)
+    output.write(json.dumps(headers) + '\n')
+    for content in contents:
+        output.write(content)
+
+
+def load_reports(input_):
+    """
+    Return the list of results of reports written by dump_reports to the
+    input file
+    """
+    results = []
+    for header in json.loads(input_.readline()):
+        if header is None:
+            results.append(None)
+            continue
+        oext, direct_print, name, is_unicode, length = header
+        content = input_.read(length)
+        if is_unicode:
+            content = content.decode('utf-8')
+        else:
+            content = bytearray(content)
+        results.append((oext, content, direct_print, name))
+    return results
+
+
+class _Call(object):
+    "A call of SingleFlight.do waited on by the identical calls"
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight(object):
+    """
+    Run a function once for the concurrent calls with the same key: the
+    first call runs it while the others wait and receive its result.
+
+    With a directory, the calls of the other processes are serialized by a
+    lock file per key and the result is passed to them through a file
+    written with dump and read with load.
+    """
+
+    def __init__(
+            self, directory=None, timeout=SINGLE_FLIGHT_TIMEOUT,
+            dump=dump_report, load=load_report):
+        self.directory = directory
+        self.timeout = timeout
+        self.dump = dump
+        self.load = load
+        self._calls = {}
+        self._lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def do(self, key, function):
+        """
+        Return the result of function for the key, a string usable as a
+        file name, computed once for the concurrent calls. If the running
+        call fails or does not end within the timeout, the waiting calls
+        run function themselves.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if call.done.wait(self.timeout) and not call.failed:
+                return call.result
+            return function()
+
+        try:
+            call.result = self._do_shared(key, function)
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _do_shared(self, key, function):
+        """
+        Return the result of function run while holding the lock file of
+        the key, or the result written by another process which held it
+        while waiting
+        """
+        if not self.directory:
+            return function()
+
+        path = os.path.join(self.directory, key)
+        start = time.time()
+        with open(path + '.lock', 'a') as lock_file:
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError, exception:
+                    if exception.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() - start > self.timeout:
+                    logger.warning('Timeout waiting for the lock of %s', key)
+                    return function()
+                waited = True
+                time.sleep(POLL_INTERVAL)
+            try:
+                if waited:
+                    result = self._read_result(path + '.result', start)
+                    if result is not None:
+                        return result
+                os.utime(path + '.lock', None)
+                result = function()
+                self._write_result(path + '.result', result)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_result(self, path, start):
+        """
+        Return the result of the file if it was written after start,
+        otherwise None
+        """
+        try:
+            if os.path.getmtime(path) < start:
+                return None
+            with open(path, 'rb') as result_file:
+                return self.load(result_file)
+        except (IOError, OSError, ValueError):
+            logger.warning('Unable to read the result %s', path, exc_info=True)
+            return None
+
+    def _write_result(self, path, result):
+        """
+        Write the result to the file for the waiting processes and remove
+        the files which are too old to be waited on
+        """
+        try:
+            output = tempfile.NamedTemporaryFile(
+                dir=self.directory, prefix='.', delete=False
+            )
+            with output:
+                self.dump(result, output)
+            os.rename(output.name, path)
+        except (IOError, OSError):
+            logger.warning(
+                'Unable to write the result %s', path, exc_info=True
+            )
+        self.prune()
+
+    def prune(self):
+        """
+        Remove the lock and result files not used for twice the timeout
+        """
+        limit = time.time() - 2 * self.timeout
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
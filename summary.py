@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from decimal import Decimal
+
+from sql import Literal, Null
+from sql.aggregate import Count, Sum
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['SaleSummary', 'Sale', 'SaleLine']
+__metaclass__ = PoolMeta
+
+# States of the sales included in the summary and the report
+SUMMARY_STATES = ['confirmed', 'processing', 'done']
+
+
+class SaleSummary(ModelSQL):
+    """
+    Daily Sales Summary
+
+    Pre-aggregated totals of the confirmed, processing and done sales by
+    day, company, channel, party and currency. The rows without product
+    hold the amounts and number of the sales, the rows with a product hold
+    the quantity and untaxed amount of the lines of that product.
+    """
+    __name__ = 'report.sales.summary'
+
+    date = fields.Date('Date', required=True, readonly=True, select=True)
+    company = fields.Many2One(
+        'company.company', 'Company', required=True, readonly=True,
+        select=True
+    )
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', readonly=True, select=True
+    )
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, readonly=True, select=True
+    )
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', required=True, readonly=True
+    )
+    product = fields.Many2One(
+        'product.product', 'Product', readonly=True, select=True
+    )
+    sale_count = fields.Integer('Sales', readonly=True)
+    quantity = fields.Float('Quantity', readonly=True)
+    untaxed_amount = fields.Numeric(
+        'Untaxed', digits=(16, 4), readonly=True
+    )
+    tax_amount = fields.Numeric('Tax', digits=(16, 4), readonly=True)
+    total_amount = fields.Numeric('Total', digits=(16, 4), readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        created = not TableHandler.table_exist(cls._table)
+
+        super(SaleSummary, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        # Rows refreshed by date and party
+        table.index_action(['date', 'party'], 'add')
+
+        if created:
+            cls.rebuild()
+
+    @classmethod
+    def get_keys(cls, sales):
+        """
+        Return the set of (date, party id) keys of the summary rows
+        aggregating the given sales
+        """
+        return set(
+            (sale.sale_date, sale.party.id) for sale in sales
+            if sale.state in SUMMARY_STATES and sale.sale_date
+        )
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recompute the whole summary
+        """
+        cls._refresh(lambda date, party: Literal(True))
+
+    @classmethod
+    def refresh(cls, keys):
+        """
+        Recompute the summary rows of the given (date, party id) keys
+        """
+        parties_by_date = defaultdict(set)
+        for date, party_id in keys:
+            parties_by_date[date].add(party_id)
+
+        for date, party_ids in parties_by_date.iteritems():
+            party_ids = list(party_ids)
+            cls._refresh(
+                lambda date_column, party_column: (date_column == date)
+                & party_column.in_(party_ids)
+            )
+
+    @classmethod
+    def _refresh(cls, condition):
+        """
+        Delete and recompute the summary rows matching the condition
+        returned by condition for the date and party columns of the
+        summary and of the sale tables.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        sale = Sale.__table__()
+        line = SaleLine.__table__()
+
+        cursor.execute(*table.delete(
+            where=condition(table.date, table.party)
+        ))
+
+        keys = [
+            sale.sale_date, sale.company, sale.channel, sale.party,
+            sale.currency,
+        ]
+        columns = [
+            table.create_uid, table.create_date,
+            table.date, table.company, table.channel, table.party,
+            table.currency,
+        ]
+        where = (
+            condition(sale.sale_date, sale.party)
+            & sale.state.in_(SUMMARY_STATES)
+            & (sale.sale_date != Null)
+        )
+        cached = (
+            (sale.untaxed_amount_cache != Null)
+            & (sale.tax_amount_cache != Null)
+            & (sale.total_amount_cache != Null)
+        )
+        user = Transaction().user
+
+        cursor.execute(*table.insert(
+            columns + [
+                table.sale_count, table.untaxed_amount, table.tax_amount,
+                table.total_amount,
+            ],
+            sale.select(*[
+                Literal(user), CurrentTimestamp()] + keys + [
+                Count(Literal(1)),
+                Sum(sale.untaxed_amount_cache),
+                Sum(sale.tax_amount_cache),
+                Sum(sale.total_amount_cache),
+            ], where=where & cached, group_by=keys)
+        ))
+
+        cursor.execute(*sale.select(sale.id, where=where & ~cached))
+        uncached_ids = [row[0] for row in cursor.fetchall()]
+        if uncached_ids:
+            cls._insert_uncached(uncached_ids)
+
+        cursor.execute(*table.insert(
+            columns + [table.product, table.quantity, table.untaxed_amount],
+            line.join(
+                sale, condition=line.sale == sale.id
+            ).select(*[
+                Literal(user), CurrentTimestamp()] + keys + [
+                line.product,
+                Sum(line.quantity),
+                Sum(line.quantity * line.unit_price),
+            ], where=where & (line.product != Null),
+                group_by=keys + [line.product])
+        ))
+
+    @classmethod
+    def _insert_uncached(cls, sale_ids):
+        """
+        Insert the summary rows of sales without cached amounts, computing
+        the amounts from their lines in batch
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SalesReport = pool.get('report.sales', type='report')
+
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        user = Transaction().user
+
+        totals = defaultdict(
+            lambda: [0, Decimal('0'), Decimal('0'), Decimal('0')]
+        )
+        # The summary covers every sale whatever the access rules of the
+        # user triggering the refresh
+        with Transaction().set_user(0), Transaction().set_context(user=0):
+            amounts = SalesReport.get_sale_amounts(sale_ids)
+            for values in Sale.read(sale_ids, [
+                    'sale_date', 'company', 'channel', 'party', 'currency']):
+                key = (
+                    values['sale_date'], values['company'],
+                    values['channel'], values['party'], values['currency'],
+                )
+                sale_amounts = amounts[values['id']]
+                totals[key][0] += 1
+                totals[key][1] += sale_amounts.untaxed
+                totals[key][2] += sale_amounts.tax
+                totals[key][3] += sale_amounts.total
+
+        for key, (count, untaxed, tax, total) in totals.iteritems():
+            cursor.execute(*table.insert([
+                table.create_uid, table.create_date,
+                table.date, table.company, table.channel, table.party,
+                table.currency, table.sale_count, table.untaxed_amount,
+                table.tax_amount, table.total_amount,
+            ], [[user, CurrentTimestamp()] + list(key) + [
+                count, untaxed, tax, total]]))
+
+
+class Sale:
+    __name__ = 'sale.sale'
+
+    _summary_fields = set([
+        'state', 'sale_date', 'company', 'channel', 'party', 'currency',
+        'untaxed_amount_cache', 'tax_amount_cache', 'total_amount_cache',
+        'lines',
+    ])
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(Sale, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        # Sales searched by the report on state and date range, optionally
+        # with a channel or a party
+        table.index_action(['state', 'sale_date', 'channel'], 'add')
+        table.index_action(['party', 'state', 'sale_date'], 'add')
+
+    @classmethod
+    def create(cls, vlist):
+        Summary = Pool().get('report.sales.summary')
+
+        sales = super(Sale, cls).create(vlist)
+        Summary.refresh(Summary.get_keys(sales))
+        return sales
+
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('report.sales.summary')
+
+        actions = iter(args)
+        sales = []
+        for records, values in zip(actions, actions):
+            if cls._summary_fields & set(values):
+                sales.extend(records)
+        keys = Summary.get_keys(sales)
+
+        super(Sale, cls).write(*args)
+
+        if sales:
+            Summary.refresh(
+                keys | Summary.get_keys(cls.browse(map(int, sales)))
+            )
+
+    @classmethod
+    def delete(cls, sales):
+        Summary = Pool().get('report.sales.summary')
+
+        keys = Summary.get_keys(sales)
+        super(Sale, cls).delete(sales)
+        Summary.refresh(keys)
+
+
+class SaleLine:
+    __name__ = 'sale.line'
+
+    _summary_fields = set([
+        'sale', 'type', 'product', 'quantity', 'unit_price', 'taxes',
+    ])
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(SaleLine, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        # Quantities of the top products summed from the index only
+        table.index_action(['sale', 'product', 'quantity'], 'add')
+        # Sales searched by the report on a product
+        table.index_action(['product', 'sale'], 'add')
+
+    @classmethod
+    def get_summary_keys(cls, lines):
+        """
+        Return the set of (date, party id) keys of the summary rows
+        aggregating the sales of the given lines
+        """
+        Summary = Pool().get('report.sales.summary')
+
+        return Summary.get_keys(set(line.sale for line in lines))
+
+    @classmethod
+    def create(cls, vlist):
+        Summary = Pool().get('report.sales.summary')
+
+        lines = super(SaleLine, cls).create(vlist)
+        Summary.refresh(cls.get_summary_keys(lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('report.sales.summary')
+
+        actions = iter(args)
+        lines = []
+        for records, values in zip(actions, actions):
+            if cls._summary_fields & set(values):
+                lines.extend(records)
+        keys = cls.get_summary_keys(lines)
+
+        super(SaleLine, cls).write(*args)
+
+        if lines:
+            Summary.refresh(
+                keys | cls.get_summary_keys(cls.browse(map(int, lines)))
+            )
+
+    @classmethod
+    def delete(cls, lines):
+        Summary = Pool().get('report.sales.summary')
+
+        keys = cls.get_summary_keys(lines)
+        super(SaleLine, cls).delete(lines)
+        Summary.refresh(keys)
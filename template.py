@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import logging
+import threading
+
+from jinja2 import Environment, FunctionLoader, select_autoescape, meta
+from jinja2.bccache import BytecodeCache, FileSystemBytecodeCache
+
+from trytond.config import config
+from trytond.tools import file_open
+
+__all__ = [
+    'BYTECODE_CACHE', 'create_environment', 'from_string', 'load_template',
+    'warm_templates',
+]
+
+logger = logging.getLogger(__name__)
+
+# Directory in which the compiled templates are also stored, so that they
+# are shared by the server processes and kept across restarts
+TEMPLATE_CACHE_DIR = config.get(
+    'sales_reports', 'template_cache_dir', default=None
+)
+# Number of templates compiled from strings kept per environment
+STRING_TEMPLATES = 32
+
+
+class TemplateBytecodeCache(BytecodeCache):
+    """
+    Keep the compiled code of the templates in memory, and in directory
+    when given. An entry is used only if the source of the template has the
+    same checksum as when it was compiled.
+    """
+
+    def __init__(self, directory=None):
+        self._codes = {}
+        self._lock = threading.Lock()
+        self.file_cache = None
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.file_cache = FileSystemBytecodeCache(
+                directory, '__sales_reports_%s.cache'
+            )
+
+    def load_bytecode(self, bucket):
+        checksum, code = self._codes.get(bucket.key, (None, None))
+        if checksum == bucket.checksum:
+            bucket.code = code
+            return
+        if self.file_cache is not None:
+            self.file_cache.load_bytecode(bucket)
+            if bucket.code is not None:
+                with self._lock:
+                    self._codes[bucket.key] = (bucket.checksum, bucket.code)
+
+    def dump_bytecode(self, bucket):
+        with self._lock:
+            self._codes[bucket.key] = (bucket.checksum, bucket.code)
+        if self.file_cache is not None:
+            try:
+                self.file_cache.dump_bytecode(bucket)
+            except (IOError, OSError):
+                logger.warning(
+                    'Unable to store the compiled template %s', bucket.key,
+                    exc_info=True
+                )
+
+    def clear(self):
+        with self._lock:
+            self._codes.clear()
+        if self.file_cache is not None:
+            self.file_cache.clear()
+
+
+BYTECODE_CACHE = TemplateBytecodeCache(TEMPLATE_CACHE_DIR)
+
+
+def _placeholder_filter(*args, **kwargs):
+    # Raising prevents the optimizer from calling the filter at compile time
+    raise RuntimeError('Template filter called while warming the templates')
+
+
+class PlaceholderFilters(dict):
+    """
+    The filters of an environment compiling templates outside of any
+    transaction. The filters which are not known are given a placeholder,
+    as the compiled code looks the filters up when it is rendered. Such
+    filters must not be context, eval context or environment filters.
+    """
+
+    def get(self, key, default=None):
+        return dict.get(self, key, _placeholder_filter)
+
+
+def load_template(name):
+    """
+    Return the source, file name and up-to-date function of the template
+    named <module_name>/path/to/template. The template is reloaded when the
+    modification time of its file changes.
+    """
+    module, path = name.split('/', 1)
+    try:
+        with file_open(os.path.join(module, path)) as template_file:
+            source = template_file.read()
+            filename = template_file.name
+    except IOError:
+        return None
+    mtime = os.path.getmtime(filename)
+
+    def uptodate():
+        try:
+            return os.path.getmtime(filename) == mtime
+        except OSError:
+            return False
+    return source.decode('utf-8'), filename, uptodate
+
+
+def create_environment(loader_func):
+    """
+    Return a jinja environment loading the templates with loader_func and
+    sharing the compiled templates of the process
+    """
+    env = Environment(
+        loader=FunctionLoader(loader_func),
+        autoescape=select_autoescape(['html', 'xml']),
+        extensions=['jinja2.ext.loopcontrols'],
+        bytecode_cache=BYTECODE_CACHE,
+        auto_reload=True,
+    )
+    env.string_templates = {}
+    return env
+
+
+def from_string(env, source):
+    """
+    Return the template compiled from source, compiling each source only
+    once per environment
+    """
+    if isinstance(source, unicode):
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    else:
+        key = hashlib.sha1(source).hexdigest()
+        source = source.decode('utf-8')
+    template = env.string_templates.get(key)
+    if template is None:
+        template = env.from_string(source)
+        if len(env.string_templates) >= STRING_TEMPLATES:
+            env.string_templates.clear()
+        env.string_templates[key] = template
+    return template
+
+
+def warm_templates(names, loader_func=load_template):
+    """
+    Compile the templates and the templates they extend or include into
+    the bytecode cache, so that the first report rendered by the process
+    does not compile them
+    """
+    env = create_environment(loader_func)
+    env.filters = PlaceholderFilters(env.filters)
+    names = list(names)
+    seen = set()
+    while names:
+        name = names.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            source, _, _ = env.loader.get_source(env, name)
+            env.get_template(name)
+        except Exception:
+            logger.warning(
+                'Unable to compile the template %s', name, exc_info=True
+            )
+            continue
+        names.extend(
+            n for n in meta.find_referenced_templates(env.parse(source))
+            if n is not None
+        )
+    return seen
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the sales report.
+
+Generates growing volumes of sales and times each phase of the report at
+every volume. The volumes are read from the BENCHMARK_ORDERS environment
+variable as comma separated numbers of orders, and the results are written
+as JSON to the file named by BENCHMARK_OUTPUT or to the standard output.
+
+Run it with:
+
+    python setup.py benchmark --orders=1000,10000,100000 --output=bench.json
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import unittest
+from decimal import Decimal
+
+import trytond.tests.test_tryton
+from trytond import backend
+from trytond.tests.test_tryton import POOL, USER, with_transaction
+from trytond.transaction import Transaction
+
+from test_base import BaseTestCase
+from trytond.modules.sales_reports.sale import HTMLFile, SaleStream
+
+# Number of sales created at once by the generator
+BATCH_SIZE = 500
+
+
+class SalesReportBenchmark(BaseTestCase):
+    """
+    Benchmark of the sales report
+    """
+
+    def setup_volumes(
+            self, gateways=2, currencies=2, channels=2, parties=50,
+            products=20):
+        """
+        Create the gateways, currencies, channels, parties and products
+        the generated sales are spread over, in addition to the defaults
+        """
+        self.setup_defaults()
+
+        self.gateways = [self.cash_gateway] + self.PaymentGateway.create([{
+            'name': 'Gateway %s' % i,
+            'journal': self.cash_journal.id,
+            'provider': 'self',
+            'method': 'manual',
+        } for i in range(1, gateways)])
+
+        self.currencies = [self.currency] + self.Currency.create([{
+            'name': 'Currency %s' % i,
+            'code': 'C%02d' % i,
+            'symbol': 'C%02d' % i,
+        } for i in range(1, currencies)])
+
+        with Transaction().set_context(company=self.company.id):
+            self.channels = [self.channel] + self.Channel.create([{
+                'name': 'Channel %s' % i,
+                'price_list': self.price_list,
+                'invoice_method': 'order',
+                'shipment_method': 'order',
+                'source': 'manual',
+                'create_users': [('add', [USER])],
+                'warehouse': self.warehouse,
+                'payment_term': self.payment_term,
+            } for i in range(1, channels)])
+        # The allowed channels of the user are in its cached preferences
+        self.User._get_preferences_cache.clear()
+        Transaction().context.update(
+            self.User.get_preferences(context_only=True))
+
+        self.parties = [self.party] + self.Party.create([{
+            'name': 'Customer %s' % i,
+            'addresses': [('create', [{
+                'name': 'Customer %s' % i,
+                'city': 'Gotham',
+                'country': self.country.id,
+            }])],
+        } for i in range(1, parties)])
+
+        template, = self.ProductTemplate.create([{
+            'name': 'Benchmark Product',
+            'type': 'goods',
+            'list_price': Decimal('20'),
+            'cost_price': Decimal('15'),
+            'default_uom': self.uom.id,
+            'salable': True,
+            'sale_uom': self.uom.id,
+            'account_revenue': self.product_template.account_revenue.id,
+        }])
+        self.products = [self.product] + self.Product.create([{
+            'template': template.id,
+            'code': 'BENCH%s' % i,
+        } for i in range(1, products)])
+        self.generated = 0
+
+    def generate_sales(self, orders, lines=3, payments=1, days=365):
+        """
+        Create confirmed sales, with their lines and payments, until orders
+        sales have been generated. The sales are spread over the last days
+        and over the gateways, currencies, channels, parties and products
+        of setup_volumes.
+        """
+        today = datetime.date.today()
+
+        while self.generated < orders:
+            start = self.generated
+            count = min(BATCH_SIZE, orders - start)
+            vlist = []
+            for i in xrange(start, start + count):
+                party = self.parties[i % len(self.parties)]
+                lines_values = [{
+                    'type': 'line',
+                    'quantity': (i + j) % 5 + 1,
+                    'product': self.products[
+                        (i + j) % len(self.products)].id,
+                    'unit': self.uom.id,
+                    'unit_price': Decimal((i + j) % 90 + 10),
+                    'description': 'Benchmark line',
+                } for j in range(lines)]
+                # The lines have no tax, so the cached amounts are set
+                # without computing them from the lines
+                amount = sum(
+                    l['unit_price'] * l['quantity'] for l in lines_values
+                )
+                vlist.append({
+                    'reference': 'Benchmark %s' % i,
+                    'payment_term': self.payment_term.id,
+                    'currency': self.currencies[i % len(self.currencies)].id,
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'sale_date': today - datetime.timedelta(days=i % days),
+                    'state': 'confirmed',
+                    'channel': self.channels[i % len(self.channels)].id,
+                    'untaxed_amount_cache': amount,
+                    'tax_amount_cache': Decimal('0'),
+                    'total_amount_cache': amount,
+                    'lines': [('create', lines_values)],
+                })
+            sales = self.Sale.create(vlist)
+
+            if payments:
+                self.SalePayment.create([{
+                    'sale': sale.id,
+                    'amount': (
+                        values['total_amount_cache'] / payments
+                    ).quantize(Decimal('0.01')),
+                    'gateway': self.gateways[
+                        (sale.id + k) % len(self.gateways)].id,
+                    'credit_account': self.parties[
+                        (start + n) % len(self.parties)
+                    ].account_receivable.id,
+                } for n, (sale, values) in enumerate(zip(sales, vlist))
+                    for k in range(payments)])
+            self.generated += count
+
+    def run_phases(self, data):
+        """
+        Run the report for the data and return the duration in seconds of
+        each phase. The PDF conversion is None if it is not available.
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        ActionReport = POOL.get('ir.action.report')
+
+        phases = {}
+
+        def timed(name, function, *args):
+            start = time.time()
+            result = function(*args)
+            phases[name] = time.time() - start
+            return result
+
+        def search():
+            sale_query = self.Sale.search(
+                SalesReport.get_sale_domain(data), order=[], query=True
+            )
+            len(SaleStream(SalesReport, sale_query))
+            return sale_query
+
+        sale_query = timed('search', search)
+
+        summary_query = None
+        if SalesReport.use_summary(data):
+            summary_query = SalesReport.get_summary_query(data)
+            timed(
+                'aggregation', SalesReport.get_sales_by_currency_from_summary,
+                summary_query, sale_query
+            )
+        else:
+            timed('aggregation', SalesReport.get_sales_by_currency, sale_query)
+        timed('payments', SalesReport.get_payments, sale_query)
+        timed(
+            'top_products', SalesReport.get_top_products, data, sale_query,
+            summary_query
+        )
+        timed('rows', lambda: list(SaleStream(SalesReport, sale_query)))
+
+        action_report, = ActionReport.search([
+            ('report_name', '=', SalesReport.__name__),
+        ])
+        context = timed('context', SalesReport.get_context, None, data)
+        html = timed('render', SalesReport.render, action_report, context)
+        if isinstance(html, HTMLFile):
+            html = html.read()
+
+        try:
+            timed('pdf', SalesReport.html_to_pdf, html)
+        except Exception, exception:
+            phases['pdf'] = None
+            phases['pdf_error'] = str(exception)
+        phases['html_bytes'] = len(html)
+        return phases
+
+    @with_transaction()
+    def test_benchmark(self):
+        """
+        Benchmark the report at each volume of BENCHMARK_ORDERS
+        """
+        volumes = sorted(
+            int(v) for v in os.environ.get('BENCHMARK_ORDERS', '50').split(',')
+        )
+        results = []
+
+        self.setup_volumes()
+        with Transaction().set_context(company=self.company.id):
+            for orders in volumes:
+                start = time.time()
+                self.generate_sales(orders)
+                generation = time.time() - start
+
+                data = {
+                    'start_date': datetime.date.today() - datetime.timedelta(
+                        days=365),
+                    'end_date': datetime.date.today(),
+                    'customer': None,
+                    'product': None,
+                    'channel': None,
+                    'detailed_payments': True,
+                }
+                phases = self.run_phases(data)
+                self.assertTrue(phases['html_bytes'])
+                results.append({
+                    'orders': orders,
+                    'backend': backend.name(),
+                    'generation': generation,
+                    'phases': phases,
+                })
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if os.environ.get('BENCHMARK_OUTPUT'):
+            with open(os.environ['BENCHMARK_OUTPUT'], 'w') as output_file:
+                output_file.write(output)
+        else:
+            sys.stdout.write(output + '\n')
+
+
+def suite():
+    "Define suite"
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(SalesReportBenchmark)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
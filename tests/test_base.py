@@ -2,6 +2,7 @@
 import sys
 import os
 from decimal import Decimal
+from datetime import date
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, ModuleTestCase
@@ -56,6 +57,9 @@ class BaseTestCase(ModuleTestCase):
         self.Channel = POOL.get('sale.channel')
         self.PriceList = POOL.get('product.price_list')
         self.PaymentTerm = POOL.get('account.invoice.payment_term')
+        self.Journal = POOL.get('account.journal')
+        self.PaymentGateway = POOL.get('payment_gateway.gateway')
+        self.SalePayment = POOL.get('sale.payment')
 
     def _create_coa_minimal(self, company):
         """Create a minimal chart of accounts
@@ -224,3 +228,51 @@ class BaseTestCase(ModuleTestCase):
                 'warehouse': self.warehouse,
                 'payment_term': self.payment_term,
             }])
+
+        self.cash_journal, = self.Journal.search(
+            [('type', '=', 'cash')], limit=1
+        )
+        self.cash_gateway, = self.PaymentGateway.create([{
+            'name': 'Cash Gateway',
+            'journal': self.cash_journal.id,
+            'provider': 'self',
+            'method': 'manual',
+        }])
+
+    def create_sale(self, quantity=2, unit_price=Decimal('10000'), **values):
+        """Creates a confirmed sale with one line of the default product
+        """
+        sale_values = {
+            'reference': 'Test Sale',
+            'payment_term': self.payment_term.id,
+            'currency': self.company.currency.id,
+            'party': self.party.id,
+            'invoice_address': self.party.addresses[0],
+            'sale_date': date.today(),
+            'state': 'confirmed',
+            'shipment_address': self.party.addresses[0],
+            'channel': self.channel.id,
+        }
+        sale_values.update(values)
+        sale, = self.Sale.create([sale_values])
+        self.SaleLine.create([{
+            'type': 'line',
+            'quantity': quantity,
+            'product': self.product,
+            'unit': self.uom,
+            'unit_price': unit_price,
+            'description': 'Test description',
+            'sale': sale.id,
+        }])
+        return sale
+
+    def create_payment(self, sale, amount, gateway=None):
+        """Creates a payment for the sale
+        """
+        payment, = self.SalePayment.create([{
+            'sale': sale.id,
+            'amount': amount,
+            'gateway': gateway or self.cash_gateway,
+            'credit_account': self.party.account_receivable.id,
+        }])
+        return payment
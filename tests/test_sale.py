@@ -2,13 +2,37 @@
 import unittest
 import sys
 import os
-from datetime import date
+import csv
+import zipfile
+import time
+import shutil
+import tempfile
+import sqlite3
+import threading
+from StringIO import StringIO
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import POOL, with_transaction
+from trytond.tests.test_tryton import POOL, USER, with_transaction
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 from trytond.pool import Pool
+from trytond.config import config
+from trytond import backend
 from test_base import BaseTestCase
+from trytond.modules.sales_reports.sale import SaleStream, SEQUENTIAL_SCAN
+from trytond.modules.sales_reports import instrument, replica, \
+    parallel, renderer, definition as definition_module, job as job_module, \
+    sale as sale_module
+from trytond.modules.sales_reports.instrument import ReportProfile, \
+    CountingConnection
+from trytond.modules.sales_reports.export import can_export
+from trytond.modules.sales_reports.template import BYTECODE_CACHE, \
+    warm_templates
+from trytond.modules.sales_reports.renderer import RendererPool, \
+    RendererBusy, PDFRenderer, WkhtmltopdfRenderer, WeasyPrintRenderer
+from trytond.modules.sales_reports.singleflight import SingleFlight
 
 DIR = os.path.abspath(os.path.normpath(os.path.join(
     __file__, '..', '..', '..', '..', '..', 'trytond'
@@ -120,6 +144,1681 @@ class TestSale(BaseTestCase):
             # Assert report name
             self.assertEqual(val[3], 'Sales Report')
 
+    @with_transaction()
+    def test_0020_test_sales_by_currency(self):
+        """
+        Test the per currency totals computed in SQL match the ORM
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            cached_sale = self.create_sale(quantity=1)
+            self.Sale.store_cache([cached_sale])
+            uncached_sale = self.create_sale(quantity=3)
+            self.create_payment(cached_sale, Decimal('4000'))
+            self.create_payment(uncached_sale, Decimal('1000'))
+
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+            }
+            sales = self.Sale.search(SalesReport.get_sale_domain(data))
+            sale_query = self.Sale.search(
+                SalesReport.get_sale_domain(data), order=[], query=True
+            )
+
+            expected = SalesReport._get_sales_by_currency_orm(sales)
+            result = SalesReport.get_sales_by_currency(sale_query)
+
+            self.assertEqual(result.keys(), [self.company.currency])
+            for name in ('untaxed', 'tax', 'total', 'payment_available'):
+                self.assertEqual(
+                    result[self.company.currency][name],
+                    expected[self.company.currency][name]
+                )
+            self.assertEqual(
+                result[self.company.currency]['total'], Decimal('40000')
+            )
+            self.assertEqual(
+                result[self.company.currency]['payment_available'],
+                Decimal('5000')
+            )
+
+    @with_transaction()
+    def test_0030_test_payments(self):
+        """
+        Test the payments grouped by sale, gateway and currency
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sale1 = self.create_sale()
+            sale2 = self.create_sale()
+            self.create_payment(sale1, Decimal('100'))
+            self.create_payment(sale1, Decimal('50'))
+            self.create_payment(sale2, Decimal('25'))
+
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+            }
+            gateways, pbgc, pbc, pbsg = SalesReport.get_payments(
+                self.Sale.search(
+                    SalesReport.get_sale_domain(data), order=[], query=True
+                )
+            )
+
+            currency = self.company.currency
+            self.assertEqual(gateways, set([self.cash_gateway]))
+            self.assertEqual(
+                pbgc[self.cash_gateway][currency], Decimal('175')
+            )
+            self.assertEqual(pbc[currency], Decimal('175'))
+            self.assertEqual(
+                pbsg[sale1.id][self.cash_gateway.id], Decimal('150')
+            )
+            self.assertEqual(
+                pbsg[sale2.id][self.cash_gateway.id], Decimal('25')
+            )
+
+            # The payments by sale are only computed for detailed payments
+            gateways, pbgc, pbc, pbsg = SalesReport.get_payments(
+                self.Sale.search(
+                    SalesReport.get_sale_domain(data), order=[], query=True
+                ), detailed=False
+            )
+            self.assertEqual(
+                pbgc[self.cash_gateway][currency], Decimal('175')
+            )
+            self.assertEqual(pbc[currency], Decimal('175'))
+            self.assertEqual(pbsg, {})
+
+            # The available amounts are summed for the given sales only
+            self.assertEqual(
+                SalesReport.get_payment_available([sale1.id]),
+                {sale1.id: Decimal('150')}
+            )
+            self.assertEqual(
+                SalesReport.get_payment_available([sale1.id, sale2.id]),
+                {sale1.id: Decimal('150'), sale2.id: Decimal('25')}
+            )
+
+    @with_transaction()
+    def test_0040_test_streaming_report(self):
+        """
+        Test the report rendered in streaming mode
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        ActionReport = POOL.get('ir.action.report')
+
+        self.setup_defaults()
+        sales_report_action, = ActionReport.search([
+            ('report_name', '=', 'report.sales'),
+        ])
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sales = [
+                self.create_sale(sale_date=date(2016, 1, day))
+                for day in (1, 2, 2, 3)
+            ]
+            for sale in sales:
+                sale.number = 'SO-%d' % sale.id
+                sale.save()
+
+            stream = SaleStream(
+                SalesReport, self.Sale.search([], order=[], query=True),
+                batch_size=3
+            )
+            self.assertEqual(len(stream), 4)
+            self.assertEqual(
+                [s.id for s in stream],
+                [sales[3].id, sales[2].id, sales[1].id, sales[0].id]
+            )
+            self.Sale.store_cache(sales[:2])
+            # A payment in each batch of the stream
+            self.create_payment(sales[0], Decimal('300'))
+            self.create_payment(sales[2], Decimal('20'))
+            for row in stream:
+                sale = self.Sale(row.id)
+                self.assertEqual(row.number, sale.number)
+                self.assertEqual(row.sale_date, sale.sale_date)
+                self.assertEqual(row.party_name, sale.party.rec_name)
+                self.assertEqual(row.currency_code, sale.currency.code)
+                self.assertEqual(row.untaxed_amount, sale.untaxed_amount)
+                self.assertEqual(row.tax_amount, sale.tax_amount)
+                self.assertEqual(row.total_amount, sale.total_amount)
+                self.assertEqual(
+                    row.payment_available, sale.payment_available
+                )
+                self.assertEqual(row.state, sale.state)
+
+            data = {
+                'start_date': date(2016, 1, 1),
+                'end_date': date(2016, 1, 31),
+                'product': self.product.id,
+                'streaming': True,
+            }
+            report_context = SalesReport.get_context([], data)
+            self.assertTrue(report_context['stream_html'])
+
+            val = SalesReport.execute([], data)
+            self.assertEqual(val[0], sales_report_action.template_extension)
+            for sale in sales:
+                self.assertIn(sale.number, str(val[1]))
+
+            # The parties without name are displayed by their code if any
+            party = self.Party.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*party.update(
+                [party.name, party.code], [None, 'C1'],
+                where=party.id == self.party.id
+            ))
+            self.assertEqual(set(r.party_name for r in stream), set(['[C1]']))
+            cursor.execute(*party.update(
+                [party.code], [None], where=party.id == self.party.id
+            ))
+            self.assertEqual(set(r.party_name for r in stream), set(['']))
+
+    @with_transaction()
+    def test_0050_test_sales_summary(self):
+        """
+        Test the daily sales summary is refreshed with the sales
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        Summary = POOL.get('report.sales.summary')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sale1 = self.create_sale(quantity=1)
+            sale2 = self.create_sale(quantity=3)
+            self.Sale.store_cache([sale1])
+            self.create_sale(quantity=5, state='draft')
+
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'channel': self.channel.id,
+            }
+            sale_query = self.Sale.search(
+                SalesReport.get_sale_domain(data), order=[], query=True
+            )
+
+            def check_summary():
+                summary_query = SalesReport.get_summary_query(data)
+                expected = SalesReport.get_sales_by_currency(sale_query)
+                result = SalesReport.get_sales_by_currency_from_summary(
+                    summary_query, sale_query
+                )
+                self.assertEqual(result.keys(), expected.keys())
+                for currency in expected:
+                    for name in ('untaxed', 'tax', 'total'):
+                        self.assertEqual(
+                            result[currency][name], expected[currency][name]
+                        )
+                return summary_query
+
+            summary_query = check_summary()
+            self.assertEqual(
+                SalesReport.get_top_products_from_summary(summary_query),
+                [(self.product, 4, [(self.currency, Decimal('40000'))])]
+            )
+
+            self.Sale.write([sale2], {'state': 'cancel'})
+            summary_query = check_summary()
+            self.assertEqual(
+                SalesReport.get_top_products_from_summary(summary_query),
+                [(self.product, 1, [(self.currency, Decimal('10000'))])]
+            )
+
+            Summary.rebuild()
+            summary, = Summary.search([('product', '=', None)])
+            self.assertEqual(summary.sale_count, 1)
+            self.assertEqual(summary.total_amount, Decimal('10000'))
+
+    @with_transaction()
+    def test_0060_test_report_cache(self):
+        """
+        Test the rendered report is cached until a matching sale changes
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sale = self.create_sale()
+
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'product': self.product.id,
+            }
+            result = SalesReport.execute([], data)
+            self.assertIs(SalesReport.execute([], data), result)
+
+            self.create_payment(sale, Decimal('100'))
+            result2 = SalesReport.execute([], data)
+            self.assertIsNot(result2, result)
+            self.assertIs(SalesReport.execute([], data), result2)
+
+            self.create_sale()
+            self.assertIsNot(SalesReport.execute([], data), result2)
+
+    @with_transaction()
+    def test_0070_test_background_report(self):
+        """
+        Test the sales report generated in background
+        """
+        ReportWizard = POOL.get('report.sales.wizard', type="wizard")
+        Job = POOL.get('report.sales.job')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            self.create_sale()
+
+            session_id, start_state, end_state = ReportWizard.create()
+            data = {
+                start_state: {
+                    'customer': None,
+                    'channel': None,
+                    'product': self.product.id,
+                    'start_date': date.today(),
+                    'end_date': date.today(),
+                    'detailed_payments': False,
+                    'background': True,
+                },
+            }
+            result = ReportWizard.execute(session_id, data, 'generate')
+            self.assertNotIn('actions', result)
+            self.assertEqual(result['view']['state'], 'status')
+            self.assertEqual(result['view']['defaults']['state'], 'queued')
+
+            job, = Job.search([])
+            self.assertEqual(job.get_data()['start_date'], date.today())
+
+            # The jobs are queued by the wizard only, not by the clients
+            with Transaction().set_context(_check_access=True):
+                self.assertRaises(UserError, Job.create, [{
+                    'name': 'Forged Report',
+                    'data': job.data,
+                    'data_key': job.data_key,
+                    'state': 'done',
+                }])
+                session_id2, _, _ = ReportWizard.create()
+                ReportWizard.execute(session_id2, data, 'generate')
+            self.assertEqual(Job.search([], count=True), 2)
+            Job.delete(Job.search([('id', '!=', job.id)]))
+
+            self.assertEqual(Job.pop(), job.id)
+            self.assertEqual(Job.pop(), None)
+            # The jobs left running by a stopped server are queued again
+            Job.write([job], {
+                'started': datetime.now() - timedelta(
+                    seconds=job_module.JOB_TIMEOUT + 60),
+            })
+            self.assertEqual(Job.pop(), job.id)
+            self.assertEqual(Job.pop(), None)
+            Job.process([job])
+            self.assertEqual(job.state, 'done')
+            self.assertTrue(job.output)
+
+            result = ReportWizard.execute(session_id, {
+                'status': result['view']['defaults'],
+            }, 'status')
+            self.assertEqual(result['view']['defaults']['state'], 'done')
+
+            result = ReportWizard.execute(session_id, {}, 'open_')
+            report_name = result['actions'][0][0]['report_name']
+            report_data = result['actions'][0][1]
+            JobOutput = POOL.get(report_name, type='report')
+            oext, content, _, name = JobOutput.execute([], report_data)
+            self.assertEqual(content, job.output)
+            self.assertEqual(name, 'Sales Report')
+
+    @with_transaction()
+    def test_0080_pdf_renderers(self):
+        """
+        Test the PDF options of the backends and the renderer pool
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            options = SalesReport.get_pdf_options()
+
+        args = WkhtmltopdfRenderer().get_arguments(options)
+        self.assertIn('--footer-line', args)
+        self.assertEqual(
+            args[args.index('--footer-right') + 1], '[page]/[toPage]'
+        )
+        self.assertEqual(
+            args[args.index('--margin-top') + 1], '0.50in'
+        )
+
+        options['footer_left'] = u'Openlabs "Inc"'
+        stylesheet = WeasyPrintRenderer().get_stylesheet(options)
+        self.assertIn('size: Letter;', stylesheet)
+        self.assertIn('margin: 0.50in 0.50in 0.50in 0.50in;', stylesheet)
+        self.assertIn(
+            'content: counter(page) "/" counter(pages);', stylesheet
+        )
+        self.assertIn(r'content: "Openlabs \"Inc\"";', stylesheet)
+
+        pool = RendererPool(1, 0, 0)
+        with pool.slot():
+            self.assertRaises(RendererBusy, pool.acquire)
+        with pool.slot():
+            pass
+
+        pool = RendererPool(1, 1, 0)
+        with pool.slot():
+            self.assertRaises(RendererBusy, pool.acquire)
+        self.assertEqual(pool._waiting, 0)
+        self.assertEqual(pool._running, 0)
+
+        # The reports waiting too long for a renderer are refused
+        default_pool = renderer.RENDERER_POOL
+        try:
+            renderer.RENDERER_POOL = pool
+            with pool.slot():
+                self.assertRaises(
+                    UserError, SalesReport.html_to_pdf, '<html></html>',
+                    options
+                )
+            self.assertEqual(pool._running, 0)
+        finally:
+            renderer.RENDERER_POOL = default_pool
+
+        # The engines must implement render
+        self.assertRaises(TypeError, PDFRenderer)
+
+    @with_transaction()
+    def test_0090_test_parallel_sections(self):
+        """
+        Test the sections computed by shards match the serial computation
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sale1 = self.create_sale(quantity=1)
+            sale2 = self.create_sale(
+                quantity=3, sale_date=date.today() - timedelta(days=40)
+            )
+            self.Sale.store_cache([sale1])
+            self.create_payment(sale1, Decimal('5000'))
+            self.create_payment(sale2, Decimal('7000'))
+
+            data = {
+                'start_date': date.today() - timedelta(days=60),
+                'end_date': date.today(),
+                'channel': self.channel.id,
+                'detailed_payments': True,
+            }
+            self.assertEqual(len(SalesReport.start_parallel_sections(
+                data).get()), 3)
+
+            serial = SalesReport.get_context([], dict(data, parallel=False))
+            parallel = SalesReport.get_context([], dict(data, parallel=True))
+
+            currency = self.company.currency
+            for name in ('untaxed', 'tax', 'total', 'payment_available'):
+                self.assertEqual(
+                    parallel['sales_by_currency'][currency][name],
+                    serial['sales_by_currency'][currency][name]
+                )
+            self.assertEqual(
+                parallel['pbc'][currency], Decimal('12000')
+            )
+            self.assertEqual(
+                parallel['pbgc'][self.cash_gateway][currency],
+                Decimal('12000')
+            )
+            self.assertEqual(parallel['gateways'], set([self.cash_gateway]))
+            self.assertEqual(
+                parallel['pbsg'][sale2.id][self.cash_gateway.id],
+                Decimal('7000')
+            )
+            self.assertEqual(
+                parallel['top_10_products'], serial['top_10_products']
+            )
+            self.assertEqual(
+                [s.id for s in parallel['sales']],
+                [s.id for s in serial['sales']]
+            )
+
+    @with_transaction()
+    def test_0095_test_parallel_workers(self):
+        """
+        Test the sections computed by the worker threads match the serial
+        computation
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sale1 = self.create_sale(quantity=1)
+            sale2 = self.create_sale(
+                quantity=3, sale_date=date.today() - timedelta(days=40)
+            )
+            self.Sale.store_cache([sale1])
+            self.create_payment(sale1, Decimal('5000'))
+            self.create_payment(sale2, Decimal('7000'))
+            context = dict(Transaction().context)
+
+            # The memory database is not shared with the worker threads, so
+            # the report is computed on a copy of it
+            directory = tempfile.mkdtemp()
+            path = config.get('database', 'path')
+            config.set('database', 'path', directory)
+            copy = sqlite3.connect(os.path.join(directory, 'shards.sqlite'))
+            copy.executescript(
+                '\n'.join(Transaction().connection.iterdump())
+            )
+            copy.close()
+
+        data = {
+            'start_date': date.today() - timedelta(days=60),
+            'end_date': date.today(),
+            'channel': self.channel.id,
+            'detailed_payments': True,
+        }
+        currency_id = self.company.currency.id
+        gateway_id = self.cash_gateway.id
+        try:
+            parallel.PARALLEL_WORKERS = 2
+            Pool('shards').init()
+            with Transaction(new=True).start(
+                    'shards', USER, readonly=True, context=context):
+                SalesReport = Pool().get('report.sales', type='report')
+
+                results = SalesReport.start_parallel_sections(data)
+                self.assertNotIsInstance(results, parallel.TaskResults)
+                self.assertEqual(len(results.get()), 3)
+
+                serial = SalesReport.get_context(
+                    [], dict(data, parallel=False)
+                )
+                sharded = SalesReport.get_context(
+                    [], dict(data, parallel=True)
+                )
+                self.assertEqual(
+                    [c.id for c in sharded['sales_by_currency']],
+                    [currency_id]
+                )
+                serial_totals, = serial['sales_by_currency'].values()
+                sharded_totals, = sharded['sales_by_currency'].values()
+                for name in (
+                        'untaxed', 'tax', 'total', 'payment_available'):
+                    self.assertEqual(
+                        sharded_totals[name], serial_totals[name]
+                    )
+                self.assertEqual(
+                    dict((c.id, v) for c, v in sharded['pbc'].iteritems()),
+                    {currency_id: Decimal('12000')}
+                )
+                self.assertEqual(
+                    [g.id for g in sharded['gateways']], [gateway_id]
+                )
+                self.assertEqual(
+                    sharded['pbsg'][sale2.id][gateway_id], Decimal('7000')
+                )
+                self.assertEqual(
+                    [(p.product.id, p.quantity, p.revenues)
+                        for p in sharded['top_10_products']],
+                    [(p.product.id, p.quantity, p.revenues)
+                        for p in serial['top_10_products']]
+                )
+                self.assertEqual(
+                    [s.id for s in sharded['sales']],
+                    [s.id for s in serial['sales']]
+                )
+        finally:
+            parallel.PARALLEL_WORKERS = 0
+            if parallel._thread_pool is not None:
+                parallel._thread_pool.close()
+                parallel._thread_pool = None
+            config.set('database', 'path', path)
+            shutil.rmtree(directory)
+
+    @with_transaction()
+    def test_0100_test_report_profile(self):
+        """
+        Test the phases of the report are recorded and passed to the hooks
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            self.create_sale()
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'debug': True,
+            }
+
+            profiles = []
+            instrument.subscribe(profiles.append)
+            try:
+                oext, content, _, _ = SalesReport.execute([], data)
+            finally:
+                instrument.unsubscribe(profiles.append)
+
+            report_profile, = profiles
+            self.assertEqual(
+                [p['name'] for p in report_profile.phases],
+                ['search', 'orders', 'totals', 'payments', 'top_products',
+                    'render']
+            )
+            search = report_profile.phases[0]
+            self.assertTrue(search['queries'])
+            self.assertEqual(search['rows'], 1)
+            self.assertGreaterEqual(report_profile.queries, sum(
+                p['queries'] for p in report_profile.phases
+            ))
+            self.assertIn('search', report_profile.format())
+            self.assertIn('Profile', content.decode('utf-8'))
+            self.assertIsNone(instrument.current_profile())
+
+            # Not instrumented without hook nor debug
+            del data['debug']
+            SalesReport.execute([], data)
+            self.assertEqual(len(profiles), 1)
+
+    @with_transaction()
+    def test_0110_test_query_plans(self):
+        """
+        Test the queries of the report use the indexes of the module
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            self.create_sale()
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'channel': self.channel.id,
+            }
+            self.assertEqual(SalesReport.check_query_plans(data), {})
+            del data['channel']
+            self.assertEqual(SalesReport.check_query_plans(data), {})
+            self.assertEqual(SalesReport.check_query_plans(
+                dict(data, product=self.product.id)), {})
+
+        pattern = SEQUENTIAL_SCAN['sqlite']
+        self.assertEqual(
+            pattern.search('SCAN TABLE sale_line').group(1), 'sale_line'
+        )
+        self.assertEqual(pattern.search('SCAN sale_sale').group(1), 'sale_sale')
+        self.assertIsNone(
+            pattern.search('SCAN sale_line USING COVERING INDEX sale_index')
+        )
+        self.assertEqual(
+            SEQUENTIAL_SCAN['postgresql'].search(
+                '->  Seq Scan on sale_sale a  (cost=0.00..1.01 rows=1)'
+            ).group(1), 'sale_sale'
+        )
+
+    @with_transaction()
+    def test_0120_test_top_products(self):
+        """
+        Test the top products ranked by quantity and by revenue in every
+        currency
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            product2, = self.Product.create([{
+                'template': self.product_template.id,
+                'code': '456',
+            }])
+            self.create_sale(quantity=5, unit_price=Decimal('10'))
+            sale2 = self.create_sale(quantity=1, unit_price=Decimal('100'))
+            self.SaleLine.write(list(sale2.lines), {'product': product2.id})
+
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+            }
+            sale_query = self.Sale.search(
+                SalesReport.get_sale_domain(data), order=[], query=True
+            )
+            summary_query = SalesReport.get_summary_query(data)
+
+            for query in (None, summary_query):
+                self.assertEqual(
+                    SalesReport.get_top_products(data, sale_query, query),
+                    [
+                        (self.product, 5, [(self.currency, Decimal('50'))]),
+                        (product2, 1, [(self.currency, Decimal('100'))]),
+                    ]
+                )
+                self.assertEqual(
+                    SalesReport.get_top_products(dict(
+                        data, top_products=1, top_products_by='revenue'
+                    ), sale_query, query),
+                    [(product2, 1, [(self.currency, Decimal('100'))])]
+                )
+
+            # The quantities sold in every currency are ranked together
+            euro, = self.Currency.create([{
+                'name': 'Euro',
+                'code': 'EUR',
+                'symbol': 'E',
+            }])
+            sale3 = self.create_sale(
+                quantity=5, unit_price=Decimal('1'), currency=euro.id
+            )
+            self.SaleLine.write(list(sale3.lines), {'product': product2.id})
+            summary_query = SalesReport.get_summary_query(data)
+            for query in (None, summary_query):
+                self.assertEqual(
+                    SalesReport.get_top_products(data, sale_query, query),
+                    [
+                        (product2, 6, [
+                            (euro, Decimal('5')),
+                            (self.currency, Decimal('100')),
+                        ]),
+                        (self.product, 5, [(self.currency, Decimal('50'))]),
+                    ]
+                )
+
+    @with_transaction()
+    def test_0130_test_template_cache(self):
+        """
+        Test the templates are compiled once and reloaded when changed
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        ActionReport = POOL.get('ir.action.report')
+
+        name = 'sales_reports/reports/sales_report.html'
+        BYTECODE_CACHE.clear()
+        self.assertIn(name, warm_templates([name]))
+        self.assertTrue(BYTECODE_CACHE._codes)
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            self.create_sale()
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+            }
+            report, = ActionReport.search([
+                ('report_name', '=', SalesReport.__name__),
+            ])
+            env = SalesReport.get_environment()
+            self.assertIs(SalesReport.get_environment(), env)
+            template = SalesReport.get_report_template(
+                env, report.report_content, report
+            )
+            self.assertIs(SalesReport.get_report_template(
+                env, report.report_content, report
+            ), template)
+
+            oext, content, _, _ = SalesReport.execute([], data)
+            self.assertIn(self.party.name, content.decode('utf-8'))
+            self.assertIs(env.get_template(name), template)
+
+            # Changing the file reloads the template
+            mtime = os.path.getmtime(template.filename)
+            os.utime(template.filename, (mtime + 1, mtime + 1))
+            try:
+                self.assertIsNot(env.get_template(name), template)
+            finally:
+                os.utime(template.filename, (mtime, mtime))
+
+    @with_transaction()
+    def test_0140_test_report_chunks(self):
+        """
+        Test the PDF report is rendered by parts of orders
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        ActionReport = POOL.get('ir.action.report')
+
+        self.setup_defaults()
+        report, = ActionReport.search([
+            ('report_name', '=', SalesReport.__name__),
+        ])
+        report.extension = 'pdf'
+        report.save()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            self.create_sale(reference='First')
+            self.create_sale(reference='Second')
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'chunk_orders': 1,
+                'chunk_output': 'zip',
+            }
+            self.assertEqual(SalesReport.get_chunk_orders(data, 2), 1)
+            self.assertIsNone(SalesReport.get_chunk_orders(data, 1))
+            self.assertIsNone(
+                SalesReport.get_chunk_orders(dict(data, chunk_orders=0), 2)
+            )
+
+            context = SalesReport.get_context([], data)
+            chunks = SalesReport.render(report, context)
+            self.assertEqual(len(chunks), 2)
+
+            # The parts are zipped without conversion to other formats
+            report.extension = 'html'
+            oext, content = SalesReport.convert_chunks(report, chunks)
+            self.assertEqual(oext, 'zip')
+            archive = zipfile.ZipFile(StringIO(content))
+            self.assertEqual(
+                archive.namelist(),
+                ['sales_report-001.html', 'sales_report-002.html']
+            )
+            first, last = [
+                archive.read(name).decode('utf-8')
+                for name in archive.namelist()
+            ]
+            self.assertIn('Part 1 of 2', first)
+            self.assertIn('Period', first)
+            self.assertNotIn('Payments', first)
+            self.assertIn('Part 2 of 2', last)
+            self.assertNotIn('Period', last)
+            self.assertIn('Payments', last)
+
+            # The parts are not delivered unmerged when PyPDF2 is missing
+            report.extension = 'pdf'
+            chunks = SalesReport.render(
+                report, dict(context, chunk_output='merge')
+            )
+            can_merge_pdf = sale_module.can_merge_pdf
+            try:
+                sale_module.can_merge_pdf = lambda: False
+                self.assertRaises(
+                    UserError, SalesReport.convert_chunks, report, chunks
+                )
+            finally:
+                sale_module.can_merge_pdf = can_merge_pdf
+
+            options = SalesReport.get_chunk_pdf_options(
+                SalesReport.get_pdf_options(), 2, 3
+            )
+            self.assertEqual(
+                options['footer_right'], 'Part 2 of 3 - {page}/{pages}'
+            )
+
+    @with_transaction()
+    def test_0150_test_export(self):
+        """
+        Test the report data is exported as CSV and XLSX
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        WizardStart = POOL.get('report.sales.wizard.start')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            self.create_sale(quantity=1, unit_price=Decimal('10'))
+            self.create_sale(quantity=2, unit_price=Decimal('10'))
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'detailed_payments': True,
+                'output_format': 'csv',
+            }
+            oext, content, _, name = SalesReport.execute([], data)
+            self.assertEqual(oext, 'csv')
+            self.assertEqual(name, 'Sales Report')
+
+            rows = list(csv.reader(StringIO(str(content))))
+            titles = [
+                rows[i + 1][0] for i, row in enumerate(rows[:-1]) if not row
+            ]
+            self.assertEqual(rows[0], ['Orders'])
+            self.assertEqual(
+                titles, ['Totals', 'Payments', 'Top Products']
+            )
+            header = rows[1]
+            self.assertEqual(header[:3], ['Order #', 'Date', 'Customer'])
+            self.assertEqual(header[-1], 'Current Status')
+            orders = rows[2:4]
+            # Most recent first
+            self.assertEqual(
+                [order[4] for order in orders], ['20.00', '10.00']
+            )
+            self.assertEqual(orders[0][-1], 'Confirmed')
+            totals = rows[rows.index(['Totals']) + 2]
+            self.assertEqual(totals[:4], ['USD', '30.00', '0.00', '30.00'])
+
+            data['output_format'] = 'xlsx'
+            # The XLSX export is only offered when it is available
+            self.assertEqual(
+                'xlsx' in dict(WizardStart.get_output_formats()),
+                can_export('xlsx')
+            )
+            if can_export('xlsx'):
+                oext, content, _, _ = SalesReport.execute([], data)
+                self.assertEqual(oext, 'xlsx')
+                self.assertTrue(str(content).startswith('PK'))
+            else:
+                self.assertRaises(UserError, SalesReport.execute, [], data)
+
+    @with_transaction()
+    def test_0160_test_prefetch(self):
+        """
+        Test rendering the template does not query the database
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        ActionReport = POOL.get('ir.action.report')
+
+        self.setup_defaults()
+        report, = ActionReport.search([
+            ('report_name', '=', SalesReport.__name__),
+        ])
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sale = self.create_sale()
+            self.create_payment(sale, Decimal('100'))
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'customer': self.party.id,
+                'channel': self.channel.id,
+                'detailed_payments': True,
+            }
+            # Nothing is read from the records created by the test
+            Transaction().cache.clear()
+            context = SalesReport.get_context([], data)
+            self.assertEqual(context['customer'], self.party)
+            self.assertEqual(context['gateways'], set([self.cash_gateway]))
+
+            # Read by the report before rendering the template
+            company = self.Company(self.company.id)
+            company.header_html, company.footer_html
+            report.report_content, report.report_content_custom
+            context.update({
+                'report': report,
+                'company': company,
+            })
+
+            transaction = Transaction()
+            connection = transaction.connection
+            counter = ReportProfile(SalesReport.__name__)
+            transaction.connection = CountingConnection(connection, counter)
+            try:
+                html = SalesReport.render_template(
+                    report.report_content, context, None
+                )
+            finally:
+                transaction.connection = connection
+            self.assertEqual(counter.queries, 0)
+            self.assertIn(self.product.rec_name, html.decode('utf-8'))
+
+    @with_transaction()
+    def test_0170_test_report_definitions(self):
+        """
+        Test the reports of the definitions are rendered in advance and
+        served by the wizard
+        """
+        ReportWizard = POOL.get('report.sales.wizard', type="wizard")
+        Definition = POOL.get('report.sales.definition')
+        Job = POOL.get('report.sales.job')
+        JobOutput = POOL.get('report.sales.job.output', type='report')
+
+        self.setup_defaults()
+
+        yesterday = date.today() - timedelta(days=1)
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            self.create_sale(sale_date=yesterday)
+            definition, = Definition.create([{
+                'name': 'Daily Sales',
+                'channel': self.channel.id,
+            }])
+            self.assertEqual(
+                definition.get_period(date(2017, 3, 1)),
+                (date(2017, 2, 28), date(2017, 2, 28))
+            )
+            definition.period = 'week'
+            self.assertEqual(
+                definition.get_period(date(2017, 3, 1)),
+                (date(2017, 2, 20), date(2017, 2, 26))
+            )
+            definition.period = 'month'
+            self.assertEqual(
+                definition.get_period(date(2017, 3, 1)),
+                (date(2017, 2, 1), date(2017, 2, 28))
+            )
+
+            # The scheduler queues the reports from the configured hour
+            due_hour = definition_module.RENDER_DUE_HOUR
+            try:
+                definition_module.RENDER_DUE_HOUR = 24
+                Definition.run_due()
+                self.assertEqual(Job.search([], count=True), 0)
+                definition_module.RENDER_DUE_HOUR = 0
+                Definition.run_due()
+                self.assertEqual(Job.search([], count=True), 1)
+            finally:
+                definition_module.RENDER_DUE_HOUR = due_hour
+
+            Definition.render_due()
+            job, = Job.search([])
+            self.assertEqual(job.definition, definition)
+            self.assertEqual(job.name, 'Daily Sales')
+            self.assertEqual(job.get_data()['start_date'], yesterday)
+            # Already queued
+            Definition.render_due()
+            self.assertEqual(Job.search([], count=True), 1)
+
+            Job.process([job])
+            self.assertEqual(job.state, 'done')
+
+            session_id, start_state, end_state = ReportWizard.create()
+            data = {
+                start_state: {
+                    'customer': None,
+                    'channel': self.channel.id,
+                    'product': None,
+                    'start_date': yesterday,
+                    'end_date': yesterday,
+                    'detailed_payments': False,
+                    'top_products': 10,
+                    'top_products_by': 'quantity',
+                    'output_format': 'report',
+                    'chunk_output': 'merge',
+                    'background': False,
+                },
+            }
+            result = ReportWizard.execute(session_id, data, 'generate')
+            action, report_data = result['actions'][0]
+            self.assertEqual(action['report_name'], 'report.sales.job.output')
+            self.assertEqual(report_data, {'id': job.id})
+
+            # Served to the other users of the company who read the same
+            # sales, rendered again for the others
+            manager, clerk = self.User.create([{
+                'name': 'Sales Manager',
+                'login': 'sales_manager',
+                'main_company': self.company.id,
+                'company': self.company.id,
+            }, {
+                'name': 'Sales Clerk',
+                'login': 'sales_clerk',
+                'main_company': self.company.id,
+                'company': self.company.id,
+            }])
+            self.Channel.write([self.channel], {
+                'read_users': [('add', [manager.id])],
+            })
+            with Transaction().set_user(manager.id):
+                self.assertEqual(Job.search([], count=True), 0)
+                session_id, start_state, end_state = ReportWizard.create()
+                result = ReportWizard.execute(session_id, data, 'generate')
+                action, report_data = result['actions'][0]
+                self.assertEqual(report_data, {'id': job.id})
+                oext, content, _, _ = JobOutput.execute([], report_data)
+                self.assertEqual(oext, job.output_format)
+                self.assertEqual(content, job.output)
+            with Transaction().set_user(clerk.id):
+                session_id, start_state, end_state = ReportWizard.create()
+                result = ReportWizard.execute(session_id, data, 'generate')
+                action, report_data = result['actions'][0]
+                self.assertEqual(action['report_name'], 'report.sales')
+                # Nor served when asked directly
+                self.assertRaises(
+                    UserError, JobOutput.execute, [], {'id': job.id}
+                )
+
+            # Not served once the sales changed
+            self.create_sale(sale_date=yesterday)
+            session_id, start_state, end_state = ReportWizard.create()
+            result = ReportWizard.execute(session_id, data, 'generate')
+            action, report_data = result['actions'][0]
+            self.assertEqual(action['report_name'], 'report.sales')
+
+    @with_transaction()
+    def test_0180_test_report_batch(self):
+        """
+        Test the reports of a batch of filter sets are the reports of each
+        filter set
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            customer, = self.Party.create([{
+                'name': 'Selina Kyle',
+                'addresses': [('create', [{
+                    'name': 'Selina Kyle',
+                    'city': 'Gotham',
+                    'country': self.country.id,
+                }])],
+            }])
+            sale1 = self.create_sale(unit_price=Decimal('10'))
+            self.create_payment(sale1, Decimal('20'))
+            self.create_sale(
+                quantity=3, unit_price=Decimal('5'), party=customer.id,
+                invoice_address=customer.addresses[0],
+                shipment_address=customer.addresses[0]
+            )
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'detailed_payments': True,
+            }
+            filter_sets = [
+                {'channel': self.channel.id},
+                {'customer': self.party.id},
+                {'customer': customer.id, 'product': self.product.id},
+                {'customer': self.company.party.id},
+            ]
+            contexts = SalesReport.get_batch_contexts(data, filter_sets)
+            self.assertIsNone(contexts[-1])
+            for filter_set, context in zip(filter_sets, contexts[:-1]):
+                expected = SalesReport.get_context([], dict(data, **{
+                    'customer': filter_set.get('customer'),
+                    'product': filter_set.get('product'),
+                    'channel': filter_set.get('channel'),
+                }))
+                self.assertEqual(
+                    [s.id for s in context['sales']],
+                    [s.id for s in expected['sales']]
+                )
+                for name in [
+                        'sale_count', 'gateways', 'customer', 'product',
+                        'channel']:
+                    self.assertEqual(context[name], expected[name])
+                for currency, amounts in expected[
+                        'sales_by_currency'].iteritems():
+                    self.assertEqual(
+                        dict(context['sales_by_currency'][currency]),
+                        dict(amounts)
+                    )
+                self.assertEqual(
+                    dict(context['pbc']), dict(expected['pbc'])
+                )
+                self.assertEqual(
+                    [(p.product, p.quantity, p.revenues)
+                        for p in context['top_10_products']],
+                    [(p.product, p.quantity, p.revenues)
+                        for p in expected['top_10_products']]
+                )
+
+            # The streamed reports search their own sales
+            contexts = SalesReport.get_batch_contexts(
+                dict(data, streaming=True), filter_sets
+            )
+            self.assertIsInstance(contexts[0]['sales'], SaleStream)
+            self.assertEqual(
+                sorted(s.id for s in contexts[0]['sales']),
+                sorted(s.id for s in SalesReport.get_context([], dict(
+                    data, channel=self.channel.id
+                ))['sales'])
+            )
+
+            data['output_format'] = 'csv'
+            results = SalesReport.execute_batch(data, filter_sets)
+            self.assertEqual(len(results), 4)
+            self.assertIsNone(results[-1])
+            oext, content, _, _ = results[1]
+            self.assertEqual(oext, 'csv')
+            self.assertIn('Bruce Wayne', str(content))
+            self.assertNotIn('Selina Kyle', str(content))
+            # The reports are cached
+            self.assertIs(
+                SalesReport.execute_batch(data, filter_sets)[1], results[1]
+            )
+
+            # The admission counts the orders of all the filter sets
+            SalesReport._report_cache.clear()
+            SalesReport._estimate_cache.clear()
+            max_orders = sale_module.ADMISSION_MAX_ORDERS
+            try:
+                sale_module.ADMISSION_MAX_ORDERS = 3
+                SalesReport.get_admission(dict(data, **filter_sets[0]))
+                self.assertRaises(
+                    UserError, SalesReport.execute_batch, data, filter_sets
+                )
+            finally:
+                sale_module.ADMISSION_MAX_ORDERS = max_orders
+
+    @with_transaction()
+    def test_0190_test_sale_amounts(self):
+        """
+        Test the amounts of the sales computed in batch are the amounts of
+        the sale module
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        Tax = POOL.get('account.tax')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            account = self._get_account_by_kind('revenue', self.company)
+            percentage, fixed = Tax.create([{
+                'name': 'VAT',
+                'description': 'VAT',
+                'type': 'percentage',
+                'rate': Decimal('0.1'),
+                'invoice_account': account.id,
+                'credit_note_account': account.id,
+            }, {
+                'name': 'Eco',
+                'description': 'Eco',
+                'type': 'fixed',
+                'amount': Decimal('0.35'),
+                'invoice_account': account.id,
+                'credit_note_account': account.id,
+            }])
+            sale1 = self.create_sale(quantity=3, unit_price=Decimal('3.33'))
+            sale2 = self.create_sale(quantity=1, unit_price=Decimal('0.05'))
+            self.SaleLine.create([{
+                'type': 'line',
+                'quantity': quantity,
+                'product': self.product,
+                'unit': self.uom,
+                'unit_price': unit_price,
+                'description': 'Taxed',
+                'sale': sale.id,
+                'taxes': [('add', taxes)],
+            } for sale, quantity, unit_price, taxes in [
+                (sale1, 2, Decimal('1.115'), [percentage.id]),
+                (sale1, 1, Decimal('7.77'), [percentage.id, fixed.id]),
+                (sale2, -2, Decimal('4.44'), [percentage.id, fixed.id]),
+                (sale2, 5, Decimal('0.07'), [fixed.id]),
+            ]])
+
+            amounts = SalesReport.get_sale_amounts([sale1.id, sale2.id])
+            for sale in self.Sale.browse([sale1, sale2]):
+                self.assertEqual(amounts[sale.id], (
+                    self.company.currency.id, sale.untaxed_amount,
+                    sale.tax_amount, sale.total_amount
+                ))
+            self.assertTrue(amounts[sale1.id].tax)
+            self.assertEqual(SalesReport.get_sale_amounts([]), {})
+
+    def test_0200_test_single_flight(self):
+        """
+        Test the concurrent identical calls are run once
+        """
+        single_flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def render():
+            calls.append(1)
+            started.set()
+            release.wait(10)
+            return ('pdf', bytearray('report'), False, u'Sales Report')
+
+        def request():
+            results.append(single_flight.do('key', render))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait(10)
+        followers = [threading.Thread(target=request) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        # Let the followers wait for the leader
+        time.sleep(0.5)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r is results[0] for r in results))
+
+        # Once done, the next call runs again
+        single_flight.do('key', render)
+        self.assertEqual(len(calls), 2)
+
+    def test_0210_test_single_flight_processes(self):
+        """
+        Test the identical calls of processes sharing a directory are run
+        once
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            # Each instance stands for a server process
+            first = SingleFlight(directory)
+            second = SingleFlight(directory)
+            started, release = threading.Event(), threading.Event()
+            results = []
+
+            def render():
+                started.set()
+                release.wait(10)
+                return ('pdf', bytearray('report'), False, u'Sales Report')
+
+            leader = threading.Thread(
+                target=lambda: results.append(first.do('key', render))
+            )
+            leader.start()
+            started.wait(10)
+            follower = threading.Thread(target=lambda: results.append(
+                second.do('key', lambda: self.fail('Rendered twice'))
+            ))
+            follower.start()
+            # Let the follower wait for the lock file
+            time.sleep(0.5)
+            release.set()
+            for thread in [leader, follower]:
+                thread.join(10)
+            self.assertEqual(results, [
+                ('pdf', bytearray('report'), False, u'Sales Report'),
+            ] * 2)
+        finally:
+            shutil.rmtree(directory)
+
+    @with_transaction()
+    def test_0220_test_flight_key(self):
+        """
+        Test the identical report requests have the same flight key
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'channel': self.channel.id,
+            }
+            version = SalesReport.get_data_version(data)
+            key = SalesReport.get_flight_key(data, version)
+            self.assertEqual(
+                SalesReport.get_flight_key(dict(data), version), key
+            )
+            self.assertNotEqual(
+                SalesReport.get_flight_key(dict(data, channel=None), version),
+                key
+            )
+            self.create_sale()
+            self.assertNotEqual(SalesReport.get_flight_key(
+                data, SalesReport.get_data_version(data)
+            ), key)
+
+    @with_transaction()
+    @unittest.skipIf(backend.name() != 'sqlite', 'replica copied by SQLite')
+    def test_0230_test_read_replica(self):
+        """
+        Test the report is read from the replica database
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sale1 = self.create_sale(quantity=1)
+            self.Sale.store_cache([sale1])
+
+            # A copy of the database stands in for the replica
+            directory = tempfile.mkdtemp()
+            path = config.get('database', 'path')
+            config.set('database', 'path', directory)
+            copy = sqlite3.connect(os.path.join(directory, 'replica.sqlite'))
+            copy.executescript(
+                '\n'.join(Transaction().connection.iterdump())
+            )
+            copy.close()
+
+            sale2 = self.create_sale(quantity=2)
+            self.Sale.store_cache([sale2])
+
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'channel': self.channel.id,
+                'output_format': 'csv',
+            }
+
+            def get_orders(data):
+                _, content, _, _ = SalesReport.execute([], data)
+                rows = list(csv.reader(StringIO(str(content))))
+                return rows[2:rows.index([])]
+
+            try:
+                replica.REPLICA_DATABASE = 'replica'
+                self.assertEqual(len(get_orders(data)), 1)
+                # Not used when disabled or too late
+                self.assertEqual(
+                    len(get_orders(dict(data, replica=False))), 2
+                )
+                replica.REPLICA_MAX_LAG = -1
+                self.assertEqual(len(get_orders(data)), 2)
+                replica.REPLICA_MAX_LAG = 60
+                # Or unreachable
+                replica.REPLICA_DATABASE = 'missing'
+                self.assertEqual(len(get_orders(data)), 2)
+            finally:
+                replica.REPLICA_DATABASE = None
+                replica.REPLICA_MAX_LAG = 60
+                config.set('database', 'path', path)
+                shutil.rmtree(directory)
+
+    @with_transaction()
+    def test_0240_test_admission(self):
+        """
+        Test the large reports are queued and the too large ones refused
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        ReportWizard = POOL.get('report.sales.wizard', type="wizard")
+        WizardStart = POOL.get('report.sales.wizard.start')
+        Job = POOL.get('report.sales.job')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            self.create_sale()
+            self.create_sale()
+            SalesReport._estimate_cache.clear()
+
+            start = WizardStart(
+                start_date=date.today(), end_date=date.today(),
+                channel=self.channel, customer=None, product=None
+            )
+            self.assertEqual(start.on_change_with_estimated_orders(), 2)
+            self.assertIsNone(start.on_change_with_estimated_duration())
+
+            # The duration is computed from the orders counted once
+            estimate_orders = SalesReport.estimate_orders
+            calls = []
+
+            def count_estimates(data):
+                calls.append(data)
+                return estimate_orders(data)
+            SalesReport.estimate_orders = staticmethod(count_estimates)
+            try:
+                changes = start.on_change_with(
+                    ['estimated_duration', 'estimated_orders']
+                )
+            finally:
+                del SalesReport.estimate_orders
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(changes['estimated_orders'], 2)
+            self.assertTrue(
+                isinstance(changes['estimated_duration'], timedelta)
+            )
+
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'channel': self.channel.id,
+            }
+            self.assertEqual(SalesReport.get_admission(data), 'direct')
+            wizard_data = {
+                'customer': None,
+                'channel': self.channel.id,
+                'product': None,
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'detailed_payments': False,
+                'top_products': 10,
+                'top_products_by': 'quantity',
+                'output_format': 'report',
+                'chunk_output': 'merge',
+                'background': False,
+            }
+
+            # The orders estimated by the wizard are reused by the report
+            session_id, start_state, end_state = ReportWizard.create()
+            result = ReportWizard.execute(session_id, {
+                start_state: wizard_data,
+            }, 'generate')
+            action, = result['actions']
+            self.assertNotIn('estimated_orders', action[1])
+            self.create_sale()
+            self.assertEqual(SalesReport.estimate_orders(data), 2)
+            SalesReport._estimate_cache.clear()
+            self.assertEqual(SalesReport.estimate_orders(data), 3)
+
+            background = sale_module.ADMISSION_BACKGROUND_ORDERS
+            max_orders = sale_module.ADMISSION_MAX_ORDERS
+            try:
+                sale_module.ADMISSION_BACKGROUND_ORDERS = 1
+                self.assertEqual(
+                    SalesReport.get_admission(data), 'background'
+                )
+                session_id, start_state, end_state = ReportWizard.create()
+                result = ReportWizard.execute(session_id, {
+                    start_state: wizard_data,
+                }, 'generate')
+                self.assertFalse(result.get('actions'))
+                self.assertEqual(Job.search([], count=True), 1)
+
+                sale_module.ADMISSION_MAX_ORDERS = 1
+                self.assertRaises(UserError, SalesReport.get_admission, data)
+                self.assertRaises(
+                    UserError, SalesReport.execute, [],
+                    dict(data, output_format='csv')
+                )
+                # The estimates of the clients are ignored
+                self.assertRaises(
+                    UserError, SalesReport.execute, [],
+                    dict(data, output_format='csv', estimated_orders=1)
+                )
+            finally:
+                sale_module.ADMISSION_BACKGROUND_ORDERS = background
+                sale_module.ADMISSION_MAX_ORDERS = max_orders
+
+    @with_transaction()
+    def test_0250_test_preview(self):
+        """
+        Test the HTML preview lists the first orders with the full totals
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+        ReportWizard = POOL.get('report.sales.wizard', type="wizard")
+        Job = POOL.get('report.sales.job')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            sales = [
+                self.create_sale(quantity=1, unit_price=Decimal('10')),
+                self.create_sale(quantity=1, unit_price=Decimal('20')),
+                self.create_sale(quantity=1, unit_price=Decimal('40')),
+            ]
+            self.Sale.store_cache(sales)
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'channel': self.channel.id,
+                'output_format': 'preview',
+                'preview_orders': 2,
+            }
+            context = SalesReport.get_context([], dict(data, streaming=False))
+            self.assertEqual(len(context['sales']), 2)
+            self.assertEqual(context['sale_count'], 3)
+            self.assertEqual(
+                context['sales_by_currency'][self.company.currency]['total'],
+                Decimal('70')
+            )
+
+            oext, content, _, _ = SalesReport.execute([], data)
+            self.assertEqual(oext, 'html')
+            html = str(content)
+            self.assertIn('Showing 2 of 3 orders', html)
+            self.assertIn('/sale.sale/%d"' % sales[2].id, html)
+            self.assertNotIn('/sale.sale/%d"' % sales[0].id, html)
+
+            # The previews are rendered directly whatever the admission
+            background = sale_module.ADMISSION_BACKGROUND_ORDERS
+            max_orders = sale_module.ADMISSION_MAX_ORDERS
+            try:
+                sale_module.ADMISSION_BACKGROUND_ORDERS = 1
+                sale_module.ADMISSION_MAX_ORDERS = 2
+                oext, content, _, _ = SalesReport.execute(
+                    [], dict(data, preview_orders=1)
+                )
+                self.assertEqual(oext, 'html')
+                self.assertIn('Showing 1 of 3 orders', str(content))
+
+                session_id, start_state, end_state = ReportWizard.create()
+                result = ReportWizard.execute(session_id, {
+                    start_state: {
+                        'customer': None,
+                        'channel': self.channel.id,
+                        'product': None,
+                        'start_date': date.today(),
+                        'end_date': date.today(),
+                        'detailed_payments': False,
+                        'top_products': 10,
+                        'top_products_by': 'quantity',
+                        'output_format': 'preview',
+                        'chunk_output': 'merge',
+                        'background': False,
+                    },
+                }, 'generate')
+                action, = result['actions']
+                self.assertEqual(action[1]['output_format'], 'preview')
+                self.assertEqual(Job.search([], count=True), 0)
+            finally:
+                sale_module.ADMISSION_BACKGROUND_ORDERS = background
+                sale_module.ADMISSION_MAX_ORDERS = max_orders
+
+    @with_transaction()
+    def test_0260_test_summary_lines(self):
+        """
+        Test the summary is refreshed with the lines of the sales
+        """
+        SalesReport = POOL.get('report.sales', type='report')
+
+        self.setup_defaults()
+
+        with Transaction().set_context({
+            'company': self.company.id,
+            'channel': self.channel.id}
+        ):
+            product2, = self.Product.create([{
+                'template': self.product_template.id,
+                'code': '456',
+            }])
+            sale = self.create_sale(quantity=2, unit_price=Decimal('10'))
+            data = {
+                'start_date': date.today(),
+                'end_date': date.today(),
+                'streaming': False,
+            }
+            self.assertTrue(SalesReport.use_summary(data))
+
+            def check_report(products, total):
+                context = SalesReport.get_context([], data)
+                self.assertEqual(
+                    [(p.product, p.quantity, dict(p.revenues))
+                        for p in context['top_10_products']],
+                    products
+                )
+                self.assertEqual(
+                    context['sales_by_currency'][self.currency]['total'],
+                    total
+                )
+
+            check_report(
+                [(self.product, 2, {self.currency: Decimal('20')})],
+                Decimal('20')
+            )
+
+            line, = sale.lines
+            self.SaleLine.write([line], {'quantity': 3})
+            check_report(
+                [(self.product, 3, {self.currency: Decimal('30')})],
+                Decimal('30')
+            )
+
+            line2, = self.SaleLine.create([{
+                'type': 'line',
+                'quantity': 1,
+                'product': product2.id,
+                'unit': self.uom,
+                'unit_price': Decimal('5'),
+                'description': 'Test description',
+                'sale': sale.id,
+            }])
+            check_report([
+                (self.product, 3, {self.currency: Decimal('30')}),
+                (product2, 1, {self.currency: Decimal('5')}),
+            ], Decimal('35'))
+
+            self.SaleLine.delete([line])
+            check_report(
+                [(product2, 1, {self.currency: Decimal('5')})], Decimal('5')
+            )
+
 
 def suite():
     "Define suite"